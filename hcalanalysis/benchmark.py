@@ -0,0 +1,152 @@
+'''
+Offline benchmark of the processors, on synthetic hcalnano files (see hcaltools.synthetic).
+
+Each processor in processors/ (those declaring `columns`) and splash23/splash_finder.py is run over one file
+per occupancy preset, in a fresh process, and events/s, MB/s (decompressed MB of the declared branches) and
+peak RSS are reported. Results can be stored as a baseline, and compared against it later:
+
+    python benchmark.py --save-baseline    # on a reference version
+    python benchmark.py                    # compare; exits with 1 if anything is slower than --tolerance
+'''
+import os
+import sys
+import json
+import time
+import inspect
+import resource
+import importlib
+import multiprocessing
+import concurrent.futures
+
+from coffea import processor
+from hcalanalysis.schemas import HcalNanoAODSchema
+from hcaltools import runner, synthetic
+from hcaltools.chunking import bytes_per_event
+from hcaltools.columns import ColumnSet
+from hcaltools.eventselection import EventSelection
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+
+def find_processors(verbose=False):
+    """{"module.Class": class} of the runnable processors (ProcessorABC subclasses declaring columns)
+
+    With verbose, the processors skipped for not declaring columns are listed.
+    """
+    import hcalanalysis.processors
+    modules = [f"hcalanalysis.processors.{name}" for name in hcalanalysis.processors.__all__]
+    modules.append("hcalanalysis.splash23.splash_finder")
+    processors = {}
+    for module_name in sorted(modules):
+        # Modules missing an optional dependency are skipped; any other error in a processor module is raised
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError as e:
+            print(f"WARNING : Skipping {module_name}, which could not be imported: {e!r}")
+            continue
+        for name, obj in vars(module).items():
+            if inspect.isclass(obj) and issubclass(obj, processor.ProcessorABC) and obj.__module__ == module_name:
+                if hasattr(obj, "columns"):
+                    processors[f"{module_name.split('.')[-1]}.{name}"] = obj
+                elif verbose:
+                    # Without columns, the MB/s can't be computed, and the synthetic files may miss branches it reads
+                    print(f"WARNING : Skipping {module_name.split('.')[-1]}.{name}, which doesn't declare `columns`")
+    return processors
+
+
+def make_inputs(workdir, nevents, presets):
+    """Write (or reuse) one synthetic file per preset, and an event list selecting every 100th event
+
+    Like the few beam splashes of a splash run: processors keeping per-event maps of the selected events
+    (SplashProcessor) would not fit in memory with all the events selected.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    fileset = {}
+    for preset in presets:
+        path = os.path.join(workdir, f"synthetic_{preset}_{nevents}.root")
+        if not os.path.isfile(path):
+            print(f"Writing {path}")
+            occupancy, mean_charge = synthetic.PRESETS[preset]
+            synthetic.write_file(path, nevents, occupancy=occupancy, mean_charge=mean_charge)
+        fileset[f"synthetic_{preset}"] = [path]
+    eventlist = os.path.join(workdir, f"synthetic_events_{nevents}.json")
+    EventSelection({dataset: range(1, nevents + 1, 100) for dataset in fileset}).to_file(eventlist)
+    return fileset, eventlist
+
+
+def _benchmark_one(processor_name, dataset, filenames, eventlist, chunksize):
+    """Run one processor over one dataset (in a fresh process); returns the measurements"""
+    processor_class = find_processors()[processor_name]
+    kwargs = {}
+    if "event_list" in inspect.signature(processor_class.__init__).parameters:
+        kwargs["event_list"] = eventlist
+    processor_instance = processor_class(**kwargs)
+
+    chunks = runner.plan_chunks({dataset: filenames}, treename="Events", chunksize=chunksize)
+    nevents = sum(chunk.entrystop - chunk.entrystart for chunk in chunks)
+    columns = ColumnSet.from_processor(processor_instance)
+    nbytes = sum(bytes_per_event(filename, "Events", columns) for filename in filenames) / len(filenames) * nevents
+
+    ts_start = time.time()
+    runner.run(chunks, processor_instance, HcalNanoAODSchema, executor="iterative", status=False)
+    seconds = time.time() - ts_start
+    return {
+        "events_per_s": nevents / seconds,
+        "mb_per_s": nbytes / 1e6 / seconds,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3,
+        "nevents": nevents,
+        "seconds": seconds,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the processors on synthetic hcalnano files")
+    parser.add_argument("-n", "--events", type=int, default=500, help="Events per synthetic file")
+    parser.add_argument("--presets", type=str, default="minbias,splash", help=f"Comma-separated occupancy presets, from {list(synthetic.PRESETS)}")
+    parser.add_argument("-p", "--processors", type=str, default=None, help="Comma-separated processors to run, e.g. bx1processor.BX1Processor (default: all)")
+    parser.add_argument("--workdir", type=str, default="benchmark_inputs", help="Directory for the synthetic files")
+    parser.add_argument("--chunksize", type=int, default=250, help="Chunk size")
+    parser.add_argument("--baseline", type=str, default=BASELINE, help="Baseline json")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative events/s loss reported as a regression")
+    args = parser.parse_args()
+
+    processor_names = list(find_processors(verbose=True))
+    if args.processors:
+        processor_names = [name for name in processor_names if name in args.processors.split(",")]
+    fileset, eventlist = make_inputs(args.workdir, args.events, args.presets.split(","))
+
+    # Each benchmark runs in a freshly spawned process, so that the peak RSS is its own
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for processor_name in processor_names:
+        for dataset, filenames in fileset.items():
+            key = f"{processor_name}@{dataset}"
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                results[key] = pool.submit(_benchmark_one, processor_name, dataset, filenames, eventlist, args.chunksize).result()
+
+    baseline = {}
+    if os.path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    regressions = []
+    print(f"{'benchmark':<55} {'events/s':>10} {'MB/s':>8} {'peak RSS [MB]':>14} {'vs. baseline':>13}")
+    for key, result in results.items():
+        comparison = ""
+        if key in baseline:
+            ratio = result["events_per_s"] / baseline[key]["events_per_s"]
+            comparison = f"{ratio:.2f}x"
+            if ratio < 1. - args.tolerance:
+                comparison += " SLOWER"
+                regressions.append(key)
+        print(f"{key:<55} {result['events_per_s']:>10.1f} {result['mb_per_s']:>8.1f} {result['peak_rss_mb']:>14.1f} {comparison:>13}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+    if regressions:
+        print(f"Regressions (events/s more than {args.tolerance:.0%} below baseline): {regressions}")
+        sys.exit(1)
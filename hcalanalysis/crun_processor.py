@@ -1,28 +1,40 @@
 '''
 This script is a condor launcher for run_processor.py. Specifically, this script handles:
-   - Dividing input files into condor subjobs
+   - Dividing input files into condor subjobs (one per file, or packed/split into equal jobs by events or bytes)
    - Creating usercode tarball for distribution to worker nodes
    - Setting up the executable (i.e. wrapper script around run_processor.py) to be run on the worker nodes
 '''
 
 import os
 import sys
+import json
+import shutil
 import datetime
 import yaml
 from pprint import pprint
 
+from hcaltools import metadatacache, tarballs
+from hcaltools.jobplanner import plan_jobs, job_entry_ranges
+from hcaltools.nanoindex import load_fileset, normalize_filename
+
 import argparse
 parser = argparse.ArgumentParser(description="Run hcalanalysis processors on condor")
 parser.add_argument(dest="processor_name", type=str, help="Name of processor, i.e. bx1processor.BX1Processor")
 parser.add_argument("-i", "--inputfiles", type=str, help="List of input files (comma-separated)")
 parser.add_argument("-I", "--inputfilestxt", type=str, help="")
 parser.add_argument("-y", "--inputfilesyaml", type=str, help="")
+parser.add_argument("-j", "--inputfilesjson", type=str, help="Dataset index json (see filelists/makeindex.py)")
 parser.add_argument("-d", "--dataset", type=str, help="Dataset name (only for -i/--inputfiles; for -I, the dataset name is taken from .yaml)")
 parser.add_argument("-o", "--outputfile", type=str, required=True, help="Output file")
 parser.add_argument("-w", "--workers", type=int, default=4, help="Number of workers per job")
-parser.add_argument("--retar_venv", action="store_true", help="Retar venv (takes a while)")
+parser.add_argument("--retar_venv", action="store_true", help="Retar venv even if its fingerprint is unchanged (takes a while)")
+parser.add_argument("--tar-codec", type=str, default="zst" if shutil.which("zstd") else "gz", choices=list(tarballs.CODECS), help="Tarball compression (zst is much faster to pack and unpack; default: zst if available)")
 parser.add_argument("--chunksize", type=int, default=250, help="Chunk size")
 parser.add_argument("--maxchunks", type=int, default=None, help="Max chunks")
+job_size_group = parser.add_mutually_exclusive_group()
+job_size_group.add_argument("--events-per-job", type=int, default=None, help="Pack/split the files of each dataset into jobs of about this many events (default: one job per file)")
+job_size_group.add_argument("--mb-per-job", type=float, default=None, help="Pack/split the files of each dataset into jobs of about this many MB of input (default: one job per file)")
+parser.add_argument("--metadata-cache", type=str, default=metadatacache.DEFAULT_PATH, help="Persistent cache of file sizes and entry counts (see hcaltools/metadatacache.py)")
 args = parser.parse_args()
 
 # Input filehandling
@@ -41,27 +53,56 @@ elif args.inputfilesyaml:
         doc = yaml.load(f)
         for dataset, filelist in doc.items():
             fileset[dataset] = filelist
+
+file_metadata = {}
+if args.inputfilesjson:
+    fileset, file_metadata = load_fileset(args.inputfilesjson)
+fileset = {dataset: [normalize_filename(x) for x in filelist] for dataset, filelist in fileset.items()}
+file_metadata = {normalize_filename(k): v for k, v in file_metadata.items()}
 pprint(fileset)
 
-# Tar inputs
-print("Tarring user code...")
+# Job planning: each job is a list of (file, entrystart, entrystop); entrystart=None means the whole file
+jobs = {}
+if args.events_per_job or args.mb_per_job:
+    # Sizes and entry counts from the index metadata, or else from the metadata cache
+    missing = [x for filelist in fileset.values() for x in filelist if x not in file_metadata]
+    if missing:
+        file_metadata.update(metadatacache.MetadataCache(args.metadata_cache).get(missing))
+    for dataset, filelist in fileset.items():
+        if args.events_per_job:
+            files = [(x, file_metadata[x]["nentries"], 1.) for x in filelist]
+            target = args.events_per_job
+        else:
+            files = [(x, file_metadata[x]["nentries"], file_metadata[x]["size"] / max(file_metadata[x]["nentries"], 1)) for x in filelist]
+            target = args.mb_per_job * 1.e6
+        jobs[dataset] = plan_jobs(files, target, chunksize=args.chunksize)
+        print(f"{dataset}: {len(filelist)} files -> {len(jobs[dataset])} jobs")
+else:
+    for dataset, filelist in fileset.items():
+        jobs[dataset] = [[(x, None, None)] for x in filelist]
+
+# Tar inputs: the venv and user code layers are reused when their fingerprints are unchanged (see hcaltools/tarballs.py)
 whoami = os.getlogin()
 tarball_dir = f"/afs/cern.ch/work/{whoami[0]}/{whoami}/tarballs"
 os.system(f"mkdir -p {tarball_dir}")
-os.system(f"tar -czvf {tarball_dir}/usercode.tar.gz -C $HCALANALYSISDIR/.. hcalanalysis/hcalanalysis hcalanalysis/hcaltools \
-   --exclude='*.root' \
-   --exclude='*.coffea*' \
-   --exclude='*/job*' \
-   --exclude='*.png' \
-   --exclude='*.pdf' \
-   --exclude='*.tar.gz' \
-   --exclude='*ipynb ' \
-   --exclude='hcalanalysis/hcalanalysis/condor'")
-print("...done tarring user code")
-if args.retar_venv:
-    print("Retarring virtual environment...")
-    os.system(f"tar -czf {tarball_dir}/venv.tar.gz -C $HCALANALYSISDIR/.. hcalanalysis/venv hcalanalysis/setup.py hcalanalysis/env.sh --exclude='*.root' --exclude='*.coffea' --exclude='*.png' --exclude='*.pdf'")
-    print("...done tarring virtual environment")
+tar_root = os.path.expandvars("$HCALANALYSISDIR/..")
+usercode_files = tarballs.list_files(tar_root, ["hcalanalysis/hcalanalysis", "hcalanalysis/hcaltools", "hcalanalysis/setup.py", "hcalanalysis/env.sh"], exclude=[
+    "*.root",
+    "*.coffea*",
+    "*/job[0-9]*",
+    "*.png",
+    "*.pdf",
+    "*.tar.*",
+    "*.ipynb",
+    "*/__pycache__",
+    "hcalanalysis/hcalanalysis/condor",
+])
+usercode_fingerprint = tarballs.content_fingerprint(tar_root, usercode_files)
+usercode_tarball = tarballs.cached_tarball(tarball_dir, "usercode", tar_root, usercode_files, usercode_fingerprint, codec=args.tar_codec)
+venv_fingerprint = tarballs.venv_fingerprint(os.path.join(tar_root, "hcalanalysis/venv"))
+venv_files = lambda: tarballs.list_files(tar_root, ["hcalanalysis/venv"], exclude=["*.root", "*.coffea", "*.png", "*.pdf"])
+venv_tarball = tarballs.cached_tarball(tarball_dir, "venv", tar_root, venv_files, venv_fingerprint, codec=args.tar_codec, force=args.retar_venv)
+extract_flags = tarballs.CODECS[args.tar_codec][2]
 
 # Make submission directory
 ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -83,13 +124,17 @@ for dataset in fileset.keys():
     output_suffix = args.outputfile.split(".")[-1]
     this_outputfile = f"{output_prefix}.{dataset}.{output_suffix}"
 
-    # One job per file. 
-    # @todo support >1 file per job? 
-    # Might not be necessary, RAW files are already huge... typical hcalnano file size is already ~2GB. 
-    this_nsubjobs = len(fileset[dataset])
+    # One job per file, or the packed/split jobs from the job planning
+    this_jobs = jobs[dataset]
+    this_nsubjobs = len(this_jobs)
+    job_files = [",".join(dict.fromkeys(x[0] for x in job)) for job in this_jobs]
+    job_ranges = [json.dumps(job_entry_ranges(job), separators=(",", ":")) for job in this_jobs]
+    use_entryranges = any(x[1] is not None for job in this_jobs for x in job)
 
     # Make run script (to be run on batch node)
     processor_command = f"python run_processor.py {args.processor_name} -i ${{INPUT_FILES[$1]}} -d {dataset} -o {this_outputfile}.$1 -w {args.workers}"
+    if use_entryranges:
+        processor_command += f" --entryranges \"${{ENTRY_RANGES[$1]}}\""
     if args.chunksize:
         processor_command += f" --chunksize {args.chunksize}"
     if args.maxchunks:
@@ -99,8 +144,19 @@ for dataset in fileset.keys():
         run_script.write(f"""
 #!/bin/bash
 export HOME=$(pwd)
-tar -xzf usercode.tar.gz
-tar -xzf venv.tar.gz
+# The venv layer is unpacked once per node, and shared by the jobs which land there
+LAYER_DIR=${{HCALANALYSIS_LAYER_CACHE:-/tmp/$(id -un)-hcalanalysis-layers}}/venv-{venv_fingerprint[:16]}
+mkdir -p $(dirname $LAYER_DIR)
+(
+    flock 9
+    if [ ! -e $LAYER_DIR/.unpacked ]; then
+        rm -rf $LAYER_DIR $LAYER_DIR.tmp
+        mkdir -p $LAYER_DIR.tmp
+        tar {extract_flags} {os.path.basename(venv_tarball)} -C $LAYER_DIR.tmp && mv $LAYER_DIR.tmp $LAYER_DIR && touch $LAYER_DIR/.unpacked
+    fi
+) 9>$LAYER_DIR.lock
+tar {extract_flags} {os.path.basename(usercode_tarball)}
+ln -sfn $LAYER_DIR/hcalanalysis/venv hcalanalysis/venv
 echo 'After untarring, contents of ${{PWD}}:'
 ls -lrth
 cd hcalanalysis
@@ -108,14 +164,15 @@ source env.sh
 cd hcalanalysis
 echo 'Contents of ${{PWD}}:'
 ls -lrth
-INPUT_FILES=({" ".join(fileset[dataset])})
+INPUT_FILES=({" ".join(job_files)})
+ENTRY_RANGES=({" ".join(f"'{x}'" for x in job_ranges) if use_entryranges else ""})
 {processor_command}
 mv *coffea* $_CONDOR_SCRATCH_DIR/
 echo 'Done with run.sh'
 """)
 
     # Files to transfer to batch
-    files_to_transfer = [f"{tarball_dir}/usercode.tar.gz", f"{tarball_dir}/venv.tar.gz"]
+    files_to_transfer = [usercode_tarball, venv_tarball]
 
     # Make condor command
     csub_command = f"csub {submission_subdir}/run.sh -F {','.join(files_to_transfer)} -n {this_nsubjobs} -d {submission_subdir} -t workday --mem 6000 2>&1"
@@ -0,0 +1,42 @@
+'''
+Build the event number -> entry index sidecars (see hcaltools/eventindex.py) for the files of a nanoindex.
+Only the run, luminosityBlock and event branches are read. Files which already have an index are skipped.
+
+Example:
+    python makeeventindex.py -j nanoindex/nanoindex_r365373_Splashes_FEVT.json -o eventindex -w 8
+'''
+import os
+import concurrent.futures
+
+from hcaltools.eventindex import EventIndexStore, FileEventIndex
+from hcaltools.nanoindex import load_fileset, normalize_filename
+
+import argparse
+parser = argparse.ArgumentParser(description="Build event number -> entry index sidecars for a nanoindex")
+parser.add_argument("-j", "--inputfilesjson", type=str, required=True, help="nanoindex json (see makeindex.py)")
+parser.add_argument("-o", "--outputdir", type=str, default="eventindex", help="Index directory")
+parser.add_argument("-w", "--workers", type=int, default=8, help="Number of files to index in parallel")
+parser.add_argument("-f", "--force", action="store_true", help="Rebuild existing indices")
+args = parser.parse_args()
+
+fileset, _ = load_fileset(args.inputfilesjson)
+
+# Same file name normalization as run_processor.py, so the indices are found again there
+filenames = []
+for dataset, filelist in fileset.items():
+    for filename in filelist:
+        filenames.append(normalize_filename(filename))
+
+store = EventIndexStore(args.outputdir)
+if not args.force:
+    filenames = [x for x in filenames if not os.path.isfile(store.path(x))]
+print(f"Indexing {len(filenames)} files")
+
+with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+    futures = {pool.submit(FileEventIndex.build, filename): filename for filename in filenames}
+    for future in concurrent.futures.as_completed(futures):
+        filename = futures[future]
+        index = future.result()
+        store.add(filename, index)
+        print(f"{filename} : {len(index)} events")
+store.save_summary()
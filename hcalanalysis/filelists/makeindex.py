@@ -1,37 +1,39 @@
 import os
-import subprocess
 import json
 
+from hcaltools.nanoindex import listers, make_index
+from hcaltools.eventindex import EventIndexStore
+
 import argparse
 parser = argparse.ArgumentParser(description="""
-Index a folder on EOS and dump to json
+Index a folder on EOS and dump to json, with the size, number of events, UUID and run/LS/event ranges of each file
+(see hcaltools/nanoindex.py). Subfolders are listed, and files opened, in parallel.
 [1] LFN = logical file name, which is a path starting with /store/group/dpg_hcal/...
 """)
 parser.add_argument("-d", "--directory", type=str, required=True, help="Directory to index")
 parser.add_argument("-k", "--key", type=str, required=True, help="Key of this dataset in the dictionary")
 parser.add_argument("-e", "--ext", default=".root", type=str, help="File extension to index")
+parser.add_argument("-j", "--workers", type=int, default=16, help="Number of parallel listings/file reads")
+parser.add_argument("-b", "--backend", type=str, default="eos", choices=list(listers), help="Listing backend (local: local filesystem, for testing)")
+parser.add_argument("--max-depth", type=int, default=None, help="Maximum depth of subfolders to index (0: only the directory itself)")
+parser.add_argument("--no-metadata", action="store_true", help="Only list the files, without opening them")
+parser.add_argument("--eventindex", type=str, default=None, help="Also store the event number -> entry sidecars here (see makeeventindex.py)")
+parser.add_argument("-o", "--outputdir", type=str, default="nanoindex", help="Output folder")
 args = parser.parse_args()
 
-def get_children(parent):
-	#print(f"DEBUG : Call to get_children({parent})")
-	command = f"eos root://eoscms.cern.ch ls -F {parent}"
-	print(command)
-	result = subprocess.getoutput(command)#, stdout=subprocess.PIPE)
-	print(result)
-	return result.split("\n")
-
-def get_subfolders(parent):
-	subfolders = []
-	for x in get_children(parent):
-		if len(x) == 0: 
-			continue
-		if x[-1] == "/":
-			subfolders.append(x)
-	return subfolders
+index_store = EventIndexStore(args.eventindex) if args.eventindex else None
+index = make_index(listers[args.backend](), args.directory,
+	ext=args.ext,
+	workers=args.workers,
+	max_depth=args.max_depth,
+	metadata=not args.no_metadata,
+	index_store=index_store,
+)
+if index_store is not None:
+	index_store.save_summary()
 
-folder_contents = get_children(args.directory)
-folder_contents = [x for x in folder_contents if x.endswith(args.ext)]
-folder_contents = [f"root://eoscms.cern.ch/{args.directory}/{x}" for x in folder_contents]
-index = {args.key: folder_contents}
-with open(f"nanoindex/nanoindex_{args.key}.json", "w") as f:
-	json.dump(index, f, sort_keys=True, indent=2)
+nevents = sum(metadata["nentries"] for metadata in index["metadata"].values())
+print(f"{args.key}: {len(index['files'])} files, {nevents} events")
+os.makedirs(args.outputdir, exist_ok=True)
+with open(os.path.join(args.outputdir, f"nanoindex_{args.key}.json"), "w") as f:
+	json.dump({args.key: index}, f, sort_keys=True, indent=2)
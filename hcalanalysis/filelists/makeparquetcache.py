@@ -0,0 +1,92 @@
+'''
+Convert the files of a nanoindex to a column-pruned parquet cache (see hcaltools/parquetio.py), and write a
+nanoindex of the cache, which run_processor.py -j reads like the original.
+
+Only the selected collections (and run/luminosityBlock/event) are copied, so reprocessing skips both the
+ROOT decompression of everything else and the transfer from EOS. The cache is partitioned by dataset, with
+one parquet file per input file. Files already converted from the same source file (same UUID) are skipped.
+
+Example:
+    python makeparquetcache.py -j nanoindex/nanoindex_r365373_Splashes_FEVT.json -o /tmp/parquetcache -w 8
+'''
+import os
+import json
+import hashlib
+import concurrent.futures
+
+from hcaltools import parquetio
+from hcaltools.columns import ColumnSet
+from hcaltools.nanoindex import load_fileset, normalize_filename
+from hcaltools.skim import EVENT_ID_BRANCHES
+
+import argparse
+parser = argparse.ArgumentParser(description="Convert the files of a nanoindex to a column-pruned parquet cache")
+parser.add_argument("-j", "--inputfilesjson", type=str, required=True, help="nanoindex json (see makeindex.py)")
+parser.add_argument("-o", "--outputdir", type=str, required=True, help="Cache directory")
+parser.add_argument("-c", "--collections", type=str, default="bunchCrossing,DigiHB,DigiHE,DigiHF,RecHitHBHE", help="Comma-separated collections/branches to copy (run/luminosityBlock/event are always copied)")
+parser.add_argument("-d", "--datasets", type=str, default=None, help="Comma-separated datasets of the index to convert (default: all)")
+parser.add_argument("-w", "--workers", type=int, default=8, help="Number of files converted in parallel")
+parser.add_argument("--row-group-size", type=int, default=250, help="Entries per parquet row group; chunks read whole row groups, so use about the --chunksize of run_processor.py")
+parser.add_argument("--compression", type=str, default="snappy", help="Parquet compression codec (snappy, lz4, zstd, none)")
+parser.add_argument("-f", "--force", action="store_true", help="Convert files even if an up-to-date copy exists")
+args = parser.parse_args()
+
+fileset, file_metadata = load_fileset(args.inputfilesjson)
+if args.datasets:
+    fileset = {dataset: fileset[dataset] for dataset in args.datasets.split(",")}
+columns = ColumnSet({name: None for name in (*EVENT_ID_BRANCHES, *args.collections.split(","))})
+
+
+def cache_path(dataset, url):
+    stem = os.path.splitext(os.path.basename(url))[0]
+    url_hash = hashlib.sha1(url.encode()).hexdigest()[:8]
+    return os.path.abspath(os.path.join(args.outputdir, dataset, f"{stem}-{url_hash}.parquet"))
+
+
+def up_to_date(url, path):
+    if not os.path.isfile(path):
+        return False
+    uuid = file_metadata.get(url, {}).get("uuid")
+    return uuid is not None and parquetio.source_uuid(path) == uuid
+
+
+index = {}
+with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+    # (dataset, file, cache path, conversion future; None if the cached copy is up to date)
+    conversions = []
+    for dataset, filelist in fileset.items():
+        index[dataset] = {"files": [], "metadata": {}}
+        for filename in filelist:
+            url = normalize_filename(filename)
+            path = cache_path(dataset, url)
+            if not args.force and up_to_date(filename, path):
+                print(f"{url} : up to date")
+                conversions.append((dataset, filename, path, None))
+            else:
+                conversions.append((dataset, filename, path, pool.submit(parquetio.convert_root_file, url, path, columns,
+                                                                         row_group_size=args.row_group_size, compression=args.compression)))
+
+    for dataset, filename, path, future in conversions:
+        if future is not None:
+            try:
+                nentries = future.result()
+            except Exception as e:
+                print(f"WARNING : Could not convert {filename} ({e!r}), leaving it out of the cache index")
+                continue
+            print(f"{filename} -> {path} : {nentries} events")
+        # The event ranges of the source file still apply; size and UUID are those of the parquet file
+        metadata = dict(file_metadata.get(filename, {}))
+        metadata.update(
+            size=os.path.getsize(path),
+            uuid=parquetio.file_uuid(path),
+            nentries=parquetio.num_entries(path),
+            source=filename,
+        )
+        index[dataset]["files"].append(path)
+        index[dataset]["metadata"][path] = metadata
+
+os.makedirs(args.outputdir, exist_ok=True)
+index_path = os.path.join(args.outputdir, f"nanoindex_{os.path.splitext(os.path.basename(args.inputfilesjson))[0].replace('nanoindex_', '')}.json")
+with open(index_path, "w") as f:
+    json.dump(index, f, sort_keys=True, indent=2)
+print(f"Cache index: {index_path}")
@@ -0,0 +1,67 @@
+'''
+Merge the per-job outputs of crun_processor.py, <prefix>.<dataset>.<suffix>.<N>, into one
+<prefix>.<dataset>.<suffix> per dataset (see hcaltools/merge.py).
+'''
+import os
+import re
+import glob
+import shutil
+import tempfile
+
+from hcaltools.merge import tree_merge
+
+import argparse
+parser = argparse.ArgumentParser(description="Merge per-job .coffea outputs into one file per dataset (tree reduction in parallel)")
+parser.add_argument(dest="inputs", type=str, nargs="+", help="Output files, glob patterns, or directories to search (e.g. the condor submission directory)")
+parser.add_argument("-o", "--outputdir", type=str, default=".", help="Output folder for the merged files")
+parser.add_argument("-w", "--workers", type=int, default=4, help="Number of merge processes")
+parser.add_argument("-k", "--files-per-merge", type=int, default=4, help="Number of files merged by each process at a time")
+parser.add_argument("--min-size", type=int, default=100, help="Skip outputs smaller than this many bytes (failed jobs)")
+parser.add_argument("--tmpdir", type=str, default=None, help="Folder for intermediate merges (default: a temporary folder in the output folder)")
+args = parser.parse_args()
+
+job_output_re = re.compile(r"^(?P<prefix>.+)\.(?P<dataset>[^.]+)\.(?P<suffix>[^.]+)\.(?P<job>\d+)$")
+
+# Find the job outputs
+paths = []
+for input in args.inputs:
+    if os.path.isdir(input):
+        for dirpath, _, filenames in os.walk(input):
+            paths.extend(os.path.join(dirpath, filename) for filename in filenames)
+    else:
+        paths.extend(glob.glob(input))
+
+groups = {}
+output_paths = {}
+for path in sorted(set(paths)):
+    match = job_output_re.match(os.path.basename(path))
+    if not match:
+        continue
+    name = f"{match.group('prefix')}.{match.group('dataset')}.{match.group('suffix')}"
+    groups.setdefault(name, []).append(path)
+    output_paths[name] = os.path.join(args.outputdir, name)
+if not groups:
+    raise ValueError(f"No job outputs (<prefix>.<dataset>.<suffix>.<N>) found in {args.inputs}")
+for name in sorted(groups):
+    print(f"{name}: {len(groups[name])} job outputs")
+
+os.makedirs(args.outputdir, exist_ok=True)
+tmpdir = args.tmpdir or tempfile.mkdtemp(prefix="merge_", dir=args.outputdir)
+try:
+    skipped = tree_merge(groups, output_paths, tmpdir,
+        k=args.files_per_merge,
+        workers=args.workers,
+        min_size=args.min_size,
+    )
+finally:
+    if not args.tmpdir:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+for name in sorted(groups):
+    for path, reason in sorted(skipped[name]):
+        print(f"WARNING : Skipped {path} ({reason})")
+    nmerged = len(groups[name]) - len(skipped[name])
+    if nmerged:
+        print(f"{name}: merged {nmerged}/{len(groups[name])} job outputs into {output_paths[name]}")
+    else:
+        print(f"WARNING : {name}: no valid job outputs, nothing written")
@@ -8,12 +8,26 @@ from coffea import processor
 from coffea import hist as chist
 from coffea import nanoevents
 import hist
+from hcaltools.profiling import stage
+from hcaltools import skim
+from hcaltools.accumulators import EventListAccumulator
+from hcaltools.digicache import DigiCache
 logger = logging.getLogger(__name__)
 import time
 from pprint import pprint
 import sys
 
 class BX1Processor(processor.ProcessorABC):
+    # Branches read by process(); everything else is pruned when the events are opened (see hcaltools.columns)
+    columns = {
+        "run": None,
+        "luminosityBlock": None,
+        "event": None,
+        "bunchCrossing": None,
+        "HBDigis": ["valid", "ieta", "fc", "pedestalfc"],
+        "HEDigis": ["valid", "ieta", "fc", "pedestalfc"],
+    }
+
     def __init__(self):
         self._axis_ls = hist.axis.IntCategory([], name="ls", growth=True)
         self._axis_bx = hist.axis.IntCategory([], name="bx", growth=True)
@@ -63,8 +77,9 @@ class BX1Processor(processor.ProcessorABC):
                 self._axis_subdet,
                 hist.axis.Variable(10**np.linspace(0, 6, num=100, endpoint=True), name="avgq", label=r"Average $q_{ch}^{>60}$ [fC]"), 
                 hist.axis.Variable(nhits_bins, name="nhits", label="Number of hits >60fC")), 
-            "bad_events":  processor.list_accumulator([]), 
-            "full_events": processor.list_accumulator([]),
+            # Bounded event lists: the 100 events with the highest charge / most hits
+            "bad_events":  EventListAccumulator(cap=100, policy="top"), 
+            "full_events": EventListAccumulator(cap=100, policy="top"),
 
         }
 
@@ -80,44 +95,50 @@ class BX1Processor(processor.ProcessorABC):
         #print(events["HBDigis", "adc3"])
         np.set_printoptions(threshold=sys.maxsize)
 
-        for subdet in ["HB", "HE"]:
-            digis = events[f"{subdet}Digis"]
-            digis["adc"] = np.stack([ak.to_numpy(digis[f"adc{iTS}"]) for iTS in range(8)], axis=-1)
-            digis["fc"] = np.stack([ak.to_numpy(digis[f"fc{iTS}"]) for iTS in range(8)], axis=-1)
-            digis["pedestalfc"] = np.stack([ak.to_numpy(digis[f"pedestalfc{iTS}"]) for iTS in range(8)], axis=-1)
-            digis["realfc"] = digis.fc - digis.pedestalfc
-            digis["sumq"] = ak.sum(digis["realfc"], axis=-1)
+        with DigiCache(events) as derived:
+            for subdet in ["HB", "HE"]:
+                with stage("compute"):
+                    collection = f"{subdet}Digis"
+                    # adc, fc and pedestalfc are packed into (nhits x 8) arrays by HcalNanoAODSchema
+                    sumq = derived.sumq(collection, pedestal_subtracted=True)
+                    eventq = ak.sum(sumq[sumq > 60], axis=-1)
+                    # Counts all valid digis, not only those above 60 fC
+                    nhits = derived.counts(collection)
 
-            validdigis = digis[digis.valid]
-            eventq = ak.sum(validdigis["sumq"][validdigis["sumq"] > 60], axis=-1)
-            nhits = ak.num(validdigis["sumq"] > 60., axis=-1)
-            
-            # Broadcast event# and bx# to the same shape as the digi arrays
-            digi_event = events.event * ak.ones_like(validdigis.ieta)
-            digi_bx = events.bunchCrossing * ak.ones_like(validdigis.ieta)
-            digi_is_bx1 = (digi_bx==1)
-                        
-            # Event total charge vs nHits
-            output["eventq"].fill(
-                bx = events.bunchCrossing, 
-                subdet = subdet, 
-                eventq = eventq, 
-                nhits = nhits
-            )
+                with stage("fill"):
+                    # Event total charge vs nHits
+                    output["eventq"].fill(
+                        bx = events.bunchCrossing, 
+                        subdet = subdet, 
+                        eventq = eventq, 
+                        nhits = nhits
+                    )
 
-            # Avg channel change vs nHits
-            output["avgq"].fill(
-                bx = events.bunchCrossing, 
-                subdet = subdet, 
-                avgq = eventq / nhits, 
-                nhits = nhits
-            )
+                    # Avg channel change vs nHits
+                    output["avgq"].fill(
+                        bx = events.bunchCrossing, 
+                        subdet = subdet, 
+                        avgq = eventq / nhits, 
+                        nhits = nhits
+                    )
 
-            # Bad event lists
-            highq_events = events.event[(nhits > 400) & (eventq > 5.e4)]
-            full_events = events.event[(nhits > 9000)]
-            output["bad_events"].extend(highq_events[:100])
-            output["full_events"].extend(full_events[:100])
+                    # Bad event lists
+                    highq_mask = (nhits > 400) & (eventq > 5.e4)
+                    full_mask = (nhits > 9000)
+                    output["bad_events"].fill(
+                        run = events.run[highq_mask], 
+                        luminosityBlock = events.luminosityBlock[highq_mask], 
+                        event = events.event[highq_mask], 
+                        value = eventq[highq_mask]
+                    )
+                    output["full_events"].fill(
+                        run = events.run[full_mask], 
+                        luminosityBlock = events.luminosityBlock[full_mask], 
+                        event = events.event[full_mask], 
+                        value = nhits[full_mask]
+                    )
+                    # Keep the digis of these events, when skimming (see hcaltools.skim)
+                    skim.mark(highq_mask | full_mask)
         
         return processor.accumulate([{events.metadata["dataset"]: output}])
 
@@ -8,6 +8,11 @@ from coffea import processor
 from coffea import hist as chist
 from coffea import nanoevents
 import hist
+from hcaltools.profiling import stage
+from hcaltools import skim
+from hcaltools.channels import ChannelMap
+from hcaltools.accumulators import EventListAccumulator
+from hcaltools.digicache import DigiCache
 logger = logging.getLogger(__name__)
 import time
 from pprint import pprint
@@ -17,6 +22,16 @@ import sys
 #np.set_printoptions(threshold=sys.maxsize)
 
 class TestProcessor(processor.ProcessorABC):
+    # Branches read by process(); everything else is pruned when the events are opened (see hcaltools.columns)
+    columns = {
+        "run": None,
+        "luminosityBlock": None,
+        "event": None,
+        "bunchCrossing": None,
+        "HBDigis": ["valid", "ieta", "iphi", "depth", "fc", "pedestalfc"],
+        "HEDigis": ["valid", "ieta", "iphi", "depth", "fc", "pedestalfc"],
+    }
+
     def __init__(self):
         self._axis_subdet = hist.axis.StrCategory(["HB", "HE"], name="subdet", growth=True)
         self._axis_ieta = hist.axis.Regular(83, -41.5, 41.5, name="ieta", label=r"ieta")
@@ -42,12 +57,10 @@ class TestProcessor(processor.ProcessorABC):
                             label=r"Channel $\Sigma_{TS} q$ [fC]"
                 ),
             ),
-            'sumq_depthmap': hist.Hist(
-                self._axis_ieta,
-                self._axis_iphi,
-                self._axis_depth7,
-            ), 
-            "interesting_events": processor.list_accumulator([]),
+            # Channel map over the dense HCAL channel index; use .to_hist() for an (ieta, iphi, depth) hist
+            'sumq_depthmap': ChannelMap(label=r"$\Sigma_{TS} q$ [fC]"), 
+            # Bounded event list: the 1000 interesting events with the highest total charge
+            "interesting_events": EventListAccumulator(cap=1000, policy="top"),
 
         }
 
@@ -61,59 +74,52 @@ class TestProcessor(processor.ProcessorABC):
 
         # Container for storing total event charge (1D array; i.e., one number per event)
         eventq = ak.zeros_like(events.event, dtype=float)
-        digis = {}
-        validdigis = {}
-        for subdet in ["HB", "HE"]:
-            #print(f"Working on {subdet}")
-            digis[subdet] = events[f"{subdet}Digis"]
-
-            # In hcalnano, time slices are saved as individual branches (due to NanoAOD's limit on dimensionality of output)
-            # We can repack them into a single object as follows (however, it's a bit time consuming)
-            digis[subdet]["adc"] = np.stack([ak.to_numpy(digis[subdet][f"adc{iTS}"]) for iTS in range(8)], axis=-1)
-            digis[subdet]["fc"] = np.stack([ak.to_numpy(digis[subdet][f"fc{iTS}"]) for iTS in range(8)], axis=-1)
-            digis[subdet]["pedestalfc"] = np.stack([ak.to_numpy(digis[subdet][f"pedestalfc{iTS}"]) for iTS in range(8)], axis=-1)
-
-            # Compute some derived quantities
-            digis[subdet]["realfc"] = digis[subdet].fc - digis[subdet].pedestalfc
-            digis[subdet]["sumq"] = ak.sum(digis[subdet]["realfc"], axis=-1)
-
-            # Apply a mask on "valid digis". 
-            #    "valid" means that the digi was filled during the hcalnano step;
-            #    invalid digis are filled with default values, and should never be filled into histograms!
-            validdigis[subdet] = digis[subdet][digis[subdet].valid]
-
-            eventq = eventq + ak.sum(validdigis[subdet]["sumq"], axis=-1)
-
-            # Fill histograms
-            
-            # Techicality: variables for filling must be either 1D arrays (all same length) or scalar
-            #    Hence event quantities (e.g. event number, BX number) have to be 
-            #    broadcast to the same shape as the digi arrays, and multidimensional arrays have 
-            #    to be flattened (use ak.flatten() )
-            validdigis_shape = ak.ones_like(validdigis[subdet].ieta)
-            is_bx1_validdigishape = is_bx1 * validdigis_shape
-            
-            # Channel total charge (sumq)
-            #    Note that arrays must be 1D, so we call ak.flatten on the 2D digi arrays (recall, digis are stored as <evt num : detid>)
-            output["sumq"].fill(
-                subdet = subdet, 
-                sumq = ak.flatten(validdigis[subdet]["sumq"]), 
-                is_bx1 = ak.flatten(is_bx1_validdigishape), 
-            )
-
-            # sumq depth map
-            output["sumq_depthmap"].fill(
-                ieta   = ak.flatten(validdigis[subdet].ieta), 
-                iphi   = ak.flatten(validdigis[subdet].iphi), 
-                depth  = ak.flatten(validdigis[subdet].depth), 
-                weight = ak.flatten(validdigis[subdet]["sumq"])
-            )
+        # Derived digi quantities (valid digis, sumq, ...) are computed once and shared by the fills below,
+        # and freed at the end of the block (see hcaltools.digicache)
+        with DigiCache(events) as derived:
+            for subdet in ["HB", "HE"]:
+                #print(f"Working on {subdet}")
+                collection = f"{subdet}Digis"
+                with stage("compute"):
+                    # In hcalnano, time slices are saved as individual branches (due to NanoAOD's limit on dimensionality of output)
+                    # HcalNanoAODSchema repacks them into (nhits x 8) arrays (adc, fc, pedestalfc, ...), built lazily on first access
+
+                    # Derived quantities are only computed for "valid digis". 
+                    #    "valid" means that the digi was filled during the hcalnano step;
+                    #    invalid digis are filled with default values, and should never be filled into histograms!
+                    # sumq = sum over time slices of realfc = fc - pedestalfc
+                    eventq = eventq + ak.sum(derived.sumq(collection, pedestal_subtracted=True), axis=-1)
+
+                # Fill histograms
+                
+                # Techicality: variables for filling must be either 1D arrays (all same length) or scalar
+                #    Hence event quantities (e.g. event number, BX number) have to be 
+                #    broadcast to the same shape as the digi arrays, and multidimensional arrays have 
+                #    to be flattened (flat=True gives flattened numpy arrays)
+                with stage("fill"):
+                    # Channel total charge (sumq)
+                    #    Note that arrays must be 1D, so we use the flattened digi arrays (recall, digis are stored as <evt num : detid>)
+                    output["sumq"].fill(
+                        subdet = subdet, 
+                        sumq = derived.sumq(collection, pedestal_subtracted=True, flat=True), 
+                        is_bx1 = derived.event_field(collection, "bunchCrossing", flat=True) == 1, 
+                    )
+
+                    # sumq depth map
+                    output["sumq_depthmap"].fill(
+                        subdet = subdet, 
+                        ieta   = derived.field(collection, "ieta", flat=True), 
+                        iphi   = derived.field(collection, "iphi", flat=True), 
+                        depth  = derived.field(collection, "depth", flat=True), 
+                        weight = derived.sumq(collection, pedestal_subtracted=True, flat=True)
+                    )
 
         # Fill event total charge
-        output["eventq"].fill(
-            is_bx1 = is_bx1, 
-            eventq = eventq, 
-        )
+        with stage("fill"):
+            output["eventq"].fill(
+                is_bx1 = is_bx1, 
+                eventq = eventq, 
+            )
 
 
         # Record some interesting event numbers 
@@ -121,13 +127,21 @@ class TestProcessor(processor.ProcessorABC):
         # Interesting event == (>10 highq hits)
         #highq_nhits = ak.zeros_like(events.event, dtype=float)
         #for subdet in ["HB", "HE"]:
-        #    highq_nhits = highq_nhits + ak.sum(validdigis[subdet]["sumq"] > 2.e5, axis=-1)
+        #    highq_nhits = highq_nhits + ak.sum(derived.sumq(f"{subdet}Digis", pedestal_subtracted=True) > 2.e5, axis=-1)
         #interesting_events = events.event[(highq_nhits >= 10)]
 
         # OK, counting high energy hits turns out to be a hard way to define interesting events :) Instead, do eventq>20,000 fC
-        interesting_events = events.event[(eventq>2.e5)]
-        print(f"Interesting events: {len(interesting_events)} / {len(events)}")
-        output["interesting_events"].extend(interesting_events)
+        interesting_mask = (eventq>2.e5)
+        print(f"Interesting events: {ak.sum(interesting_mask)} / {len(events)}")
+        with stage("fill"):
+            output["interesting_events"].fill(
+                run = events.run[interesting_mask], 
+                luminosityBlock = events.luminosityBlock[interesting_mask], 
+                event = events.event[interesting_mask], 
+                value = eventq[interesting_mask]
+            )
+            # Keep the digis of these events, when skimming (see hcaltools.skim)
+            skim.mark(interesting_mask)
     
 
 
@@ -6,11 +6,21 @@ This script handles the instantiation of the processor and the handling of input
 import os
 import sys
 import time
+import signal
 import re
 import yaml
 import json
 from hcalanalysis.processors import *
 from hcalanalysis.schemas import HcalNanoAODSchema
+from hcaltools import runner
+from hcaltools.chunking import adaptive_chunksizes
+from hcaltools.eventselection import EventSelection
+from hcaltools.eventindex import EventIndexStore
+from hcaltools.inputcache import InputCache, LocalSource
+from hcaltools.nanoindex import load_fileset, normalize_filename
+from hcaltools import metadatacache
+from hcaltools import outputstore
+from hcaltools import skim
 from pprint import pprint
 from coffea import processor, util
 
@@ -27,14 +37,43 @@ if __name__ == "__main__":
     input_group.add_argument("-i", "--inputfiles", type=str, help="List of input files (comma-separated)")
     input_group.add_argument("-I", "--inputfilestxt", type=str, help="")
     input_group.add_argument("-y", "--inputfilesyaml", type=str, help="")
-    input_group.add_argument("-j", "--inputfilesjson", type=str, help="")
+    input_group.add_argument("-j", "--inputfilesjson", type=str, help="Dataset index json (see filelists/makeindex.py); with file metadata, no file is opened to plan the chunks")
     parser.add_argument("-o", "--outputfile", type=str, required=True, help="Output file")
     parser.add_argument("-f", "--force", action="store_true", help="Overwrite output file")
+    parser.add_argument("--output-format", type=str, default="coffea", choices=["coffea", "columnar"], help="coffea: one compressed pickle (util.save); columnar: a directory of memory-mappable arrays, read lazily with hcaltools.outputstore.open_store")
     parser.add_argument("-d", "--dataset", type=str, help="Dataset name (used as the key in the output accumulator dictionary)")
     parser.add_argument("-w", "--workers", type=int, default=4, help="Number of workers")
+    parser.add_argument("--executor", type=str, default="futures", choices=list(runner.executors), help="Executor backend")
+    parser.add_argument("--threads-per-worker", type=int, default=1, help="Threads per worker (dask executor)")
+    parser.add_argument("--memory-limit", type=str, default="auto", help="Memory limit per worker, e.g. 4GB (dask executor)")
+    parser.add_argument("--treereduction", type=int, default=8, help="Number of outputs merged at a time on the workers (dask executor)")
+    parser.add_argument("--max-worker-memory", type=float, default=None, help="RSS ceiling per worker in MB; workers above it are replaced, and a chunk which exceeds it is retried in two halves (recycling executor)")
+    parser.add_argument("--max-chunks-per-worker", type=int, default=None, help="Replace workers after this many chunks (recycling executor)")
+    parser.add_argument("--profile", action="store_true", help="Profile the stages of each chunk (read, schema, process, and the processor's own stages), and print a table per dataset")
+    parser.add_argument("--profile-trace", type=str, default=None, help="With --profile, append a json line per chunk to this file")
+    parser.add_argument("--input-cache", type=str, default=None, help="Stage remote input files to this local directory, and read them from there")
+    parser.add_argument("--input-cache-size", type=float, default=50, help="Input cache size limit in GB; least recently used files are evicted")
+    parser.add_argument("--input-cache-checksum", action="store_true", help="Verify the adler32 checksum of files staged to the input cache")
+    parser.add_argument("--input-cache-source", type=str, default=None, help="Local directory standing in for EOS (root://host//store/x -> DIR/store/x), for testing the input cache")
+    parser.add_argument("--prefetch", type=int, default=2, help="With --input-cache, number of upcoming files staged in the background")
+    parser.add_argument("--read-ahead", type=int, default=0, help="Read up to this many chunks ahead in a background thread of each worker, while the current chunk is processed")
+    parser.add_argument("--read-ahead-group", type=int, default=4, help="With --read-ahead, number of consecutive chunks of a file handed to a worker at once")
+    parser.add_argument("--read-ahead-lazy", action="store_true", help="With --read-ahead, only open the chunks ahead, and read their branches when first accessed instead of all the declared branches")
+    parser.add_argument("--metadata-cache", type=str, default=metadatacache.DEFAULT_PATH, help="Persistent cache of the entry counts of input files (empty string: don't use a cache)")
+    parser.add_argument("--refresh-metadata", action="store_true", help="Reopen all input files to get their entry counts, ignoring the index metadata and the metadata cache")
+    parser.add_argument("--no-validate-metadata", action="store_true", help="Trust the metadata cache without checking the size/mtime of the files")
+    parser.add_argument("--metadata-max-age", type=float, default=metadatacache.DEFAULT_MAX_AGE / 3600, help="Trust metadata cache entries of remote files checked less than this many hours ago, without a new xrdfs stat (0: check on every run)")
+    parser.add_argument("--skim-dir", type=str, default=None, help="Write the events marked by the processor (hcaltools.skim.mark) to parquet files here, and their index to SKIM_DIR/nanoindex_skim.json (for -j)")
+    parser.add_argument("--skim-collections", type=str, default=None, help="Comma-separated collections/branches written to the skim (default: the processor's skim_collections, or its declared columns)")
     parser.add_argument("-c", "--condor", action="store_true", help="Flag for running on condor (alters paths/logging/behaviors where necessary)")
-    parser.add_argument("--chunksize", type=int, default=250, help="Chunk size")
+    parser.add_argument("--chunksize", type=int, default=250, help="Chunk size (with --memory-budget, size of the probe chunks)")
+    parser.add_argument("--memory-budget", type=float, default=None, help="Adaptive chunking: size the chunks of each dataset so that processing one takes about this much memory (MB), measured on its first chunk")
     parser.add_argument("--maxchunks", type=int, default=None, help="Max chunks")
+    parser.add_argument("--eventlist", type=str, default=None, help="Only process the events in this list (json, {dataset: [event numbers]})")
+    parser.add_argument("--entryranges", type=str, default=None, help="Only process these entry ranges, {file: [[entrystart, entrystop], ...]}, as a json string or file (files not listed are processed in full; see crun_processor.py)")
+    parser.add_argument("--checkpoint-dir", type=str, default=None, help="Periodically save the merged output and completed chunks here, and resume from it if present")
+    parser.add_argument("--checkpoint-interval", type=float, default=600, help="Seconds between checkpoints")
+    parser.add_argument("--eventindex", type=str, default="eventindex", help="Directory of event number -> entry index sidecars, used with --eventlist (see filelists/makeeventindex.py). Missing indices are built on the fly.")
     args = parser.parse_args()
 
     processor_class = getattr(globals()[args.processor_name.split(".")[0]], args.processor_name.split(".")[1])
@@ -44,6 +83,7 @@ if __name__ == "__main__":
 
     # Input file handling
     fileset = {}
+    file_metadata = {}
     if args.inputfilesyaml:
         if args.dataset:
             raise RuntimeError("ERROR : Cannot specify --dataset/-d with --inputfilesyaml/-y, because the dataset naming comes from the .yaml file.")
@@ -55,8 +95,7 @@ if __name__ == "__main__":
     elif args.inputfilesjson:
         if args.dataset:
             raise RuntimeError("ERROR : Cannot specify --dataset/-d with --inputfilesjson/-j, because the dataset naming comes from the .json file.")
-        with open(args.inputfilesjson) as f:
-            fileset = json.load(f)
+        fileset, file_metadata = load_fileset(args.inputfilesjson)
     else:
         input_files = []
         if args.inputfiles:
@@ -67,16 +106,15 @@ if __name__ == "__main__":
                     input_files.append(line.strip())
         fileset[args.dataset] = input_files
 
-    # Normalize file names
+    # Normalize file names (entry counts from the index are looked up by the normalized name)
+    nentries = {}
     for k, v in fileset.items():
         new_list = []
         for input_file in v:
-            new_input_file = input_file
-            if new_input_file.startswith("/eos/cms/store"):
-                new_input_file = re.sub(r"^/eos/cms/store", r"root://eoscms.cern.ch//store", new_input_file)
-            elif new_input_file.startswith("/store"):
-                new_input_file = re.sub(r"^/store", r"root://eoscms.cern.ch//store", new_input_file)
+            new_input_file = normalize_filename(input_file)
             new_list.append(new_input_file)
+            if input_file in file_metadata:
+                nentries[new_input_file] = file_metadata[input_file]["nentries"]
         fileset[k] = new_list
 
     # For quicktest, limit number of input files and events per job
@@ -87,31 +125,134 @@ if __name__ == "__main__":
     else:
         maxchunks = args.maxchunks
 
+    # Entry counts of the files without index metadata, from the persistent metadata cache (see hcaltools.metadatacache)
+    if args.refresh_metadata:
+        nentries = {}
+    if args.metadata_cache:
+        missing = [x for filelist in fileset.values() for x in filelist if x not in nentries]
+        if missing:
+            nentries.update(metadatacache.MetadataCache(args.metadata_cache).nentries(missing, treename="Events", refresh=args.refresh_metadata,
+                                                                                          validate=not args.no_validate_metadata, max_age=args.metadata_max_age * 3600))
+
     print("Input fileset:")
     pprint(fileset)
 
     # Check output file status
-    if os.path.isfile(args.outputfile) and not args.force:
+    if os.path.exists(args.outputfile) and not args.force:
         raise RuntimeError("Output file {args.outputfile} already exists. Specify -f/--force to overwrite.")
 
     # Run processor
+    # Turn SIGTERM (e.g. condor eviction) into a normal exit, so the last checkpoint gets written
+    if args.checkpoint_dir:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
     ts_start = time.time()
-    output = processor.run_uproot_job(fileset,
-                                treename='Events',
-                                processor_instance=processor_class(),
-                                executor=processor.futures_executor,
-                                #executor=processor.iterative_executor,
-                                executor_args={'workers': args.workers, 'status': True, 'schema': HcalNanoAODSchema},
-                                chunksize=args.chunksize,
-                                maxchunks=maxchunks,
-                            )
+    # With an event list, only read the entry ranges containing the listed events
+    entry_ranges = None
+    if args.eventlist and args.entryranges:
+        raise RuntimeError("ERROR : Cannot specify both --eventlist and --entryranges.")
+    if args.entryranges:
+        if os.path.isfile(args.entryranges):
+            with open(args.entryranges, "r") as f:
+                entry_ranges = json.load(f)
+        else:
+            entry_ranges = json.loads(args.entryranges)
+        entry_ranges = {normalize_filename(k): [tuple(x) for x in v] for k, v in entry_ranges.items()}
+    if args.eventlist:
+        index_store = EventIndexStore(args.eventindex)
+        entry_ranges = index_store.entry_ranges(fileset, EventSelection.from_file(args.eventlist), treename="Events")
+        index_store.save_summary()
+        print(f"Event list {args.eventlist}: {sum(len(x) for x in entry_ranges.values())} entry ranges in {sum(1 for x in entry_ranges.values() if x)} files")
+
+    processor_instance = processor_class()
+
+    # Adaptive chunking: chunk size per dataset from a probe of its first chunk (see hcaltools.chunking).
+    # With a checkpoint, the sizes are saved with it, so that a resumed job plans the same chunks.
+    chunksize = args.chunksize
+    chunking = None
+    if args.memory_budget:
+        chunking_path = os.path.join(args.checkpoint_dir, "chunking.json") if args.checkpoint_dir else None
+        if chunking_path and os.path.isfile(chunking_path):
+            with open(chunking_path, "r") as f:
+                chunking = json.load(f)
+        else:
+            probe_chunks = {}
+            for chunk in runner.plan_chunks(fileset, treename="Events", chunksize=args.chunksize, maxchunks=1, entry_ranges=entry_ranges, nentries=nentries):
+                probe_chunks.setdefault(chunk.dataset, chunk)
+            chunking = adaptive_chunksizes(probe_chunks, processor_instance, HcalNanoAODSchema, memory_budget=args.memory_budget * 1e6)
+            if chunking_path:
+                os.makedirs(args.checkpoint_dir, exist_ok=True)
+                with open(chunking_path, "w") as f:
+                    json.dump(chunking, f, indent=2)
+        chunksize = {dataset: chunking.get(dataset, {}).get("chunksize", args.chunksize) for dataset in fileset}
+
+    # Branches are pruned to the processor's declared columns (see hcaltools.columns)
+    chunks = runner.plan_chunks(fileset, treename="Events", chunksize=chunksize, maxchunks=maxchunks, entry_ranges=entry_ranges, nentries=nentries)
+    input_cache = None
+    if args.input_cache:
+        source = LocalSource(args.input_cache_source) if args.input_cache_source else None
+        input_cache = InputCache(args.input_cache, max_bytes=args.input_cache_size * 1e9, source=source, checksum=args.input_cache_checksum)
+
+    executor_options = {}
+    if args.executor == "dask":
+        executor_options = {
+            "threads_per_worker": args.threads_per_worker,
+            "memory_limit": args.memory_limit,
+            "treereduction": args.treereduction,
+        }
+    elif args.executor == "recycling":
+        executor_options = {
+            "max_rss": args.max_worker_memory * 1e6 if args.max_worker_memory else None,
+            "max_chunks": args.max_chunks_per_worker,
+        }
+    output = runner.run(chunks,
+                        processor_instance=processor_instance,
+                        schemaclass=HcalNanoAODSchema,
+                        workers=args.workers,
+                        executor=args.executor,
+                        executor_options=executor_options,
+                        status=True,
+                        checkpoint_dir=args.checkpoint_dir,
+                        checkpoint_interval=args.checkpoint_interval,
+                        profile=args.profile,
+                        trace_path=args.profile_trace,
+                        input_cache=input_cache,
+                        prefetch=args.prefetch,
+                        read_ahead=args.read_ahead,
+                        read_ahead_group=args.read_ahead_group,
+                        read_ahead_lazy=args.read_ahead_lazy,
+                        skim_dir=args.skim_dir,
+                        skim_collections=args.skim_collections.split(",") if args.skim_collections else None,
+                    )
     ts_end = time.time()
     total_time = ts_end - ts_start
 
+    # Record the adaptive chunking decisions with the output
+    if chunking:
+        for dataset, info in chunking.items():
+            output.setdefault(dataset, {})["_chunking"] = info
+
     pprint(output)
 
+    for dataset, outputdict in output.items():
+        if "_readahead" in outputdict:
+            print(f"Read-ahead of {dataset}: {outputdict['_readahead'].summary()}")
+
+    if args.profile:
+        for dataset, outputdict in output.items():
+            if "_profile" in outputdict:
+                print(f"\nProfile of {dataset}:")
+                print(outputdict["_profile"].table())
+
+    if args.skim_dir:
+        skim_index = skim.write_index(output, args.skim_dir)
+        nskimmed = sum(sum(outputdict.get("_skim", {}).values()) for outputdict in output.values() if isinstance(outputdict, dict))
+        print(f"Skimmed {nskimmed} events into {args.skim_dir} (index: {skim_index})")
+
     # Save output
-    util.save(output, args.outputfile)
+    if args.output_format == "columnar":
+        outputstore.save(output, args.outputfile)
+    else:
+        util.save(output, args.outputfile)
 
 
     # Print some bookkeeping
@@ -1,6 +1,7 @@
 import warnings
 from coffea.nanoevents import transforms
 from coffea.nanoevents.schemas.base import BaseSchema, zip_forms
+from .timesamples import timesamples_form
 
 
 class HcalNanoAODSchema(BaseSchema):
@@ -13,6 +14,8 @@ class HcalNanoAODSchema(BaseSchema):
     - Any local index branches with names matching ``{source}_{target}Idx*`` are converted to global indexes for the event chunk (postfix ``G``)
     - Any `nested_items` are constructed, if the necessary branches are available
     - Any `special_items` are constructed, if the necessary branches are available
+    - Any per-time-sample branches ``{name}_{field}{iTS}`` of the `timesample_items` collections are packed
+      into a virtual fixed-length ``{name}_{field}`` array of shape (nhits x nTS), for each of the `timesample_fields`
 
     From those arrays, NanoAOD collections are formed as collections of branches grouped by name, where:
 
@@ -59,6 +62,17 @@ class HcalNanoAODSchema(BaseSchema):
     special_items = {
     }
     """Special arrays, where the callable and input arrays are specified in the value"""
+    timesample_items = {
+        "DigiHB": 8,
+        "DigiHE": 8,
+        "DigiHF": 3,
+        "HBDigis": 8,
+        "HEDigis": 8,
+        "HFDigis": 3,
+    }
+    """Digi collections with one branch per time sample, and the number of time samples (nTS) to pack"""
+    timesample_fields = ["adc", "fc", "pedestalfc", "tdc", "capid"]
+    """Per-time-sample fields to pack, e.g. ``fc`` packs ``fc0``, ..., ``fc{nTS-1}``"""
 
     def __init__(self, base_form, version="latest"):
         super().__init__(base_form)
@@ -147,6 +161,17 @@ class HcalNanoAODSchema(BaseSchema):
             if all(k in branch_forms for k in args):
                 branch_forms[name] = fcn(*(branch_forms[k] for k in args))
 
+        # Pack per-time-sample branches into (nhits x nTS) arrays
+        for name, nTS in self.timesample_items.items():
+            for field in self.timesample_fields:
+                ts_branches = [f"{name}_{field}{iTS}" for iTS in range(nTS)]
+                if f"{name}_{field}" in branch_forms:
+                    continue
+                if all(k in branch_forms for k in ts_branches):
+                    branch_forms[f"{name}_{field}"] = timesamples_form(
+                        [branch_forms[k] for k in ts_branches]
+                    )
+
         output = {}
         for name in collections:
             mixin = self.mixins.get(name, "NanoCollection")
@@ -0,0 +1,47 @@
+'''
+Packing of per-time-sample digi branches into fixed-length arrays.
+
+hcalnano stores every time sample in its own branch (e.g. DigiHB_fc0, ..., DigiHB_fc7), because NanoAOD
+can only store one dimension per branch. The transform defined here interleaves the nTS flat branch
+contents into a single (nhits x nTS) buffer, in one pass, the first time the packed field is accessed.
+'''
+import copy
+import numpy
+from coffea.nanoevents import transforms
+from coffea.nanoevents.util import concat
+
+
+def timesamples_form(ts_forms):
+    """Form of a (nhits x nTS) array built from the jagged forms of the individual time sample branches
+
+    The offsets are taken from the first time sample; the collection offsets replace them anyway
+    when the field is zipped into its collection.
+    """
+    if not all(form["class"].startswith("ListOffsetArray") for form in ts_forms):
+        raise RuntimeError("Time sample branches must be jagged (one entry per digi)")
+    form = copy.deepcopy(ts_forms[0])
+    content = form["content"]
+    content["form_key"] = concat(
+        *[ts_form["content"]["form_key"] for ts_form in ts_forms],
+        "!timesamples",
+    )
+    form["content"] = {
+        "class": "RegularArray",
+        "size": len(ts_forms),
+        "content": content,
+    }
+    return form
+
+
+def timesamples(stack):
+    """Interleave the flat contents of nTS time sample branches into one C-ordered buffer"""
+    samples = [numpy.asarray(sample) for sample in stack]
+    stack.clear()
+    out = numpy.empty((len(samples[0]), len(samples)), dtype=numpy.result_type(*samples))
+    for iTS, sample in enumerate(samples):
+        out[:, iTS] = sample
+    stack.append(out.reshape(-1))
+
+
+# NanoEvents resolves "!name" form key nodes by looking them up in coffea.nanoevents.transforms
+transforms.timesamples = timesamples
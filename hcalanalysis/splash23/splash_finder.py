@@ -15,6 +15,10 @@ from coffea import processor, util
 from coffea import hist as chist
 from coffea import nanoevents
 import hist
+from hcalanalysis.schemas import HcalNanoAODSchema
+from hcaltools import runner
+from hcaltools.nanoindex import load_fileset, normalize_filename
+from hcaltools.accumulators import TopKAccumulator
 
 # Workaround for https://github.com/scikit-hep/uproot4/issues/122
 import uproot
@@ -26,7 +30,15 @@ logger = logging.getLogger(__name__)
 #np.set_printoptions(threshold=sys.maxsize)
 
 class SplashProcessor(processor.ProcessorABC):
-    def __init__(self, ):
+    # Branches read by process(); everything else is pruned when the events are opened (see hcaltools.columns)
+    columns = {
+        "event": None,
+        "DigiHB": ["valid", "fc"],
+        "DigiHE": ["valid", "fc"],
+        "DigiHF": ["valid", "fc"],
+    }
+
+    def __init__(self, topk=20, summary_hist=True):
         # List of (run, event_number) of splash events, once known
         # You can you the find_events histogram to find the splashes
         self._splash_event_list = [("r365373_Splashes_FEVT", 216), 
@@ -47,12 +59,17 @@ class SplashProcessor(processor.ProcessorABC):
                             )
 
 
+        # Top-k events by total charge (bounded, per run key), and optionally the full event charge distribution in fixed bins
         self.make_output = lambda: {
             'nevents': 0,
-            'event_sumq': hist.Hist(
-                hist.axis.IntCategory([], name='event_number', label=r"Event Number", growth=True), 
-            ), 
-            'event_sumq_dict': processor.accumulator.dict_accumulator(), 
+            'event_sumq_top': TopKAccumulator(topk), 
+            **({'event_sumq': hist.Hist(
+                hist.axis.Variable(
+                    10**np.linspace(0, 9, num=901, endpoint=True), 
+                    name="event_sumq", 
+                    label=r"Event $\Sigma q$ [fC]"
+                ), 
+            )} if summary_hist else {}), 
             "splash_depthmap": hist.Hist(
                 hist.axis.IntCategory([], name='event_number', label=r"Event Number", growth=True), 
                 self._axis_ieta, 
@@ -82,11 +99,9 @@ class SplashProcessor(processor.ProcessorABC):
             digis[subdet]["sumq"] = sum([digis[subdet][f"fc{iTS}"] for iTS in range(nTS[subdet])])
             event_sumq = event_sumq + ak.to_numpy(ak.sum(digis[subdet]["sumq"], axis=-1))
 
-        output["event_sumq"].fill(
-            event_number = events["event"], 
-            weight = event_sumq
-        )
-        output["event_sumq_dict"] = dict(zip(events["event"], event_sumq))
+        output["event_sumq_top"].fill(ak.to_numpy(events["event"]), event_sumq)
+        if "event_sumq" in output:
+            output["event_sumq"].fill(event_sumq = event_sumq)
 
         return processor.accumulate([{events.metadata["dataset"]: output}])
 
@@ -163,6 +178,8 @@ if __name__ == "__main__":
     parser.add_argument("-c", "--condor", action="store_true", help="Flag for running on condor (alters paths/logging/behaviors where necessary)")
     parser.add_argument("--chunksize", type=int, default=250, help="Chunk size")
     parser.add_argument("--maxchunks", type=int, default=None, help="Max chunks")
+    parser.add_argument("--topk", type=int, default=20, help="Number of highest-charge events to keep per run")
+    parser.add_argument("--no-summary", action="store_true", help="Don't fill the event charge distribution histogram")
     args = parser.parse_args()
 
     processor_class = SplashProcessor
@@ -172,6 +189,7 @@ if __name__ == "__main__":
 
     # Input file handling
     fileset = {}
+    file_metadata = {}
     if args.inputfilesyaml:
         if args.dataset:
             raise RuntimeError("ERROR : Cannot specify --dataset/-d with --inputfilesyaml/-y, because the dataset naming comes from the .yaml file.")
@@ -183,8 +201,7 @@ if __name__ == "__main__":
     elif args.inputfilesjson:
         if args.dataset:
             raise RuntimeError("ERROR : Cannot specify --dataset/-d with --inputfilesjson/-j, because the dataset naming comes from the .json file.")
-        with open(args.inputfilesjson) as f:
-            fileset = json.load(f)
+        fileset, file_metadata = load_fileset(args.inputfilesjson)
     else:
         input_files = []
         if args.inputfiles:
@@ -195,16 +212,15 @@ if __name__ == "__main__":
                     input_files.append(line.strip())
         fileset[args.dataset] = input_files
 
-    # Normalize file names
+    # Normalize file names (entry counts from the index are looked up by the normalized name)
+    nentries = {}
     for k, v in fileset.items():
         new_list = []
         for input_file in v:
-            new_input_file = input_file
-            if new_input_file.startswith("/eos/cms/store"):
-                new_input_file = re.sub(r"^/eos/cms/store", r"root://eoscms.cern.ch//store", new_input_file)
-            elif new_input_file.startswith("/store"):
-                new_input_file = re.sub(r"^/store", r"root://eoscms.cern.ch//store", new_input_file)
+            new_input_file = normalize_filename(input_file)
             new_list.append(new_input_file)
+            if input_file in file_metadata:
+                nentries[new_input_file] = file_metadata[input_file]["nentries"]
         fileset[k] = new_list
 
     # For quicktest, limit number of input files and events per job
@@ -224,15 +240,14 @@ if __name__ == "__main__":
 
     # Run processor
     ts_start = time.time()
-    output = processor.run_uproot_job(fileset,
-                                treename='Events',
-                                processor_instance=processor_class(),
-                                executor=processor.futures_executor,
-                                #executor=processor.iterative_executor,
-                                executor_args={'workers': args.workers, 'status': True, 'schema': processor.HcalNanoAODSchema},
-                                chunksize=args.chunksize,
-                                maxchunks=maxchunks,
-                            )
+    # Branches are pruned to the processor's declared columns (see hcaltools.columns)
+    chunks = runner.plan_chunks(fileset, treename="Events", chunksize=args.chunksize, maxchunks=maxchunks, nentries=nentries)
+    output = runner.run(chunks,
+                        processor_instance=processor_class(topk=args.topk, summary_hist=not args.no_summary),
+                        schemaclass=HcalNanoAODSchema,
+                        workers=args.workers,
+                        status=True,
+                    )
     ts_end = time.time()
     total_time = ts_end - ts_start
 
@@ -271,7 +286,4 @@ if __name__ == "__main__":
 
     for run_key in output.keys():
         print(run_key)
-        sumq_list = list(output[run_key]["event_sumq_dict"].items())
-        sumq_list = sorted(sumq_list, key=lambda x: x[1], reverse=True)
-        print(len(sumq_list))
-        pprint(sumq_list[:20])
\ No newline at end of file
+        pprint(output[run_key]["event_sumq_top"].items())
\ No newline at end of file
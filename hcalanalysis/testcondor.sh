@@ -1,2 +1,2 @@
 #!/bin/bash
-python crun_processor.py bx1processor.BX1Processor -y filelists/files_r352567.yaml -o hists_bx1.coffea -w 4 --retar_venv
\ No newline at end of file
+python crun_processor.py bx1processor.BX1Processor -y filelists/files_r352567.yaml -o hists_bx1.coffea -w 4
\ No newline at end of file
@@ -0,0 +1,133 @@
+'''
+Bounded, numpy-backed accumulators for per-event bookkeeping.
+
+Storing something for every event (dicts or lists keyed by event number) makes the output grow linearly
+with the dataset, and every worker has to pickle its share back. The accumulators here keep a fixed number
+of entries in contiguous arrays, so memory and merge cost stay flat however many files are processed.
+'''
+import numpy as np
+from coffea import processor
+
+
+class TopKAccumulator(processor.AccumulatorABC):
+    """The k events with the largest values, as sorted (event, value) arrays
+
+    Ties are broken by event number, so the result doesn't depend on the order of fills and merges.
+    """
+
+    def __init__(self, k=100):
+        self.k = k
+        self.events = np.zeros(0, dtype=np.uint64)
+        self.values = np.zeros(0, dtype=np.float64)
+
+    def identity(self):
+        return TopKAccumulator(self.k)
+
+    def fill(self, events, values):
+        self._merge(np.asarray(events).astype(np.uint64), np.asarray(values, dtype=np.float64))
+
+    def _merge(self, events, values):
+        events = np.concatenate([self.events, events])
+        values = np.concatenate([self.values, values])
+        order = np.lexsort((events, -values))[:self.k]
+        self.events = events[order]
+        self.values = values[order]
+
+    def add(self, other):
+        self._merge(other.events, other.values)
+
+    def items(self):
+        """[(event, value), ...], largest value first"""
+        return list(zip(self.events.tolist(), self.values.tolist()))
+
+    def __len__(self):
+        return len(self.events)
+
+    def __repr__(self):
+        return f"TopKAccumulator(k={self.k}, entries={len(self)})"
+
+
+def _splitmix64(x):
+    """splitmix64 finalizer: a cheap, well-mixed hash of uint64 arrays"""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class EventListAccumulator(processor.AccumulatorABC):
+    """(run, luminosityBlock, event, value) of at most `cap` events, in contiguous typed arrays
+
+    Which events are kept is decided by `policy`:
+      - "first": the lowest (run, luminosityBlock, event)
+      - "top": the largest values
+      - "reservoir": a uniform random sample, using a hash of (run, luminosityBlock, event) as the random priority
+    All three are deterministic, so the result doesn't depend on how chunks were split or merged.
+    An event filled more than once is kept once, with the entry preferred by the policy.
+    """
+
+    policies = ("first", "top", "reservoir")
+
+    def __init__(self, cap=100, policy="first"):
+        if policy not in self.policies:
+            raise ValueError(f"Unknown policy {policy}, should be one of {self.policies}")
+        self.cap = cap
+        self.policy = policy
+        self.run = np.zeros(0, dtype=np.uint32)
+        self.luminosityBlock = np.zeros(0, dtype=np.uint32)
+        self.event = np.zeros(0, dtype=np.uint64)
+        self.value = np.zeros(0, dtype=np.float64)
+
+    def identity(self):
+        return EventListAccumulator(self.cap, self.policy)
+
+    def fill(self, run, luminosityBlock, event, value=0.):
+        event = np.asarray(event).astype(np.uint64)
+        n = len(event)
+        self._merge(
+            np.broadcast_to(np.asarray(run).astype(np.uint32), (n,)),
+            np.broadcast_to(np.asarray(luminosityBlock).astype(np.uint32), (n,)),
+            event,
+            np.broadcast_to(np.asarray(value, dtype=np.float64), (n,)),
+        )
+
+    def _order(self, run, luminosityBlock, event, value):
+        if self.policy == "first":
+            return np.lexsort((event, luminosityBlock, run))
+        elif self.policy == "top":
+            return np.lexsort((event, luminosityBlock, run, -value))
+        else:
+            ids = (run.astype(np.uint64) << np.uint64(32)) | luminosityBlock.astype(np.uint64)
+            priority = _splitmix64(_splitmix64(event) ^ ids)
+            return np.lexsort((event, luminosityBlock, run, priority))
+
+    def _merge(self, run, luminosityBlock, event, value):
+        run = np.concatenate([self.run, run])
+        luminosityBlock = np.concatenate([self.luminosityBlock, luminosityBlock])
+        event = np.concatenate([self.event, event])
+        value = np.concatenate([self.value, value])
+        order = self._order(run, luminosityBlock, event, value)
+
+        # Drop repeated events, keeping the first (= preferred) occurrence
+        ids = np.empty(len(order), dtype=[("run", np.uint32), ("luminosityBlock", np.uint32), ("event", np.uint64)])
+        ids["run"], ids["luminosityBlock"], ids["event"] = run[order], luminosityBlock[order], event[order]
+        _, first = np.unique(ids, return_index=True)
+        order = order[np.sort(first)][:self.cap]
+
+        self.run = run[order]
+        self.luminosityBlock = luminosityBlock[order]
+        self.event = event[order]
+        self.value = value[order]
+
+    def add(self, other):
+        self._merge(other.run, other.luminosityBlock, other.event, other.value)
+
+    def items(self):
+        """[(run, luminosityBlock, event, value), ...], in policy order"""
+        return list(zip(self.run.tolist(), self.luminosityBlock.tolist(), self.event.tolist(), self.value.tolist()))
+
+    def __len__(self):
+        return len(self.event)
+
+    def __repr__(self):
+        return f"EventListAccumulator(cap={self.cap}, policy={self.policy!r}, entries={len(self)})"
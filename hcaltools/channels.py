@@ -0,0 +1,186 @@
+'''
+Dense index of HCAL channels, and channel-map accumulators filled over it.
+
+The (ieta x iphi x depth) = 83 x 72 x 7 hists used for depth maps are mostly empty: HB only covers
+|ieta| <= 16, HF only has every 2nd (or 4th) iphi, and most towers have far fewer than 7 depths.
+ChannelIndex enumerates the channels that can actually be read out, and maps
+(subdet, ieta, iphi, depth) to a dense linear index, so channel maps can be stored as flat arrays
+and filled with a single np.bincount. With float64 sums and int32 entries, a map takes 12 bytes per
+channel and key, about 270 kB for the ~22k channels: less than the ~450 kB of the dense hist with flow
+bins, but of the same order, so per-event maps still grow linearly with the number of events.
+
+The table is a (slightly generous) superset of the Run 3 readout:
+  - HB: 1 <= |ieta| <= 16, iphi 1-72, depth 1-4
+  - HE: 16 <= |ieta| <= 29, depth 1-7, iphi 1-72 for |ieta| <= 20, odd iphi above
+  - HF: 29 <= |ieta| <= 41, depth 1-4, odd iphi for |ieta| <= 39, iphi 3, 7, ..., 71 above
+Digis outside the table are counted in ChannelMap.unmapped, rather than silently dropped.
+'''
+import numpy as np
+import hist
+from coffea import processor
+
+SUBDETS = ("HB", "HE", "HF")
+
+
+def _subdet_channels(subdet):
+    """(ieta, iphi, depth) of all channels of one subdetector"""
+    channels = []
+    if subdet == "HB":
+        towers = [(absieta, range(1, 73), range(1, 5)) for absieta in range(1, 17)]
+    elif subdet == "HE":
+        towers = [(absieta, range(1, 73) if absieta <= 20 else range(1, 73, 2), range(1, 8)) for absieta in range(16, 30)]
+    elif subdet == "HF":
+        towers = [(absieta, range(1, 73, 2) if absieta <= 39 else range(3, 73, 4), range(1, 5)) for absieta in range(29, 42)]
+    else:
+        raise ValueError(f"Unknown subdetector {subdet}")
+    for absieta, iphis, depths in towers:
+        for ieta in (-absieta, absieta):
+            for iphi in iphis:
+                for depth in depths:
+                    channels.append((ieta, iphi, depth))
+    return channels
+
+
+class ChannelIndex:
+    """Dense linear index over the valid HB/HE/HF channels
+
+    The attributes subdet, ieta, iphi and depth hold the coordinates of each channel, in index order.
+    """
+
+    def __init__(self):
+        subdet, ieta, iphi, depth = [], [], [], []
+        for isubdet, name in enumerate(SUBDETS):
+            for channel in _subdet_channels(name):
+                subdet.append(isubdet)
+                ieta.append(channel[0])
+                iphi.append(channel[1])
+                depth.append(channel[2])
+        self.subdet = np.array(subdet, dtype=np.int8)
+        self.ieta = np.array(ieta, dtype=np.int8)
+        self.iphi = np.array(iphi, dtype=np.int8)
+        self.depth = np.array(depth, dtype=np.int8)
+
+        # Lookup table [subdet, ieta + 41, iphi, depth] -> index (-1 if not a valid channel)
+        self._lookup = np.full((len(SUBDETS), 83, 73, 8), -1, dtype=np.int32)
+        self._lookup[self.subdet, self.ieta + 41, self.iphi, self.depth] = np.arange(len(self), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.subdet)
+
+    def index(self, subdet, ieta, iphi, depth):
+        """Dense index of each (ieta, iphi, depth) of subdetector `subdet` ("HB", "HE" or "HF"); -1 if invalid"""
+        isubdet = SUBDETS.index(subdet)
+        ieta = np.asarray(ieta, dtype=np.int64)
+        iphi = np.asarray(iphi, dtype=np.int64)
+        depth = np.asarray(depth, dtype=np.int64)
+        inrange = (np.abs(ieta) <= 41) & (iphi >= 0) & (iphi <= 72) & (depth >= 0) & (depth <= 7)
+        out = np.full(len(ieta), -1, dtype=np.int64)
+        out[inrange] = self._lookup[isubdet, ieta[inrange] + 41, iphi[inrange], depth[inrange]]
+        return out
+
+
+channel_index = ChannelIndex()
+
+
+class ChannelMap(processor.AccumulatorABC):
+    """Per-channel sums of weights (and entries) over the dense channel index, split by an integer key
+
+    The key is e.g. the event number, for per-event maps; maps filled without a key use key 0.
+    Filling is one np.bincount over (key, channel), and merging adds the flat arrays key by key.
+    """
+
+    def __init__(self, label=""):
+        self.label = label
+        self.unmapped = 0
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._sumw = np.zeros((0, len(channel_index)), dtype=np.float64)
+        self._entries = np.zeros((0, len(channel_index)), dtype=np.int32)
+
+    def identity(self):
+        return ChannelMap(label=self.label)
+
+    @property
+    def keys(self):
+        return self._keys
+
+    def fill(self, subdet, ieta, iphi, depth, weight=None, key=None):
+        idx = channel_index.index(subdet, ieta, iphi, depth)
+        mapped = idx >= 0
+        self.unmapped += int(len(idx) - np.count_nonzero(mapped))
+        idx = idx[mapped]
+        if weight is not None:
+            weight = np.asarray(weight, dtype=np.float64)[mapped]
+        if key is None:
+            key = np.zeros(len(idx), dtype=np.int64)
+        else:
+            key = np.asarray(key, dtype=np.int64)[mapped]
+
+        nchannels = len(channel_index)
+        keys, inverse = np.unique(key, return_inverse=True)
+        flat = inverse * nchannels + idx
+        size = len(keys) * nchannels
+        sumw = np.bincount(flat, weights=weight, minlength=size).reshape(len(keys), nchannels)
+        entries = np.bincount(flat, minlength=size).astype(np.int32).reshape(len(keys), nchannels)
+        self._add(keys, sumw, entries)
+
+    def _add(self, keys, sumw, entries):
+        if len(keys) == 0:
+            return
+        if np.array_equal(keys, self._keys):
+            self._sumw += sumw
+            self._entries += entries
+            return
+        allkeys = np.union1d(self._keys, keys)
+        new_sumw = np.zeros((len(allkeys), len(channel_index)), dtype=np.float64)
+        new_entries = np.zeros((len(allkeys), len(channel_index)), dtype=np.int32)
+        for these_keys, these_sumw, these_entries in [(self._keys, self._sumw, self._entries), (keys, sumw, entries)]:
+            pos = np.searchsorted(allkeys, these_keys)
+            new_sumw[pos] += these_sumw
+            new_entries[pos] += these_entries
+        self._keys, self._sumw, self._entries = allkeys, new_sumw, new_entries
+
+    def add(self, other):
+        self._add(other._keys, other._sumw, other._entries)
+        self.unmapped += other.unmapped
+
+    def _row(self, key):
+        pos = np.searchsorted(self._keys, key)
+        if pos == len(self._keys) or self._keys[pos] != key:
+            raise KeyError(f"No entries for key {key}")
+        return pos
+
+    def values(self, key=0):
+        """Sum of weights per channel (in channel_index order) for one key"""
+        return self._sumw[self._row(key)]
+
+    def entries(self, key=0):
+        """Number of fills per channel (in channel_index order) for one key (int32: up to 2**31 - 1 per channel)"""
+        return self._entries[self._row(key)]
+
+    def to_hist(self, key=0, subdet=None, where=None):
+        """Dense hist.Hist(ieta, iphi, depth) of one key, for plotting
+
+        subdet restricts the map to one subdetector, and `where` is an optional boolean mask over channels
+        (e.g. a charge threshold computed from another map).
+        """
+        h = hist.Hist(
+            hist.axis.Regular(83, -41.5, 41.5, name="ieta", label=r"ieta"),
+            hist.axis.Regular(72, 0.5, 72.5, name="iphi", label=r"iphi"),
+            hist.axis.Regular(7, 0.5, 7.5, name="depth", label=r"depth"),
+            label=self.label,
+        )
+        select = self.entries(key) > 0
+        if subdet is not None:
+            select &= channel_index.subdet == SUBDETS.index(subdet)
+        if where is not None:
+            select &= np.asarray(where)
+        h.fill(
+            ieta=channel_index.ieta[select],
+            iphi=channel_index.iphi[select],
+            depth=channel_index.depth[select],
+            weight=self.values(key)[select],
+        )
+        return h
+
+    def __repr__(self):
+        return f"ChannelMap(label={self.label!r}, keys={len(self._keys)}, channels={len(channel_index)}, unmapped={self.unmapped})"
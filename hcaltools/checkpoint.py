@@ -0,0 +1,54 @@
+'''
+Checkpointing of long runs: the merged (not yet postprocessed) output, and the set of completed chunks,
+are saved periodically, so that a crashed or evicted job only has to process the missing chunks.
+'''
+import os
+import json
+import time
+import hashlib
+from coffea import util
+
+
+def plan_hash(chunks):
+    """Fingerprint of a chunk plan, to make sure a checkpoint is only resumed by the same job"""
+    return hashlib.sha1(json.dumps(sorted(tuple(chunk) for chunk in chunks)).encode()).hexdigest()
+
+
+class Checkpoint:
+    """Merged output and completed chunks of a run, persisted atomically to checkpoint_dir/checkpoint.coffea
+
+    Chunks are stored as plain tuples (dataset, filename, treename, entrystart, entrystop), which compare
+    equal to the runner's Chunk namedtuples.
+    """
+
+    def __init__(self, checkpoint_dir, chunks, interval=600):
+        self.path = os.path.join(checkpoint_dir, "checkpoint.coffea")
+        self.interval = interval
+        self.plan = plan_hash(chunks)
+        self.output = None
+        self.completed = set()
+        self._last_save = time.time()
+        if os.path.isfile(self.path):
+            saved = util.load(self.path)
+            if saved["plan"] != self.plan:
+                raise RuntimeError(f"Checkpoint {self.path} was written for a different set of chunks. Remove it, or use another checkpoint directory.")
+            self.output = saved["output"]
+            self.completed = set(tuple(chunk) for chunk in saved["completed"])
+            print(f"Resuming from checkpoint {self.path}: {len(self.completed)} chunks already done")
+
+    def remaining(self, chunks):
+        return [chunk for chunk in chunks if tuple(chunk) not in self.completed]
+
+    def mark(self, chunks, output):
+        """Record chunks as merged into output, and save if the last save is older than the interval"""
+        self.completed.update(tuple(chunk) for chunk in chunks)
+        self.output = output
+        if time.time() - self._last_save > self.interval:
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        util.save({"plan": self.plan, "output": self.output, "completed": sorted(self.completed)}, tmp_path)
+        os.replace(tmp_path, self.path)
+        self._last_save = time.time()
@@ -0,0 +1,96 @@
+'''
+Adaptive, memory-aware chunk sizes.
+
+Bytes per event differ by orders of magnitude between splash, MinimumBias and HcalNZS runs, so a single
+--chunksize is either overhead-bound or runs out of memory. Here, the first chunk of each dataset is used
+as a probe:
+  - decompressed bytes per event of the branches the processor reads, from the TTree metadata (no reading)
+  - peak memory per event, by reading all those branches and processing the chunk in a separate process
+    while sampling its RSS
+and the chunk size of the dataset is set so that the larger of the two, per chunk, fits a target budget.
+
+The probe is a lower bound: a processor may skip most of the work on the probe chunk (e.g. SplashProcessor
+returns early on chunks without splash events), and then only the reading shows up in its peak memory.
+The decompressed bytes are a floor for such cases, but the memory of derived quantities is not, so keep
+some headroom in the budget.
+'''
+import threading
+import concurrent.futures
+
+import cloudpickle
+import uproot
+
+from hcaltools.columns import ColumnSet
+from hcaltools.workerpool import rss
+
+
+def bytes_per_event(filename, treename="Events", columns=None):
+    """Decompressed bytes per event of the branches selected by columns (all branches if None)"""
+    with uproot.open(filename) as f:
+        tree = f[treename]
+        if tree.num_entries == 0:
+            return 0.
+        branches = tree.iteritems(filter_name=columns) if columns is not None else tree.iteritems()
+        return sum(branch.uncompressed_bytes for _, branch in branches) / tree.num_entries
+
+
+def _probe_memory(chunk, pickled_processor, schemaclass, columns, interval=0.01):
+    """Peak RSS increase (bytes) while reading all the branches selected by columns and processing chunk,
+    sampled every interval seconds
+    """
+    from hcaltools.runner import read_arrays, events_from_arrays
+
+    processor_instance = cloudpickle.loads(pickled_processor)
+    baseline = rss()
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], rss())
+            done.wait(interval)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        # Read eagerly, so the declared branches count even if the processor doesn't access them in this chunk
+        events = events_from_arrays(read_arrays(chunk, columns), chunk, schemaclass)
+        processor_instance.process(events)
+    finally:
+        done.set()
+        sampler.join()
+    return max(peak[0], rss()) - baseline
+
+
+def adaptive_chunksizes(probe_chunks, processor_instance, schemaclass, memory_budget, min_chunksize=10, max_chunksize=100000):
+    """Chunk size per dataset, from one probe chunk per dataset, {dataset: chunk}
+
+    memory_budget is the target peak memory of one chunk, in bytes. The memory per event is the larger of the
+    probe's peak memory and the decompressed bytes of the declared branches (see the module docstring).
+    Returns {dataset: info}, where info has the chosen "chunksize", and the measured "bytes_per_event",
+    "peak_bytes_per_event" and "probe_entries".
+    Each probe runs in a fresh process, so that memory left over by earlier chunks doesn't skew it.
+    """
+    columns = ColumnSet.from_processor(processor_instance)
+    pickled_processor = cloudpickle.dumps(processor_instance)
+    chunking = {}
+    for dataset, chunk in probe_chunks.items():
+        nentries = chunk.entrystop - chunk.entrystart
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            peak = pool.submit(_probe_memory, chunk, pickled_processor, schemaclass, columns).result()
+        peak_per_event = peak / nentries if nentries else 0.
+        decompressed_per_event = bytes_per_event(chunk.filename, chunk.treename, columns)
+        per_event = max(peak_per_event, decompressed_per_event)
+        if per_event > 0:
+            chunksize = int(min(max(memory_budget / per_event, min_chunksize), max_chunksize))
+        else:
+            chunksize = max_chunksize
+        chunking[dataset] = {
+            "chunksize": chunksize,
+            "memory_budget": memory_budget,
+            "probe_entries": nentries,
+            "bytes_per_event": decompressed_per_event,
+            "peak_bytes_per_event": peak_per_event,
+        }
+        print(f"{dataset}: {decompressed_per_event / 1e3:.1f} kB/event decompressed, {peak_per_event / 1e3:.1f} kB/event peak memory -> chunksize {chunksize}")
+    return chunking
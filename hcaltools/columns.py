@@ -0,0 +1,62 @@
+'''
+Declared column sets, used to prune the branches read from hcalnano files.
+
+Processors declare the branches they need with a class attribute `columns`, e.g.
+
+    columns = {
+        "event": None,
+        "DigiHB": ["valid", "ieta", "iphi", "depth", "fc"],
+    }
+
+A value of None selects a whole singleton branch or collection. Per-time-sample fields are declared by
+their packed name (see HcalNanoAODSchema), i.e. "fc" selects fc0, ..., fc7. Only the declared branches are
+handed to the schema, so accessing anything else fails with a missing-field error, instead of silently
+reading (and decompressing) more of the file.
+'''
+import re
+
+
+class ColumnSet:
+    """Branch filter built from a processor's declared columns
+
+    Instances are callables (branch name -> bool), so they can be passed directly to uproot's filter_name.
+    """
+
+    _timesample_pattern = re.compile(r"^(.*\D)\d+$")
+
+    def __init__(self, columns):
+        self._columns = {
+            name: (None if fields is None else frozenset(fields))
+            for name, fields in columns.items()
+        }
+
+    @classmethod
+    def from_processor(cls, processor_instance):
+        """Column set declared by a processor, or None if the processor doesn't declare one"""
+        columns = getattr(processor_instance, "columns", None)
+        if columns is None:
+            return None
+        return cls(columns)
+
+    @property
+    def names(self):
+        """Declared collection and singleton names"""
+        return list(self._columns)
+
+    def __call__(self, branch_name):
+        if branch_name in self._columns:
+            return True
+        # Counts branch of a collection
+        if branch_name.startswith("n") and branch_name[1:] in self._columns:
+            return True
+        name, sep, field = branch_name.partition("_")
+        if not sep or name not in self._columns:
+            return False
+        fields = self._columns[name]
+        if fields is None or field in fields:
+            return True
+        match = self._timesample_pattern.match(field)
+        return match is not None and match.group(1) in fields
+
+    def __repr__(self):
+        return f"ColumnSet({self._columns!r})"
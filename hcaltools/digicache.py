@@ -0,0 +1,85 @@
+'''
+Per-chunk cache of quantities derived from digi collections.
+
+Processors derive the same quantities from a digi collection several times per chunk: the valid digis, the
+pedestal-subtracted charge, the charge sum, event quantities broadcast to the digis, flattened fields for
+filling. Every re-evaluation builds new awkward temporaries. DigiCache computes each quantity once, on first
+access, and keeps it until the chunk is done:
+
+    with DigiCache(events) as derived:
+        sumq = derived.sumq("HBDigis", pedestal_subtracted=True)       # jagged, over the valid digis
+        output["sumq_depthmap"].fill(
+            subdet="HB",
+            ieta=derived.field("HBDigis", "ieta", flat=True),           # numpy, flattened
+            ...
+            weight=derived.sumq("HBDigis", pedestal_subtracted=True, flat=True),
+        )
+
+All quantities are over the valid digis only. The cache is emptied when the with block exits, so nothing
+derived outlives the chunk.
+'''
+import numpy as np
+import awkward as ak
+
+
+class DigiCache:
+    """Derived quantities of the digi collections of one chunk's events, computed on first access"""
+
+    def __init__(self, events):
+        self._events = events
+        self._cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.clear()
+
+    def clear(self):
+        self._cache.clear()
+
+    def memo(self, name, collection, compute):
+        """compute(), cached under (name, collection); for processor-specific quantities"""
+        key = (name, collection)
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    def valid(self, collection):
+        """The valid digis of collection (invalid ones are hcalnano fillers)"""
+        def compute():
+            digis = self._events[collection]
+            return digis[digis.valid]
+        return self.memo("valid", collection, compute)
+
+    def counts(self, collection):
+        """Number of valid digis per event, as a numpy array"""
+        return self.memo("counts", collection, lambda: ak.to_numpy(ak.num(self.valid(collection), axis=1)))
+
+    def field(self, collection, name, flat=False):
+        """A field of the valid digis; flat=True flattens it over the events into a numpy array"""
+        if flat:
+            return self.memo(f"flat:{name}", collection, lambda: ak.to_numpy(ak.flatten(self.valid(collection)[name])))
+        return self.valid(collection)[name]
+
+    def realfc(self, collection):
+        """Pedestal-subtracted charge per time sample, fc - pedestalfc"""
+        return self.memo("realfc", collection, lambda: self.valid(collection).fc - self.valid(collection).pedestalfc)
+
+    def sumq(self, collection, pedestal_subtracted=False, flat=False):
+        """Charge summed over the time samples (of realfc with pedestal_subtracted, else of fc)"""
+        name = "sumq_realfc" if pedestal_subtracted else "sumq"
+        if flat:
+            return self.memo(f"flat:{name}", collection, lambda: ak.to_numpy(ak.flatten(self.sumq(collection, pedestal_subtracted))))
+        charge = (lambda: self.realfc(collection)) if pedestal_subtracted else (lambda: self.valid(collection).fc)
+        return self.memo(name, collection, lambda: ak.sum(charge(), axis=-1))
+
+    def event_field(self, collection, name, flat=False):
+        """An event-level field (e.g. "event", "bunchCrossing") broadcast to the valid digis
+
+        flat=True gives the flattened numpy array, built by repeating each event's value, without
+        the jagged intermediate.
+        """
+        if flat:
+            return self.memo(f"flat_event:{name}", collection, lambda: np.repeat(ak.to_numpy(self._events[name]), self.counts(collection)))
+        return self.memo(f"event:{name}", collection, lambda: ak.broadcast_arrays(self._events[name], self.valid(collection).ieta)[0])
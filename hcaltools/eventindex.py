@@ -0,0 +1,153 @@
+'''
+Sidecar index of event number -> entry number, for random access to specific events.
+
+The index of a file is built once, by reading only the run, luminosityBlock and event branches, and is
+stored as a small .npz (sorted event numbers, and their entry numbers) in an index directory, next to a
+summary.json with the entry count and the run/LS/event ranges of each file. Given an event list, the
+summary rules out most files without opening anything, and the per-file indices turn the requested events
+into minimal entry ranges, so a few dozen splash events can be reprocessed without a full pass over the run.
+'''
+import os
+import json
+import hashlib
+import numpy as np
+import uproot
+
+
+def entry_ranges(entries, max_gap=0):
+    """Merge sorted entry numbers into [(entrystart, entrystop), ...] ranges
+
+    Entries separated by at most max_gap skipped entries are merged into the same range (reading a few extra
+    entries is cheaper than starting another chunk).
+    """
+    entries = np.asarray(entries, dtype=np.int64)
+    if len(entries) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(entries) > max_gap + 1)
+    starts = np.concatenate([entries[:1], entries[breaks + 1]])
+    stops = np.concatenate([entries[breaks], entries[-1:]]) + 1
+    return [(int(start), int(stop)) for start, stop in zip(starts, stops)]
+
+
+class FileEventIndex:
+    """Sorted event numbers of one file, with their entry numbers (and run/LS)"""
+
+    def __init__(self, event, entry, run, luminosityBlock):
+        self.event = event
+        self.entry = entry
+        self.run = run
+        self.luminosityBlock = luminosityBlock
+
+    @classmethod
+    def build(cls, filename, treename="Events"):
+        with uproot.open(filename) as f:
+            arrays = f[treename].arrays(["run", "luminosityBlock", "event"], library="np")
+        order = np.argsort(arrays["event"], kind="stable")
+        return cls(
+            event=arrays["event"][order].astype(np.uint64),
+            entry=order.astype(np.uint32),
+            run=arrays["run"][order].astype(np.uint32),
+            luminosityBlock=arrays["luminosityBlock"][order].astype(np.uint32),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(**{k: arrays[k] for k in ["event", "entry", "run", "luminosityBlock"]})
+
+    def save(self, path):
+        np.savez_compressed(path, event=self.event, entry=self.entry, run=self.run, luminosityBlock=self.luminosityBlock)
+
+    def __len__(self):
+        return len(self.event)
+
+    def summary(self):
+        """Entry count and [min, max] of run, luminosityBlock and event"""
+        summary = {"nentries": len(self)}
+        for name in ["run", "luminosityBlock", "event"]:
+            values = getattr(self, name)
+            summary[name] = [int(values.min()), int(values.max())] if len(values) else None
+        return summary
+
+    def entries(self, event_numbers):
+        """Sorted entry numbers of those of event_numbers which are in this file"""
+        event_numbers = np.asarray(event_numbers).astype(np.uint64)
+        if len(self) == 0 or len(event_numbers) == 0:
+            return np.zeros(0, dtype=np.int64)
+        lo = np.searchsorted(self.event, event_numbers, side="left")
+        hi = np.searchsorted(self.event, event_numbers, side="right")
+        # Event numbers are only unique within a run, so one event number can match several entries
+        found = [self.entry[start:stop] for start, stop in zip(lo, hi) if stop > start]
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found).astype(np.int64))
+
+
+class EventIndexStore:
+    """Directory of FileEventIndex sidecars, plus summary.json with the per-file ranges"""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self._summary_path = os.path.join(index_dir, "summary.json")
+        self._summary = {}
+        if os.path.isfile(self._summary_path):
+            with open(self._summary_path, "r") as f:
+                self._summary = json.load(f)
+
+    def path(self, filename):
+        digest = hashlib.sha1(filename.encode()).hexdigest()[:10]
+        return os.path.join(self.index_dir, f"{os.path.basename(filename)}.{digest}.npz")
+
+    def summary(self, filename):
+        return self._summary.get(filename)
+
+    def add(self, filename, index):
+        os.makedirs(self.index_dir, exist_ok=True)
+        index.save(self.path(filename))
+        self._summary[filename] = index.summary()
+
+    def get(self, filename, treename="Events", build=True):
+        """Index of one file, built (and stored) if missing and build is True"""
+        path = self.path(filename)
+        if os.path.isfile(path):
+            return FileEventIndex.load(path)
+        if not build:
+            return None
+        index = FileEventIndex.build(filename, treename)
+        self.add(filename, index)
+        return index
+
+    def save_summary(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        tmp_path = self._summary_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._summary, f, sort_keys=True, indent=2)
+        os.replace(tmp_path, self._summary_path)
+
+    def might_contain(self, filename, event_numbers):
+        """False if the summary rules out all of event_numbers for this file (True if unknown)"""
+        summary = self.summary(filename)
+        if summary is None:
+            return True
+        if summary["event"] is None or len(event_numbers) == 0:
+            return False
+        event_numbers = np.asarray(event_numbers).astype(np.uint64)
+        first, last = summary["event"]
+        return bool(np.any((event_numbers >= first) & (event_numbers <= last)))
+
+    def entry_ranges(self, fileset, selection, treename="Events", max_gap=0):
+        """{filename: [(entrystart, entrystop), ...]} covering the selected events of each dataset
+
+        fileset is {dataset: [filenames]}, and selection an EventSelection keyed by dataset. Every file of
+        the fileset gets an entry, empty if it contains none of the selected events.
+        """
+        ranges = {}
+        for dataset, filenames in fileset.items():
+            event_numbers = selection.events(dataset)
+            for filename in filenames:
+                ranges[filename] = []
+                if not self.might_contain(filename, event_numbers):
+                    continue
+                index = self.get(filename, treename)
+                ranges[filename] = entry_ranges(index.entries(event_numbers), max_gap=max_gap)
+        return ranges
@@ -0,0 +1,59 @@
+'''
+Selection of specific events (e.g. splashes) by run key and event number.
+
+Event lists are stored as json files, {run key: [event numbers]}, where the run key is the dataset name
+used in the fileset (e.g. "r365373_Splashes_FEVT").
+'''
+import json
+import numpy as np
+
+
+class EventSelection:
+    """Per-run sets of event numbers, stored as sorted arrays for vectorized lookups"""
+
+    def __init__(self, events_by_run):
+        self._events = {
+            runkey: np.unique(np.asarray(list(event_numbers), dtype=np.uint64))
+            for runkey, event_numbers in events_by_run.items()
+        }
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r") as f:
+            return cls(json.load(f))
+
+    def to_file(self, path):
+        with open(path, "w") as f:
+            json.dump({runkey: events.tolist() for runkey, events in self._events.items()}, f, sort_keys=True, indent=2)
+            f.write("\n")
+
+    @property
+    def runs(self):
+        return list(self._events)
+
+    def events(self, runkey):
+        """Sorted array of the selected event numbers of one run (empty if the run has none)"""
+        return self._events.get(runkey, np.zeros(0, dtype=np.uint64))
+
+    def __len__(self):
+        return sum(len(events) for events in self._events.values())
+
+    def mask(self, runkey, event_numbers):
+        """Boolean mask of which of event_numbers are selected in run `runkey`"""
+        event_numbers = np.asarray(event_numbers).astype(np.uint64)
+        selected = self.events(runkey)
+        if len(selected) == 0:
+            return np.zeros(len(event_numbers), dtype=bool)
+        pos = np.searchsorted(selected, event_numbers)
+        pos[pos == len(selected)] = 0
+        return selected[pos] == event_numbers
+
+    def any(self, runkey, event_numbers):
+        """True if any of event_numbers is selected in run `runkey`"""
+        selected = self.events(runkey)
+        if len(selected) == 0:
+            return False
+        event_numbers = np.asarray(event_numbers).astype(np.uint64)
+        if len(event_numbers) == 0 or event_numbers.max() < selected[0] or event_numbers.min() > selected[-1]:
+            return False
+        return bool(np.any(self.mask(runkey, event_numbers)))
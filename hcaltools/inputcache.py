@@ -0,0 +1,233 @@
+'''
+Local on-disk cache of remote (xrootd) input files.
+
+When iterating on plots, the same files are read over and over from EOS. With an InputCache, the workers
+open a local copy of each root:// file instead, staged on first use:
+  - entries are whole files, validated by size on every use (and by adler32 checksum when staged, if
+    enabled); a failed or invalid copy falls back to reading the file remotely
+  - the total size is capped, and the least recently used entries are evicted to make room
+  - a Prefetcher thread stages the next files of the job in the background
+  - the remote side is pluggable: XRootDSource (xrdfs/xrdcp) for EOS, or LocalSource, which stands in for
+    EOS with a local directory (root://host//store/x -> root_dir/store/x), for testing
+
+Staging, validation and eviction are protected by file locks, so several workers (and the prefetcher) can
+share one cache directory.
+'''
+import os
+import re
+import json
+import time
+import zlib
+import fcntl
+import shutil
+import hashlib
+import threading
+import subprocess
+from contextlib import contextmanager
+
+_url_pattern = re.compile(r"^(root://[^/]+)/(/.*)$")
+
+
+def split_url(url):
+    """root://host//path -> ("root://host", "/path")"""
+    match = _url_pattern.match(url)
+    if not match:
+        raise ValueError(f"Not an xrootd url: {url}")
+    return match.group(1), match.group(2)
+
+
+def adler32(path, blocksize=1 << 20):
+    """adler32 of a file, as the 8-digit hex string used by xrootd"""
+    value = 1
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            value = zlib.adler32(block, value)
+    return f"{value & 0xffffffff:08x}"
+
+
+class XRootDSource:
+    """Remote files read with the xrootd command line tools"""
+
+    def stat(self, url):
+        host, path = split_url(url)
+        result = subprocess.run(["xrdfs", host, "stat", path], capture_output=True, text=True, check=True)
+        return int(re.search(r"Size:\s+(\d+)", result.stdout).group(1))
+
+    def checksum(self, url):
+        host, path = split_url(url)
+        result = subprocess.run(["xrdfs", host, "query", "checksum", path], capture_output=True, text=True, check=True)
+        algorithm, value = result.stdout.split()[:2]
+        if algorithm != "adler32":
+            raise IOError(f"Unexpected checksum type {algorithm} for {url}")
+        return value.lower().zfill(8)
+
+    def copy(self, url, destination):
+        subprocess.run(["xrdcp", "--nopbar", "--force", url, destination], check=True)
+
+
+class LocalSource:
+    """Stand-in for EOS: root://host//store/x is read from root_dir/store/x"""
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def path(self, url):
+        return os.path.join(self.root_dir, split_url(url)[1].lstrip("/"))
+
+    def stat(self, url):
+        return os.path.getsize(self.path(url))
+
+    def checksum(self, url):
+        return adler32(self.path(url))
+
+    def copy(self, url, destination):
+        shutil.copyfile(self.path(url), destination)
+
+
+@contextmanager
+def _locked(path, blocking=True):
+    """Exclusive flock on path; yields False (and holds nothing) if not blocking and already locked"""
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class InputCache:
+    """Directory of local copies of remote files, at most max_bytes in total
+
+    Each entry is the file itself, a .json with its url, size and checksum (whose mtime is the time of last
+    use), and a .lock file.
+    """
+
+    def __init__(self, cache_dir, max_bytes, source=None, checksum=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.source = source if source is not None else XRootDSource()
+        self.checksum = checksum
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, url):
+        digest = hashlib.sha1(url.encode()).hexdigest()[:12]
+        return os.path.join(self.cache_dir, f"{digest}_{os.path.basename(url)}")
+
+    def fetch(self, url):
+        """Path to read url from: the cached copy (staged now if needed), or url itself if it can't be cached"""
+        if not url.startswith("root://"):
+            return url
+        path = self.entry_path(url)
+        with _locked(path + ".lock"):
+            meta = self._read_meta(path)
+            if meta is not None and os.path.isfile(path) and os.path.getsize(path) == meta["size"]:
+                os.utime(path + ".json")
+                return path
+            try:
+                if self._stage(url, path):
+                    return path
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"WARNING : Could not cache {url} ({e}), reading it remotely")
+        return url
+
+    def _read_meta(self, path):
+        try:
+            with open(path + ".json", "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _stage(self, url, path):
+        """Copy url to path (the caller holds the entry lock); False if the file is too large for the cache"""
+        size = self.source.stat(url)
+        if size > self.max_bytes:
+            return False
+        self._make_room(size)
+        tmp_path = path + ".part"
+        try:
+            self.source.copy(url, tmp_path)
+            if os.path.getsize(tmp_path) != size:
+                raise IOError(f"size mismatch, {os.path.getsize(tmp_path)} != {size}")
+            checksum = None
+            if self.checksum:
+                checksum = self.source.checksum(url)
+                if adler32(tmp_path) != checksum:
+                    raise IOError("adler32 mismatch")
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with open(path + ".json.tmp", "w") as f:
+            json.dump({"url": url, "size": size, "checksum": checksum, "staged": time.time()}, f)
+        os.replace(path + ".json.tmp", path + ".json")
+        return True
+
+    def entries(self):
+        """[(last use, size, path)] of the complete entries"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name[:-len(".json")])
+            try:
+                entries.append((os.path.getmtime(path + ".json"), os.path.getsize(path), path))
+            except OSError:
+                continue
+        return entries
+
+    def _make_room(self, size):
+        """Evict least recently used entries until size more bytes fit (entries being staged are skipped)"""
+        with _locked(os.path.join(self.cache_dir, "cache.lock")):
+            entries = sorted(self.entries())
+            total = sum(entry[1] for entry in entries)
+            for _, entry_size, path in entries:
+                if total + size <= self.max_bytes:
+                    break
+                with _locked(path + ".lock", blocking=False) as acquired:
+                    if not acquired:
+                        continue
+                    # Files already opened by a worker stay readable after the unlink
+                    for suffix in [".json", ""]:
+                        if os.path.exists(path + suffix):
+                            os.remove(path + suffix)
+                    total -= entry_size
+
+    def prefetcher(self, filenames, ahead=2):
+        return Prefetcher(self, filenames, ahead=ahead)
+
+
+class Prefetcher(threading.Thread):
+    """Background thread staging filenames in order, at most `ahead` files past the last one in use"""
+
+    def __init__(self, cache, filenames, ahead=2):
+        super().__init__(daemon=True)
+        self.cache = cache
+        self.filenames = list(dict.fromkeys(filenames))
+        self._positions = {filename: i for i, filename in enumerate(self.filenames)}
+        self.ahead = ahead
+        self._position = 0
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def advance(self, filename):
+        """Mark filename (and everything before it) as in use"""
+        with self._condition:
+            self._position = max(self._position, self._positions.get(filename, 0))
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def run(self):
+        for i, filename in enumerate(self.filenames):
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped or i <= self._position + self.ahead)
+                if self._stopped:
+                    return
+            self.cache.fetch(filename)
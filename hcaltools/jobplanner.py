@@ -0,0 +1,69 @@
+'''
+Planning of batch jobs: files packed together, or split into entry ranges, so that all jobs get the same
+amount of work.
+
+With one job per file, small files waste slot startup time (untarring the environment) and the largest
+files set the wall time of the whole dataset. Here, the files of a dataset are laid out one after the
+other, and the sequence is cut into equal pieces (by events, or by bytes using each file's bytes per event).
+Cuts inside a file fall on multiples of the chunk size counted from the start of that file, and no job gets
+more than the target, unless a single chunk is larger than the target.
+'''
+import math
+
+
+def plan_jobs(files, target, chunksize=1):
+    """Jobs of at most `target` work each, as lists of (filename, entrystart, entrystop)
+
+    files is [(filename, nentries, weight)], where weight is the work per entry (1 to balance events, or
+    the bytes per event of the file to balance bytes). The work is spread evenly over ceil(total / target)
+    jobs; where rounding cuts to chunks would overfill a job, the cut moves back a chunk, and the rest goes
+    to the next job instead.
+    """
+    files = [(filename, nentries, weight) for filename, nentries, weight in files if nentries > 0]
+    total = sum(nentries * weight for _, nentries, weight in files)
+    if total == 0:
+        return []
+    per_job = total / max(1, math.ceil(total / target))
+
+    jobs = []
+    current = []
+    filled = 0.  # work of the current job
+    done = 0.    # work of all jobs so far, including the current one
+    for filename, nentries, weight in files:
+        start = 0
+        while start < nentries:
+            if weight > 0:
+                # Nearest chunk boundary (within the file) to the end of the current job's share...
+                boundary = (len(jobs) + 1) * per_job
+                stop = start + round((boundary - done) / weight / chunksize) * chunksize
+                # ... but without overfilling the job
+                fits = math.floor((target - filled) / weight * (1 + 1e-9))
+                stop = min(stop, start + fits // chunksize * chunksize, nentries)
+            else:
+                stop = nentries
+            if stop <= start:
+                if current:
+                    jobs.append(current)
+                    current, filled = [], 0.
+                    continue
+                # An empty job takes at least one chunk
+                stop = min(nentries, start + chunksize)
+            current.append((filename, start, stop))
+            filled += (stop - start) * weight
+            done += (stop - start) * weight
+            start = stop
+            if start < nentries:
+                # Cut inside the file: the job is full
+                jobs.append(current)
+                current, filled = [], 0.
+    if current:
+        jobs.append(current)
+    return jobs
+
+
+def job_entry_ranges(job):
+    """{filename: [[entrystart, entrystop], ...]} of a job (see plan_jobs)"""
+    ranges = {}
+    for filename, entrystart, entrystop in job:
+        ranges.setdefault(filename, []).append([entrystart, entrystop])
+    return ranges
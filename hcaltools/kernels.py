@@ -0,0 +1,99 @@
+'''
+Per-digi timing kernels over flat (ndigis x nTS) buffers: charge sum, charge-weighted time and TDC time.
+
+Computing these with awkward operations per time sample builds a temporary array per sample and operation.
+Here they are computed from the flat fc and tdc buffers of a digi collection (e.g.
+ak.to_numpy(ak.flatten(digis.fc)) for the packed fields of HcalNanoAODSchema): with numba, in a single
+compiled pass which writes each output once; without it, with a few vectorized numpy operations.
+Both give the same results:
+  - sumq = sum of fc over the time samples
+  - qtime = sum of (25 ns * iTS * fc) / sumq, or NaN if sumq is 0
+  - tdctime = min over the time samples of 25 ns * iTS + 0.5 ns * tdc, where a time sample without a valid
+    TDC (tdc >= 50) counts as NaN, so that one such time sample makes tdctime NaN (as np.min does).
+    With earliest_valid_tdc=True, time samples without a valid TDC are skipped instead: tdctime is the
+    earliest time over the valid ones, and NaN only if there are none.
+'''
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+TS_NS = 25.0
+TDC_NS = 0.5
+TDC_INVALID = 50
+
+
+def _charge_loop(fc, sumq, qtime):
+    for i in range(fc.shape[0]):
+        q = 0.
+        qt = 0.
+        for iTS in range(fc.shape[1]):
+            q += fc[i, iTS]
+            qt += TS_NS * iTS * fc[i, iTS]
+        sumq[i] = q
+        qtime[i] = qt / q if q != 0 else np.nan
+
+
+def _tdc_loop(tdc, tdctime, earliest_valid):
+    # A valid TDC time is below 25 ns, so times increase with iTS and the first valid time sample is the earliest
+    for i in range(tdc.shape[0]):
+        t = np.nan
+        for iTS in range(tdc.shape[1]):
+            if tdc[i, iTS] < TDC_INVALID:
+                if np.isnan(t):
+                    t = TS_NS * iTS + TDC_NS * tdc[i, iTS]
+            elif not earliest_valid:
+                t = np.nan
+                break
+        tdctime[i] = t
+
+
+if numba is not None:
+    _charge_kernel = numba.njit(cache=True)(_charge_loop)
+    _tdc_kernel = numba.njit(cache=True)(_tdc_loop)
+
+
+def _charge_numpy(fc):
+    sumq = fc.sum(axis=1, dtype=np.float64)
+    qtime = np.full(len(fc), np.nan)
+    np.divide(fc @ (TS_NS * np.arange(fc.shape[1])), sumq, out=qtime, where=(sumq != 0))
+    return sumq, qtime
+
+
+def _tdc_numpy(tdc, earliest_valid):
+    valid = tdc < TDC_INVALID
+    first = np.argmax(valid, axis=1)
+    rows = np.arange(len(tdc))
+    has_time = valid[rows, first] if earliest_valid else valid.all(axis=1)
+    return np.where(has_time, TS_NS * first + TDC_NS * tdc[rows, first], np.nan)
+
+
+def digi_timing(fc, tdc=None, use_numba=None, earliest_valid_tdc=False):
+    """(sumq, qtime, tdctime) of each digi, from (ndigis x nTS) fc and tdc arrays; tdctime is None without tdc
+
+    use_numba=None uses the compiled kernels if numba is installed; False forces the numpy implementation.
+    earliest_valid_tdc skips the time samples without a valid TDC, rather than giving NaN (see above).
+    """
+    if use_numba is None:
+        use_numba = numba is not None
+    elif use_numba and numba is None:
+        raise RuntimeError("numba is not installed")
+    fc = np.ascontiguousarray(fc)
+    if use_numba:
+        sumq = np.empty(len(fc))
+        qtime = np.empty(len(fc))
+        _charge_kernel(fc, sumq, qtime)
+    else:
+        sumq, qtime = _charge_numpy(fc)
+
+    tdctime = None
+    if tdc is not None:
+        tdc = np.ascontiguousarray(tdc)
+        if use_numba:
+            tdctime = np.empty(len(tdc))
+            _tdc_kernel(tdc, tdctime, earliest_valid_tdc)
+        else:
+            tdctime = _tdc_numpy(tdc, earliest_valid_tdc)
+    return sumq, qtime, tdctime
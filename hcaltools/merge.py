@@ -0,0 +1,78 @@
+'''
+Tree-reduction merge of .coffea outputs.
+
+Merging hundreds of per-job outputs one after the other takes long, and loading them all at once takes a lot
+of memory. Here, the outputs of each group (e.g. dataset) are merged k at a time in a process pool; every
+merge loads its inputs one by one, so a worker never holds more than its running total and one input. The
+partial results are merged the same way, level by level, until one output per group is left.
+
+Outputs which are too small (failed jobs leave near-empty files) or can't be loaded (truncated) are skipped
+and reported.
+'''
+import os
+import concurrent.futures
+
+from coffea import processor, util
+
+
+def merge_files(paths, output_path, min_size=100):
+    """Merge the outputs in paths into output_path; returns (output_path or None if nothing valid, skipped)
+
+    skipped is [(path, reason)] of the inputs which were too small or couldn't be loaded.
+    """
+    merged = None
+    skipped = []
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            if size < min_size:
+                raise IOError(f"only {size} bytes")
+            output = util.load(path)
+        except Exception as e:
+            skipped.append((path, repr(e)))
+            continue
+        merged = processor.accumulate([output], merged)
+        del output
+    if merged is None:
+        return None, skipped
+    tmp_path = output_path + ".tmp"
+    util.save(merged, tmp_path)
+    os.replace(tmp_path, output_path)
+    return output_path, skipped
+
+
+def tree_merge(groups, output_paths, tmpdir, k=4, workers=4, min_size=100):
+    """Merge the files of each group, {name: [paths]}, into output_paths[name], k files per merge
+
+    Returns {name: skipped} (see merge_files). Groups without any valid file get no output.
+    """
+    os.makedirs(tmpdir, exist_ok=True)
+    skipped = {name: [] for name in groups}
+    current = {name: list(paths) for name, paths in groups.items() if paths}
+    level = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        while current:
+            futures = {}
+            for name, paths in current.items():
+                batches = [paths[i:i + k] for i in range(0, len(paths), k)]
+                for i, batch in enumerate(batches):
+                    if len(batches) == 1:
+                        target = output_paths[name]
+                    else:
+                        target = os.path.join(tmpdir, f"{name}.level{level}.{i}.coffea")
+                    futures[pool.submit(merge_files, batch, target, min_size if level == 0 else 0)] = (name, batch, len(batches) == 1)
+
+            next_level = {}
+            for future in concurrent.futures.as_completed(futures):
+                name, batch, final = futures[future]
+                path, batch_skipped = future.result()
+                skipped[name].extend(batch_skipped)
+                if level > 0:
+                    for partial in batch:
+                        os.remove(partial)
+                if path is not None and not final:
+                    next_level.setdefault(name, []).append(path)
+            # Keep the batch order, so the merge order is reproducible
+            current = {name: sorted(paths) for name, paths in next_level.items()}
+            level += 1
+    return skipped
@@ -0,0 +1,106 @@
+'''
+Persistent cache of input file metadata (entry count and UUID), for chunk planning.
+
+Planning chunks needs the number of entries of every file, and opening hundreds of files on EOS takes
+minutes. The cache keeps {filename: {"size", "mtime", "uuid", "treename", "nentries", "checked"}} in a json
+file. An entry is reused as long as the file's size and modification time (from a stat, which doesn't open the
+file) are unchanged; otherwise, or with refresh=True, the file is opened again. Stats and opens run in parallel.
+
+Stats of remote files (xrdfs stat) are not free either, so a remote entry checked less than max_age seconds
+ago ("checked" is the time of the last stat) is reused without a new stat. Local files are always checked.
+'''
+import os
+import re
+import json
+import time
+import subprocess
+import concurrent.futures
+
+import uproot
+
+from hcaltools import parquetio
+from hcaltools.inputcache import split_url
+
+DEFAULT_PATH = os.path.expanduser("~/.cache/hcalanalysis/metadata.json")
+
+# Remote entries checked within this many seconds are trusted without a new stat
+DEFAULT_MAX_AGE = 24 * 3600
+
+
+def stat(filename):
+    """(size, mtime) of a local file or root:// url, without opening it"""
+    if filename.startswith("root://"):
+        host, path = split_url(filename)
+        result = subprocess.run(["xrdfs", host, "stat", path], capture_output=True, text=True, check=True)
+        size = int(re.search(r"Size:\s+(\d+)", result.stdout).group(1))
+        mtime = re.search(r"MTime:\s+(.+)", result.stdout).group(1).strip()
+        return size, mtime
+    st = os.stat(filename)
+    return st.st_size, str(st.st_mtime)
+
+
+def read_metadata(filename, treename="Events"):
+    if parquetio.is_parquet(filename):
+        return {"uuid": parquetio.file_uuid(filename), "treename": treename, "nentries": parquetio.num_entries(filename)}
+    with uproot.open(filename) as f:
+        return {"uuid": str(f.file.uuid), "treename": treename, "nentries": f[treename].num_entries}
+
+
+class MetadataCache:
+    """Entry counts and UUIDs of input files, stored in a json file and validated by size and mtime (see max_age)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self._entries = json.load(f)
+
+    def save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f, sort_keys=True, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def _lookup(self, filename, treename, refresh, validate, max_age):
+        """(filename, entry, status), status being "cached", "checked" (stat unchanged) or "read" (file opened)"""
+        entry = self._entries.get(filename)
+        usable = entry is not None and not refresh and entry["treename"] == treename
+        if usable and not validate:
+            return filename, entry, "cached"
+        if usable and filename.startswith("root://") and time.time() - entry.get("checked", 0) < max_age:
+            return filename, entry, "cached"
+        size, mtime = stat(filename)
+        if usable and (entry["size"], entry["mtime"]) == (size, mtime):
+            return filename, dict(entry, checked=time.time()), "checked"
+        entry = dict(size=size, mtime=mtime, checked=time.time(), **read_metadata(filename, treename))
+        return filename, entry, "read"
+
+    def get(self, filenames, treename="Events", refresh=False, validate=True, max_age=DEFAULT_MAX_AGE, workers=16):
+        """{filename: metadata} of filenames, from the cache where valid, and opening the files otherwise
+
+        refresh=True reopens all files; validate=False trusts cached entries without checking the files, and
+        max_age=0 checks remote files on every call (see the module docstring).
+        The cache file is updated if any file was checked or read.
+        """
+        metadata = {}
+        counts = {"cached": 0, "checked": 0, "read": 0}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self._lookup, filename, treename, refresh, validate, max_age) for filename in dict.fromkeys(filenames)]
+            for future in concurrent.futures.as_completed(futures):
+                filename, entry, status = future.result()
+                metadata[filename] = entry
+                counts[status] += 1
+                if status != "cached":
+                    self._entries[filename] = entry
+        print(f"File metadata: {counts['cached'] + counts['checked']} files from the cache {self.path} "
+              f"({counts['checked']} checked against the files), {counts['read']} opened")
+        if counts["checked"] or counts["read"]:
+            self.save()
+        return metadata
+
+    def nentries(self, filenames, treename="Events", **kwargs):
+        """{filename: number of entries} (see get)"""
+        return {filename: entry["nentries"] for filename, entry in self.get(filenames, treename, **kwargs).items()}
@@ -0,0 +1,138 @@
+'''
+Dataset indices (filelists/nanoindex/*.json): the files of a dataset, and their metadata.
+
+An index is {key: {"files": [urls], "metadata": {url: {...}}}}, where the metadata of each file is its size,
+number of Events entries, file UUID and run/luminosityBlock/event ranges. With the entry counts known,
+run_processor.py plans its chunks without opening any file. Older indices, {key: [urls]}, are still read.
+
+Directories are listed through a pluggable backend: EOSLister (the eos command line tool) or LocalLister
+(the local filesystem, for testing).
+'''
+import os
+import re
+import json
+import subprocess
+import concurrent.futures
+
+import uproot
+
+from hcaltools.eventindex import FileEventIndex
+
+
+class EOSLister:
+    """Lists EOS directories with `eos ls`; urls are root://host//store/..."""
+
+    def __init__(self, host="root://eoscms.cern.ch"):
+        self.host = host
+
+    def list(self, directory):
+        """[(path, is_directory, size in bytes)] of the entries of directory"""
+        result = subprocess.run(["eos", self.host, "ls", "-l", "-F", directory], capture_output=True, text=True, check=True)
+        entries = []
+        for line in result.stdout.splitlines():
+            fields = line.split(None, 8)
+            if len(fields) < 9:
+                continue
+            name = fields[8]
+            entries.append((os.path.join(directory, name.rstrip("/")), name.endswith("/"), int(fields[4])))
+        return entries
+
+    def url(self, path):
+        return f"{self.host}/{path}"
+
+
+class LocalLister:
+    """Lists local directories; urls are the paths themselves"""
+
+    def list(self, directory):
+        return [(entry.path, entry.is_dir(), entry.stat().st_size) for entry in os.scandir(directory)]
+
+    def url(self, path):
+        return path
+
+
+listers = {
+    "eos": EOSLister,
+    "local": LocalLister,
+}
+
+
+def walk(lister, directory, ext=".root", workers=8, max_depth=None):
+    """{path: size} of the files ending with ext under directory, listing subdirectories concurrently"""
+    files = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(lister.list, directory): 0}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                depth = pending.pop(future)
+                for path, is_directory, size in future.result():
+                    if is_directory:
+                        if max_depth is None or depth < max_depth:
+                            pending[pool.submit(lister.list, path)] = depth + 1
+                    elif path.endswith(ext):
+                        files[path] = size
+    return files
+
+
+def file_metadata(url, treename="Events", index_store=None):
+    """Entry count, UUID and run/luminosityBlock/event ranges of one file
+
+    With an index_store (an eventindex.EventIndexStore), the event index sidecar is stored as well, since
+    the same branches are read for it.
+    """
+    with uproot.open(url) as f:
+        uuid = str(f.file.uuid)
+    index = FileEventIndex.build(url, treename)
+    if index_store is not None:
+        index_store.add(url, index)
+    metadata = index.summary()
+    metadata["uuid"] = uuid
+    return metadata
+
+
+def make_index(lister, directory, ext=".root", workers=8, max_depth=None, metadata=True, treename="Events", index_store=None):
+    """{"files": [urls], "metadata": {url: {...}}} of the files under directory
+
+    Files whose metadata can't be read are left out (with a warning), since they couldn't be processed anyway.
+    """
+    files = walk(lister, directory, ext=ext, workers=workers, max_depth=max_depth)
+    index = {"files": [], "metadata": {}}
+    urls = {lister.url(path): size for path, size in sorted(files.items())}
+    if not metadata:
+        index["files"] = list(urls)
+        return index
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {url: pool.submit(file_metadata, url, treename, index_store) for url in urls}
+        for url, future in futures.items():
+            try:
+                index["metadata"][url] = dict(size=urls[url], **future.result())
+            except Exception as e:
+                print(f"WARNING : Could not read {url} ({e!r}), leaving it out of the index")
+                continue
+            index["files"].append(url)
+    return index
+
+
+def normalize_filename(filename):
+    """EOS paths (/eos/cms/store/..., /store/...) -> root://eoscms.cern.ch//store/...; other names unchanged"""
+    if filename.startswith("/eos/cms/store"):
+        return re.sub(r"^/eos/cms/store", r"root://eoscms.cern.ch//store", filename)
+    elif filename.startswith("/store"):
+        return re.sub(r"^/store", r"root://eoscms.cern.ch//store", filename)
+    return filename
+
+
+def load_fileset(path):
+    """(fileset, metadata) from an index json: {dataset: [urls]}, and {url: metadata} of the files which have it"""
+    with open(path, "r") as f:
+        doc = json.load(f)
+    fileset = {}
+    metadata = {}
+    for dataset, entry in doc.items():
+        if isinstance(entry, dict):
+            fileset[dataset] = list(entry["files"])
+            metadata.update(entry.get("metadata", {}))
+        else:
+            fileset[dataset] = list(entry)
+    return fileset, metadata
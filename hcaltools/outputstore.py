@@ -0,0 +1,214 @@
+'''
+Columnar output store: processor outputs as a directory of memory-mappable arrays.
+
+util.save writes the whole output as one compressed pickle, so plotting a single histogram means unpickling
+everything. save() writes the output as a directory instead: manifest.json holds the tree of dicts, each
+histogram is stored as an uncompressed .npy of its storage (with flow bins) next to a small pickle of its
+axes, and a ChannelMap as .npy arrays of its keys, sums and entries. Other leaves are small JSON values or
+pickles of their own.
+
+open_store() reads the manifest only. Arrays are memory-mapped when a leaf is accessed, and HistView.slice()
+builds a hist of just the selected bins, so loading costs time in proportion to what is actually read:
+
+    store = open_store("output.coffea.d")
+    h = store["r365373"]["splash_sumq"].slice(event_number=123456)
+    depthmap = store["r365373"]["splash_depthmap"].to_hist(key=123456)
+'''
+import os
+import json
+import pickle
+import shutil
+from collections.abc import Mapping
+
+import numpy as np
+import hist
+from coffea import processor, util
+
+from hcaltools.channels import ChannelMap
+
+MANIFEST = "manifest.json"
+
+
+class _Writer:
+    def __init__(self, path):
+        self.path = path
+        self._nfiles = 0
+
+    def _name(self):
+        self._nfiles += 1
+        return f"n{self._nfiles}"
+
+    def write(self, obj):
+        """Write obj's arrays/pickles into the store directory and return its manifest node"""
+        if isinstance(obj, (dict, processor.dict_accumulator)) and all(isinstance(key, (str, int)) and not isinstance(key, bool) for key in obj):
+            return {
+                "type": "dict",
+                "accumulator": isinstance(obj, processor.dict_accumulator),
+                "items": [[key, self.write(value)] for key, value in obj.items()],
+            }
+        name = self._name()
+        if isinstance(obj, hist.Hist):
+            with open(os.path.join(self.path, f"{name}.axes.pkl"), "wb") as f:
+                pickle.dump({
+                    "cls": type(obj),
+                    "axes": tuple(obj.axes),
+                    "storage": obj.storage_type,
+                    "kwargs": {"name": obj.name, "label": obj.label},
+                }, f)
+            np.save(os.path.join(self.path, f"{name}.npy"), np.asarray(obj.view(flow=True)))
+            return {"type": "hist", "name": name}
+        if isinstance(obj, ChannelMap):
+            for attr in ("keys", "sumw", "entries"):
+                np.save(os.path.join(self.path, f"{name}.{attr}.npy"), getattr(obj, f"_{attr}"))
+            return {"type": "channelmap", "name": name, "label": obj.label, "unmapped": obj.unmapped}
+        if type(obj) is np.ndarray and obj.dtype != object:
+            np.save(os.path.join(self.path, f"{name}.npy"), obj)
+            return {"type": "array", "name": name}
+        if obj is None or type(obj) in (bool, int, float, str):
+            return {"type": "value", "value": obj}
+        with open(os.path.join(self.path, f"{name}.pkl"), "wb") as f:
+            pickle.dump(obj, f)
+        return {"type": "pickle", "name": name}
+
+
+def save(output, path):
+    """Write output as a columnar store directory at path (replacing an existing one)"""
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    manifest = _Writer(tmp_path).write(output)
+    with open(os.path.join(tmp_path, MANIFEST), "w") as f:
+        json.dump(manifest, f)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+class HistView:
+    """A stored hist.Hist whose storage is memory-mapped; nothing but the axes is read until it is sliced"""
+
+    def __init__(self, path, name):
+        self._path = path
+        self._name = name
+        with open(os.path.join(path, f"{name}.axes.pkl"), "rb") as f:
+            self._meta = pickle.load(f)
+        self._storage = None
+
+    @property
+    def axes(self):
+        return self._meta["axes"]
+
+    def view(self, flow=False):
+        """Memory-mapped storage array (a structured array for weighted storages)"""
+        if self._storage is None:
+            self._storage = np.load(os.path.join(self._path, f"{self._name}.npy"), mmap_mode="r")
+        if flow:
+            return self._storage
+        return self._storage[tuple(slice(int(axis.traits.underflow), int(axis.traits.underflow) + len(axis)) for axis in self.axes)]
+
+    def values(self, flow=False):
+        view = self.view(flow=flow)
+        return view["value"] if view.dtype.names else view
+
+    def _hist(self, axes, storage):
+        h = self._meta["cls"](*axes, storage=self._meta["storage"](), **self._meta["kwargs"])
+        h.view(flow=True)[...] = storage
+        return h
+
+    def slice(self, **selection):
+        """hist.Hist of the remaining axes at the selected bins, e.g. slice(event_number=123456)
+
+        Each keyword selects one value of the axis with that name (a category, or a coordinate which falls in
+        one bin). Only the selected bins are read from disk.
+        """
+        index = []
+        axes = []
+        for axis in self.axes:
+            if axis.name in selection:
+                value = selection.pop(axis.name)
+                i = axis.index(value)
+                if i < -int(axis.traits.underflow) or i >= len(axis) + int(axis.traits.overflow):
+                    raise KeyError(f"{value!r} is not in axis {axis.name}")
+                index.append(i + int(axis.traits.underflow))
+            else:
+                index.append(slice(None))
+                axes.append(axis)
+        if selection:
+            raise KeyError(f"No axes named {list(selection)}")
+        storage = np.array(self.view(flow=True)[tuple(index)])
+        if not axes:
+            return storage[()]
+        return self._hist(axes, storage)
+
+    def to_hist(self):
+        """The full hist.Hist"""
+        return self._hist(self.axes, self.view(flow=True))
+
+    def __repr__(self):
+        return f"HistView({', '.join(f'{axis.name}[{len(axis)}]' for axis in self.axes)})"
+
+
+def _load_node(path, node, lazy):
+    kind = node["type"]
+    if kind == "dict":
+        if lazy:
+            return StoreDict(path, node)
+        items = {key: _load_node(path, value, lazy) for key, value in node["items"]}
+        return processor.dict_accumulator(items) if node["accumulator"] else items
+    if kind == "value":
+        return node["value"]
+    name = node["name"]
+    mmap_mode = "c" if lazy else None
+    if kind == "hist":
+        view = HistView(path, name)
+        return view if lazy else view.to_hist()
+    if kind == "channelmap":
+        # Copy-on-write maps, so lazily loaded ChannelMaps can still be merged into
+        channelmap = ChannelMap(label=node["label"])
+        channelmap.unmapped = node["unmapped"]
+        for attr in ("keys", "sumw", "entries"):
+            setattr(channelmap, f"_{attr}", np.load(os.path.join(path, f"{name}.{attr}.npy"), mmap_mode=mmap_mode))
+        return channelmap
+    if kind == "array":
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+    if kind == "pickle":
+        with open(os.path.join(path, f"{name}.pkl"), "rb") as f:
+            return pickle.load(f)
+    raise ValueError(f"Unknown node type {kind} in {path}")
+
+
+class StoreDict(Mapping):
+    """Read-only dict of a store; values are loaded on access (hists as HistView, arrays memory-mapped)"""
+
+    def __init__(self, path, node):
+        self._path = path
+        self._items = dict((key, value) for key, value in node["items"])
+        self._cache = {}
+
+    def __getitem__(self, key):
+        if key not in self._cache:
+            self._cache[key] = _load_node(self._path, self._items[key], lazy=True)
+        return self._cache[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return f"StoreDict({list(self._items)})"
+
+
+def open_store(path):
+    """Lazy view (StoreDict) of a store written by save()"""
+    with open(os.path.join(path, MANIFEST), "r") as f:
+        return _load_node(path, json.load(f), lazy=True)
+
+
+def load(path):
+    """The full output from a store directory, or from a .coffea file (util.load)"""
+    if os.path.isdir(path):
+        with open(os.path.join(path, MANIFEST), "r") as f:
+            return _load_node(path, json.load(f), lazy=False)
+    return util.load(path)
@@ -0,0 +1,104 @@
+'''
+Parquet files of hcalnano branches (skims and caches), read by the runner like the ROOT files they came from.
+
+Each column is one hcalnano branch, either flat (run, nDigiHB) or jagged (DigiHB_fc0), so HcalNanoAODSchema
+builds the same events from a parquet file as from ROOT. Reading a range of entries only reads the row groups
+which overlap it, and only the selected columns, so row groups should be about as large as the chunks.
+
+convert_root_file() copies the selected branches of a ROOT file to parquet (see filelists/makeparquetcache.py).
+The UUID of the source file is stored in the parquet metadata, so up-to-date copies can be recognized.
+'''
+import os
+import uuid
+
+import uproot
+import awkward as ak
+import pyarrow.parquet as pq
+
+SOURCE_UUID_KEY = b"hcalanalysis.source_uuid"
+
+
+def is_parquet(filename):
+    return filename.endswith(".parquet")
+
+
+def num_entries(filename):
+    return pq.ParquetFile(filename).metadata.num_rows
+
+
+def file_uuid(filename):
+    """Stand-in for the ROOT file UUID: derived from the path, size and modification time"""
+    st = os.stat(filename)
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{os.path.abspath(filename)}:{st.st_size}:{st.st_mtime_ns}"))
+
+
+def write_branches(arrays, path, row_group_size=None):
+    """Write {branch name: array} (all of the same length) to a parquet file, atomically"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    table = ak.to_arrow_table(ak.zip(dict(arrays), depth_limit=1))
+    pq.write_table(table, tmp_path, row_group_size=row_group_size)
+    os.replace(tmp_path, path)
+
+
+def read_branches(filename, entrystart=None, entrystop=None, columns=None):
+    """{branch name: array} of entries [entrystart, entrystop)
+
+    columns selects the branches (any callable branch name -> bool, e.g. a hcaltools.columns.ColumnSet).
+    """
+    f = pq.ParquetFile(filename)
+    names = [name for name in f.schema_arrow.names if columns is None or columns(name)]
+    entrystart = 0 if entrystart is None else entrystart
+    entrystop = f.metadata.num_rows if entrystop is None else entrystop
+
+    row_groups = []
+    offset = 0
+    first = None
+    for i in range(f.metadata.num_row_groups):
+        nrows = f.metadata.row_group(i).num_rows
+        if offset < entrystop and offset + nrows > entrystart:
+            row_groups.append(i)
+            if first is None:
+                first = offset
+        offset += nrows
+    if not row_groups:
+        first = entrystart
+    events = ak.from_arrow(f.read_row_groups(row_groups, columns=names))[entrystart - first:entrystop - first]
+    return {name: events[name] for name in names}
+
+
+def source_uuid(filename):
+    """UUID of the ROOT file a parquet file was converted from (see convert_root_file), or None"""
+    metadata = pq.ParquetFile(filename).schema_arrow.metadata or {}
+    value = metadata.get(SOURCE_UUID_KEY)
+    return value.decode() if value is not None else None
+
+
+def convert_root_file(url, path, columns=None, treename="Events", step=10000, row_group_size=250, compression="snappy"):
+    """Copy the branches of a ROOT tree selected by columns to a parquet file, step entries at a time
+
+    Returns the number of entries written.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    nentries = 0
+    writer = None
+    try:
+        with uproot.open(url) as f:
+            uuid_value = str(f.file.uuid).encode()
+            for arrays in f[treename].iterate(filter_name=columns, step_size=step, how=dict):
+                table = ak.to_arrow_table(ak.zip(arrays, depth_limit=1))
+                if writer is None:
+                    schema = table.schema.with_metadata({**(table.schema.metadata or {}), SOURCE_UUID_KEY: uuid_value})
+                    writer = pq.ParquetWriter(tmp_path, schema, compression=compression)
+                writer.write_table(table.replace_schema_metadata(schema.metadata), row_group_size=row_group_size)
+                nentries += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError(f"{url} has no entries")
+    os.replace(tmp_path, path)
+    return nentries
@@ -0,0 +1,216 @@
+'''
+Per-stage timing and memory profiling of chunks.
+
+When the runner is started with profiling on, each chunk is broken down into stages:
+  - "read": reading and decompressing the declared branches
+  - "schema": building the NanoEvents from the arrays
+  - "process": the processor's process() as a whole
+  - "accumulate": merging the chunk output into the total (in the main process)
+and processors can mark their own stages inside process(), e.g.
+
+    from hcaltools.profiling import stage
+
+    with stage("compute"):
+        digis["sumq"] = ...
+    with stage("fill"):
+        output["sumq"].fill(...)
+
+stage() does nothing when profiling is off, so processors can keep the annotations. While a chunk is
+profiled, a sampler thread tracks the RSS, and keeps the peak of each open stage. Note that profiled chunks
+are read eagerly ("read" stage) instead of lazily, so "process" doesn't include any reading.
+The per-stage totals are collected in a Profile accumulator, under output[dataset]["_profile"].
+'''
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from coffea import processor
+
+from hcaltools.workerpool import rss
+
+
+class Profile(processor.AccumulatorABC):
+    """Per-stage call counts, wall time and peak memory, summed/maxed over chunks"""
+
+    def __init__(self):
+        self.nchunks = 0
+        self.nevents = 0
+        # stage name -> {"calls": int, "time": seconds, "peak_rss": bytes, "peak_increase": bytes}
+        self.stages = {}
+
+    def identity(self):
+        return Profile()
+
+    def record(self, name, seconds, peak_rss=0, peak_increase=0):
+        entry = self.stages.setdefault(name, {"calls": 0, "time": 0., "peak_rss": 0, "peak_increase": 0})
+        entry["calls"] += 1
+        entry["time"] += seconds
+        entry["peak_rss"] = max(entry["peak_rss"], peak_rss)
+        entry["peak_increase"] = max(entry["peak_increase"], peak_increase)
+
+    def add(self, other):
+        self.nchunks += other.nchunks
+        self.nevents += other.nevents
+        for name, other_entry in other.stages.items():
+            entry = self.stages.setdefault(name, {"calls": 0, "time": 0., "peak_rss": 0, "peak_increase": 0})
+            entry["calls"] += other_entry["calls"]
+            entry["time"] += other_entry["time"]
+            entry["peak_rss"] = max(entry["peak_rss"], other_entry["peak_rss"])
+            entry["peak_increase"] = max(entry["peak_increase"], other_entry["peak_increase"])
+
+    def table(self):
+        """Text table of the stages, with time per event and fraction of the chunk time"""
+        total = sum(self.stages[name]["time"] for name in ["read", "schema", "process", "accumulate"] if name in self.stages)
+        lines = [
+            f"{self.nchunks} chunks, {self.nevents} events, {total:.2f} s summed over workers",
+            f"{'stage':<20} {'calls':>8} {'time [s]':>10} {'us/event':>10} {'fraction':>9} {'peak RSS [MB]':>14} {'peak incr. [MB]':>16}",
+        ]
+        for name, entry in sorted(self.stages.items(), key=lambda item: -item[1]["time"]):
+            lines.append(
+                f"{name:<20} {entry['calls']:>8} {entry['time']:>10.3f} {1e6 * entry['time'] / max(self.nevents, 1):>10.1f}"
+                f" {entry['time'] / total if total else 0:>9.1%} {entry['peak_rss'] / 1e6:>14.1f} {entry['peak_increase'] / 1e6:>16.1f}"
+            )
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return f"Profile(nchunks={self.nchunks}, nevents={self.nevents}, stages={list(self.stages)})"
+
+
+class ReadAheadStats(processor.AccumulatorABC):
+    """Read latency of chunks read ahead in a background thread (see runner.process_chunk_group)
+
+    read_time is the time spent reading and decompressing the branches of chunks ahead, and wait_time the
+    part of it the processing thread still had to wait for; the difference was hidden behind the processing
+    of earlier chunks. Chunks read ahead lazily are only opened ahead, and their branches are read while they
+    are processed, so they are counted apart (nlazy, open_time) rather than as hidden reads.
+    """
+
+    def __init__(self):
+        self.nchunks = 0
+        self.read_time = 0.
+        self.wait_time = 0.
+        self.nlazy = 0
+        self.open_time = 0.
+
+    def identity(self):
+        return ReadAheadStats()
+
+    def record(self, read_time, wait_time, lazy=False):
+        self.nchunks += 1
+        if lazy:
+            self.nlazy += 1
+            self.open_time += read_time
+        else:
+            self.read_time += read_time
+            self.wait_time += wait_time
+
+    def add(self, other):
+        self.nchunks += other.nchunks
+        self.read_time += other.read_time
+        self.wait_time += other.wait_time
+        self.nlazy += other.nlazy
+        self.open_time += other.open_time
+
+    @property
+    def hidden_time(self):
+        return max(self.read_time - self.wait_time, 0.)
+
+    def summary(self):
+        fraction = self.hidden_time / self.read_time if self.read_time else 0.
+        text = f"{self.nchunks - self.nlazy} chunks: {self.read_time:.2f} s reading, {self.wait_time:.2f} s waited, {self.hidden_time:.2f} s ({fraction:.0%}) hidden behind processing"
+        if self.nlazy:
+            text += f"; {self.nlazy} chunks only opened ahead ({self.open_time:.2f} s), their branch reads are not timed"
+        return text
+
+    def __repr__(self):
+        return f"ReadAheadStats(nchunks={self.nchunks}, read_time={self.read_time:.2f}, wait_time={self.wait_time:.2f}, nlazy={self.nlazy})"
+
+
+class _ChunkProfiler:
+    """Tracks the open stages of one chunk, and their peak RSS (sampled in a background thread)"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.baseline = rss()
+        self.stack = []
+        self.records = {}
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._done.is_set():
+            if self.stack:
+                current = rss()
+                for entry in self.stack:
+                    entry[1] = max(entry[1], current)
+            self._done.wait(self.interval)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._done.set()
+        self._sampler.join()
+
+    @contextmanager
+    def stage(self, name):
+        entry = [name, rss()]
+        self.stack.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.stack.remove(entry)
+            peak = max(entry[1], rss())
+            record = self.records.setdefault(name, [0, 0., 0])
+            record[0] += 1
+            record[1] += seconds
+            record[2] = max(record[2], peak)
+
+
+# Profiler of the chunk being processed by this thread (dask workers can run several), if profiling is on
+_local = threading.local()
+
+
+@contextmanager
+def stage(name):
+    """Time (and track the peak memory of) the enclosed block as stage `name`, if profiling is on"""
+    profiler = getattr(_local, "profiler", None)
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name):
+        yield
+
+
+@contextmanager
+def profile_chunk(chunk, trace_path=None):
+    """Profile the stages run inside the block; yields the Profile, filled when the block exits
+
+    With trace_path, a json line with the chunk and its stages is appended to that file.
+    """
+    profile = Profile()
+    profiler = _local.profiler = _ChunkProfiler()
+    profiler.start()
+    try:
+        yield profile
+    finally:
+        _local.profiler = None
+        profiler.stop()
+        profile.nchunks = 1
+        for name, (calls, seconds, peak) in profiler.records.items():
+            profile.record(name, seconds, peak_rss=peak, peak_increase=max(peak - profiler.baseline, 0))
+            profile.stages[name]["calls"] = calls
+        if trace_path is not None:
+            line = json.dumps({
+                "pid": os.getpid(),
+                "chunk": list(chunk),
+                "nevents": profile.nevents,
+                "stages": {name: {"time": seconds, "peak_rss": peak} for name, (calls, seconds, peak) in profiler.records.items()},
+            })
+            # One write per line, in append mode, so lines from several workers don't interleave
+            with open(trace_path, "a") as f:
+                f.write(line + "\n")
@@ -0,0 +1,456 @@
+'''
+Chunked execution of processors over hcalnano filesets.
+
+This is used by run_processor.py instead of coffea's run_uproot_job, because the processors' declared
+column sets (see hcaltools.columns) have to be applied when the events are opened, which coffea's runner
+doesn't expose.
+'''
+import time
+import itertools
+import functools
+import contextlib
+import concurrent.futures
+from collections import namedtuple, deque
+
+import cloudpickle
+import uproot
+from coffea import processor
+from coffea.nanoevents import NanoEventsFactory
+from tqdm.auto import tqdm
+
+from hcaltools import profiling, parquetio, skim
+from hcaltools.columns import ColumnSet
+from hcaltools.checkpoint import Checkpoint
+from hcaltools.workerpool import recycling_executor
+
+Chunk = namedtuple("Chunk", ["dataset", "filename", "treename", "entrystart", "entrystop"])
+"""Range of entries [entrystart, entrystop) of one file; the unit of work of the runner"""
+
+
+def plan_chunks(fileset, treename="Events", chunksize=250, maxchunks=None, entry_ranges=None, nentries=None):
+    """Split the files of each dataset into chunks of at most chunksize entries
+
+    chunksize is either an int, or {dataset: chunksize} (see hcaltools.chunking).
+    maxchunks limits the number of chunks per dataset (same convention as coffea).
+    entry_ranges optionally restricts files to lists of (entrystart, entrystop) ranges, {filename: ranges}
+    (see hcaltools.eventindex); files missing from it are processed in full.
+    nentries optionally gives the number of entries of files, {filename: nentries} (see hcaltools.nanoindex);
+    only files missing from both are opened.
+    """
+    chunks = []
+    for dataset, filenames in fileset.items():
+        dataset_chunks = []
+        dataset_chunksize = chunksize[dataset] if isinstance(chunksize, dict) else chunksize
+        for filename in filenames:
+            if maxchunks is not None and len(dataset_chunks) >= maxchunks:
+                break
+            if entry_ranges is not None and filename in entry_ranges:
+                ranges = entry_ranges[filename]
+            elif nentries is not None and filename in nentries:
+                ranges = [(0, nentries[filename])]
+            else:
+                ranges = [(0, num_entries(filename, treename))]
+            for rangestart, rangestop in ranges:
+                for entrystart in range(rangestart, rangestop, dataset_chunksize):
+                    entrystop = min(entrystart + dataset_chunksize, rangestop)
+                    dataset_chunks.append(Chunk(dataset, filename, treename, entrystart, entrystop))
+        if maxchunks is not None:
+            dataset_chunks = dataset_chunks[:maxchunks]
+        chunks.extend(dataset_chunks)
+    return chunks
+
+
+def num_entries(filename, treename="Events"):
+    """Number of entries of a ROOT tree, or of a parquet file (see hcaltools.parquetio)"""
+    if parquetio.is_parquet(filename):
+        return parquetio.num_entries(filename)
+    with uproot.open(filename) as f:
+        return f[treename].num_entries
+
+
+def open_events(chunk, schemaclass, columns=None, input_cache=None):
+    """NanoEvents for one chunk, with the branches pruned to `columns` (a ColumnSet) if given
+
+    With an input_cache (see hcaltools.inputcache), remote files are read from their local copy.
+    Parquet files are read eagerly (see read_arrays).
+    """
+    if parquetio.is_parquet(chunk.filename):
+        return events_from_arrays(read_arrays(chunk, columns, input_cache=input_cache), chunk, schemaclass)
+    iteritems_options = {}
+    if columns is not None:
+        iteritems_options["filter_name"] = columns
+    filename = input_cache.fetch(chunk.filename) if input_cache is not None else chunk.filename
+    factory = NanoEventsFactory.from_root(
+        filename,
+        treepath=chunk.treename,
+        entry_start=chunk.entrystart,
+        entry_stop=chunk.entrystop,
+        schemaclass=schemaclass,
+        metadata={
+            "dataset": chunk.dataset,
+            "filename": chunk.filename,
+            "treename": chunk.treename,
+            "entrystart": chunk.entrystart,
+            "entrystop": chunk.entrystop,
+        },
+        iteritems_options=iteritems_options,
+    )
+    return factory.events()
+
+
+class PreloadedArrays(dict):
+    """Arrays of one chunk, {branch name: array}, with the metadata NanoEventsFactory.from_preloaded needs"""
+
+    def __init__(self, arrays, metadata):
+        super().__init__(arrays)
+        self.metadata = metadata
+
+
+def read_arrays(chunk, columns=None, input_cache=None):
+    """Read (and decompress) the branches selected by `columns` for one chunk, as PreloadedArrays"""
+    filename = input_cache.fetch(chunk.filename) if input_cache is not None else chunk.filename
+    if parquetio.is_parquet(filename):
+        return PreloadedArrays(parquetio.read_branches(filename, chunk.entrystart, chunk.entrystop, columns), {
+            "uuid": parquetio.file_uuid(filename),
+            "num_rows": chunk.entrystop - chunk.entrystart,
+            "object_path": chunk.treename,
+        })
+    with uproot.open(filename) as f:
+        arrays = f[chunk.treename].arrays(filter_name=columns, entry_start=chunk.entrystart, entry_stop=chunk.entrystop, how=dict)
+        uuid = str(f.file.uuid)
+    return PreloadedArrays(arrays, {
+        "uuid": uuid,
+        "num_rows": chunk.entrystop - chunk.entrystart,
+        "object_path": chunk.treename,
+    })
+
+
+def events_from_arrays(arrays, chunk, schemaclass):
+    """NanoEvents for one chunk, from arrays already in memory (see read_arrays)"""
+    factory = NanoEventsFactory.from_preloaded(
+        arrays,
+        entry_start=0,
+        entry_stop=arrays.metadata["num_rows"],
+        schemaclass=schemaclass,
+        metadata={
+            "dataset": chunk.dataset,
+            "filename": chunk.filename,
+            "treename": chunk.treename,
+            "entrystart": chunk.entrystart,
+            "entrystop": chunk.entrystop,
+        },
+    )
+    return factory.events()
+
+
+def _skim_arrays(chunk, skim_writer, mask, arrays=None, input_cache=None):
+    """Skim branches of the entries of chunk between the first and last marked ones, and the mask over them
+
+    Branches already in arrays (the chunk read eagerly, see read_arrays) are reused; only the other ones are read.
+    """
+    marked = mask.nonzero()[0]
+    first, last = int(marked[0]), int(marked[-1]) + 1
+    span = chunk._replace(entrystart=chunk.entrystart + first, entrystop=chunk.entrystart + last)
+    if arrays is None:
+        return read_arrays(span, skim_writer.columns, input_cache=input_cache), mask[first:last]
+    skim_arrays = dict(read_arrays(span, lambda name: skim_writer.columns(name) and name not in arrays, input_cache=input_cache))
+    skim_arrays.update({name: array[first:last] for name, array in arrays.items() if skim_writer.columns(name)})
+    return skim_arrays, mask[first:last]
+
+
+def _process(processor_instance, events, chunk, skim_writer=None, input_cache=None, arrays=None):
+    """processor_instance.process(events), writing the events it marks if skimming (see hcaltools.skim)
+
+    arrays are the arrays events were built from, if the chunk was read eagerly.
+    """
+    if skim_writer is None:
+        return processor_instance.process(events)
+    with skim.collect() as marks:
+        output = processor_instance.process(events)
+    if marks.mask is not None and marks.mask.any():
+        with profiling.stage("skim"):
+            skim_arrays, mask = _skim_arrays(chunk, skim_writer, marks.mask, arrays, input_cache)
+            parts = skim_writer.write(chunk, skim_arrays, mask)
+        output.setdefault(chunk.dataset, {})["_skim"] = parts
+    return output
+
+
+def process_chunk(chunk, processor_instance, schemaclass, columns=None, profile=False, trace_path=None, input_cache=None, skim_writer=None):
+    """Output of processor_instance for one chunk
+
+    With profile, the chunk is read eagerly, and a Profile of its stages is added to the output as
+    output[dataset]["_profile"] (see hcaltools.profiling).
+    With a skim_writer, the events marked by the processor are written out, and the part files are listed in
+    output[dataset]["_skim"] (see hcaltools.skim).
+    """
+    if not profile:
+        events = open_events(chunk, schemaclass, columns, input_cache=input_cache)
+        return _process(processor_instance, events, chunk, skim_writer, input_cache)
+
+    with profiling.profile_chunk(chunk, trace_path=trace_path) as chunk_profile:
+        with profiling.stage("read"):
+            arrays = read_arrays(chunk, columns, input_cache=input_cache)
+        with profiling.stage("schema"):
+            events = events_from_arrays(arrays, chunk, schemaclass)
+        chunk_profile.nevents = len(events)
+        with profiling.stage("process"):
+            output = _process(processor_instance, events, chunk, skim_writer, input_cache, arrays)
+    output.setdefault(chunk.dataset, {})["_profile"] = chunk_profile
+    return output
+
+
+def group_chunks(chunks, size):
+    """Group consecutive chunks of the same file into tuples of at most size chunks"""
+    groups = []
+    for chunk in chunks:
+        if groups and len(groups[-1]) < size and groups[-1][-1][:3] == chunk[:3]:
+            groups[-1].append(chunk)
+        else:
+            groups.append([chunk])
+    return [tuple(group) for group in groups]
+
+
+def _timed_read(chunk, schemaclass, columns, input_cache, lazy):
+    """Arrays of chunk (or, if lazy, its lazy events), and the time it took to get them"""
+    start = time.perf_counter()
+    if lazy:
+        result = open_events(chunk, schemaclass, columns, input_cache=input_cache)
+    else:
+        result = read_arrays(chunk, columns, input_cache=input_cache)
+    return result, time.perf_counter() - start
+
+
+def process_chunk_group(chunks, processor_instance, schemaclass, columns=None, depth=1, lazy=False, profile=False, trace_path=None, input_cache=None, skim_writer=None):
+    """Merged output of processor_instance for consecutive chunks, reading up to depth chunks ahead
+
+    The branches selected by `columns` of the next chunks are read and decompressed in a background thread
+    while the current one is processed. With lazy, the next chunks are only opened ahead (staged to the
+    input_cache, if any), and their branches are read when the processor first accesses them, as in
+    process_chunk; that skips branches the processor doesn't need (e.g. in chunks it skips), but hides less
+    I/O. How much of the read time was hidden is added to the output as output[dataset]["_readahead"] (a
+    profiling.ReadAheadStats). With profile, the "read" stage is the time spent waiting for the background
+    thread.
+    """
+    output = None
+    stats = profiling.ReadAheadStats()
+    remaining = iter(chunks)
+    pending = deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader:
+        def read_next():
+            for chunk in itertools.islice(remaining, 1):
+                pending.append((chunk, reader.submit(_timed_read, chunk, schemaclass, columns, input_cache, lazy)))
+
+        for _ in range(max(depth, 1)):
+            read_next()
+        while pending:
+            chunk, future = pending.popleft()
+            with (profiling.profile_chunk(chunk, trace_path=trace_path) if profile else contextlib.nullcontext()) as chunk_profile:
+                with profiling.stage("read"):
+                    wait_start = time.perf_counter()
+                    result, read_time = future.result()
+                    wait_time = time.perf_counter() - wait_start
+                read_next()
+                if lazy:
+                    events, arrays = result, None
+                else:
+                    with profiling.stage("schema"):
+                        events = events_from_arrays(result, chunk, schemaclass)
+                    arrays = result
+                del result
+                if profile:
+                    chunk_profile.nevents = len(events)
+                with profiling.stage("process"):
+                    result = _process(processor_instance, events, chunk, skim_writer, input_cache, arrays)
+                del arrays
+            stats.record(read_time, wait_time, lazy=lazy)
+            if profile:
+                result.setdefault(chunk.dataset, {})["_profile"] = chunk_profile
+            output = processor.accumulate([result], output)
+    output.setdefault(chunks[0].dataset, {})["_readahead"] = stats
+    return output
+
+
+# Processors hold lambdas (make_output), so they are shipped to the workers with cloudpickle,
+# and unpickled once per worker process
+_processor_cache = {}
+
+
+def _process_chunk_pickled(chunk, pickled_processor, schemaclass, columns, profile=False, trace_path=None, input_cache=None, skim_writer=None):
+    key = hash(pickled_processor)
+    if key not in _processor_cache:
+        _processor_cache.clear()
+        _processor_cache[key] = cloudpickle.loads(pickled_processor)
+    return process_chunk(chunk, _processor_cache[key], schemaclass, columns, profile=profile, trace_path=trace_path,
+                         input_cache=input_cache, skim_writer=skim_writer)
+
+
+def _process_chunk_group_pickled(chunks, pickled_processor, schemaclass, columns, depth=1, lazy=False, profile=False, trace_path=None, input_cache=None, skim_writer=None):
+    key = hash(pickled_processor)
+    if key not in _processor_cache:
+        _processor_cache.clear()
+        _processor_cache[key] = cloudpickle.loads(pickled_processor)
+    return process_chunk_group(chunks, _processor_cache[key], schemaclass, columns, depth=depth, lazy=lazy, profile=profile,
+                               trace_path=trace_path, input_cache=input_cache, skim_writer=skim_writer)
+
+
+def _reduce(*outputs):
+    return processor.accumulate(outputs)
+
+
+def iterative_executor(chunks, function):
+    """Yield ((chunk,), function(chunk)) for all chunks, computed one after the other in this process"""
+    for chunk in chunks:
+        yield (chunk,), function(chunk)
+
+
+def futures_executor(chunks, function, workers=4):
+    """Yield ((chunk,), function(chunk)) for all chunks, computed in a process pool
+
+    At most 2*workers chunks are in flight, so finished outputs never pile up waiting to be merged.
+    """
+    chunks = iter(chunks)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(function, chunk): chunk for chunk in itertools.islice(chunks, 2 * workers)}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                chunk = pending.pop(future)
+                for next_chunk in itertools.islice(chunks, 1):
+                    pending[pool.submit(function, next_chunk)] = next_chunk
+                yield (chunk,), future.result()
+
+
+def dask_executor(chunks, function, workers=4, threads_per_worker=1, memory_limit="auto", treereduction=8):
+    """Yield (chunks, merged output) over a dask LocalCluster
+
+    Outputs are merged on the workers, treereduction at a time, and only outputs covering
+    treereduction**2 chunks (or the leftovers at the end) are sent back, so the client merges a few large
+    outputs instead of one per chunk. memory_limit is per worker, e.g. "4GB" ("auto" splits the node's memory).
+    """
+    from dask.distributed import Client, LocalCluster, as_completed
+
+    max_level = 2
+    with LocalCluster(n_workers=workers, threads_per_worker=threads_per_worker, memory_limit=memory_limit, processes=True) as cluster, Client(cluster) as client:
+        futures = client.map(function, chunks, pure=False)
+        # future key -> (chunks covered, reduction level)
+        covered = {future.key: ((chunk,), 0) for future, chunk in zip(futures, chunks)}
+        batches = {level: [] for level in range(max_level)}
+        pending = as_completed(futures)
+        del futures
+        for future in pending:
+            future_chunks, level = covered[future.key]
+            if level < max_level:
+                batches[level].append(future)
+            else:
+                del covered[future.key]
+                yield future_chunks, future.result()
+
+            # Reduce full batches; once nothing else is running, flush the partial ones too
+            flush = pending.count() == 0
+            for level, batch in batches.items():
+                if not batch or (len(batch) < treereduction and not flush):
+                    continue
+                batch_chunks = tuple(chunk for f in batch for chunk in covered.pop(f.key)[0])
+                if len(batch) == 1:
+                    yield batch_chunks, batch[0].result()
+                else:
+                    reduced = client.submit(_reduce, *batch, pure=False)
+                    covered[reduced.key] = (batch_chunks, max_level if flush else level + 1)
+                    pending.add(reduced)
+                batch.clear()
+
+
+executors = {
+    "iterative": iterative_executor,
+    "futures": futures_executor,
+    "dask": dask_executor,
+    "recycling": recycling_executor,
+}
+
+
+def run(chunks, processor_instance, schemaclass, workers=4, status=True, checkpoint_dir=None, checkpoint_interval=600,
+        executor="futures", executor_options=None, profile=False, trace_path=None, input_cache=None, prefetch=2,
+        read_ahead=0, read_ahead_group=4, read_ahead_lazy=False, skim_dir=None, skim_collections=None):
+    """Run processor_instance over chunks, and return the postprocessed, merged output
+
+    executor is one of `executors`; executor_options are passed on to it (workers is passed to all but
+    the iterative executor).
+    With profile, each dataset's output gets a Profile of the chunk stages under "_profile", including the
+    time spent merging outputs here; trace_path is a jsonl file to which a line is appended per chunk.
+    With checkpoint_dir, the merged output and the completed chunks are saved every checkpoint_interval
+    seconds and when the run stops (also on errors), and rerunning the same job only processes the
+    missing chunks (see hcaltools.checkpoint).
+    With an input_cache, the workers read remote files from local copies, and the next `prefetch` files
+    past the ones being processed are staged in the background (see hcaltools.inputcache).
+    With read_ahead > 0, workers get groups of read_ahead_group consecutive chunks of a file, and read the
+    declared branches of up to read_ahead chunks ahead while processing; with read_ahead_lazy, they only open
+    those chunks ahead (see process_chunk_group).
+    With a skim_dir, the events marked by the processor are written there as parquet part files, with the
+    branches of skim_collections (default: the processor's declared columns; see hcaltools.skim).
+    """
+    columns = ColumnSet.from_processor(processor_instance)
+    skim_writer = None
+    if skim_dir is not None:
+        if skim_collections is None:
+            skim_collections = getattr(processor_instance, "skim_collections", None) or (columns.names if columns is not None else None)
+        if skim_collections is None:
+            raise ValueError("Skimming needs skim_collections, since the processor doesn't declare its columns")
+        skim_writer = skim.SkimWriter(skim_dir, skim_collections)
+    options = dict(
+        pickled_processor=cloudpickle.dumps(processor_instance),
+        schemaclass=schemaclass,
+        columns=columns,
+        profile=profile,
+        trace_path=trace_path,
+        input_cache=input_cache,
+        skim_writer=skim_writer,
+    )
+    if read_ahead:
+        function = functools.partial(_process_chunk_group_pickled, depth=read_ahead, lazy=read_ahead_lazy, **options)
+    else:
+        function = functools.partial(_process_chunk_pickled, **options)
+    executor_options = dict(executor_options or {})
+    if executor != "iterative":
+        executor_options.setdefault("workers", workers)
+
+    output = None
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = Checkpoint(checkpoint_dir, chunks, interval=checkpoint_interval)
+        output = checkpoint.output
+        chunks = checkpoint.remaining(chunks)
+
+    prefetcher = None
+    if input_cache is not None and prefetch:
+        prefetcher = input_cache.prefetcher([chunk.filename for chunk in chunks], ahead=prefetch)
+        prefetcher.start()
+
+    # consistent is False while a result is half-merged, so an interrupted merge is never checkpointed
+    consistent = True
+    try:
+        with tqdm(total=len(chunks), desc="Processing", unit="chunk", disable=not status) as progress:
+            tasks = group_chunks(chunks, read_ahead_group) if read_ahead else chunks
+            for done_tasks, result in executors[executor](tasks, function, **executor_options):
+                done_chunks = tuple(chunk for task in done_tasks for chunk in task) if read_ahead else done_tasks
+                consistent = False
+                accumulate_start = time.perf_counter()
+                output = processor.accumulate([result], output)
+                if profile:
+                    dataset_output = output.get(done_chunks[0].dataset, {})
+                    if "_profile" in dataset_output:
+                        dataset_output["_profile"].record("accumulate", time.perf_counter() - accumulate_start)
+                if checkpoint is not None:
+                    checkpoint.mark(done_chunks, output)
+                consistent = True
+                progress.update(len(done_chunks))
+                if prefetcher is not None:
+                    for chunk in done_chunks:
+                        prefetcher.advance(chunk.filename)
+    finally:
+        if prefetcher is not None:
+            prefetcher.stop()
+        if checkpoint is not None and consistent:
+            checkpoint.save()
+    if output is None:
+        output = {}
+    return processor_instance.postprocess(output)
@@ -0,0 +1,96 @@
+'''
+Skims: the events marked by a processor, with a chosen set of branches, written to local parquet files.
+
+A processor marks events with mark(mask), where mask is a boolean array over the events passed to process();
+marks made several times in a chunk are OR-ed. In a skim run (run_processor.py --skim-dir), the runner then
+reads the selected branches of the marked entries (reusing those of eagerly read chunks, see
+runner._skim_arrays) and writes them to a part file per chunk, as soon as the chunk is processed:
+
+    {skim_dir}/{dataset}/{file name}-{hash of the file url}_{entrystart}-{entrystop}.parquet
+
+Outside of a skim run, mark() does nothing. The part files are read back like any input file (see
+hcaltools.parquetio); run_processor.py writes their index to {skim_dir}/nanoindex_skim.json, for -j.
+'''
+import os
+import json
+import hashlib
+import threading
+import contextlib
+
+import numpy as np
+import awkward as ak
+
+from hcaltools import parquetio
+from hcaltools.columns import ColumnSet
+
+# Always written, so that skimmed events can be matched to the original ones
+EVENT_ID_BRANCHES = ("run", "luminosityBlock", "event")
+
+_local = threading.local()
+
+
+class _Marks:
+    def __init__(self):
+        self.mask = None
+
+
+def mark(mask):
+    """Mark events to be skimmed (boolean mask over the events passed to process())"""
+    marks = getattr(_local, "marks", None)
+    if marks is None:
+        return
+    mask = np.asarray(ak.to_numpy(mask), dtype=bool)
+    marks.mask = mask if marks.mask is None else (marks.mask | mask)
+
+
+@contextlib.contextmanager
+def collect():
+    """Collect the marks made in this thread inside the block"""
+    marks = _Marks()
+    _local.marks = marks
+    try:
+        yield marks
+    finally:
+        _local.marks = None
+
+
+class SkimWriter:
+    """Writes the marked entries of chunks, with the branches of `collections`, to parquet part files"""
+
+    def __init__(self, skim_dir, collections):
+        self.skim_dir = os.path.abspath(skim_dir)
+        self.columns = ColumnSet({name: None for name in (*EVENT_ID_BRANCHES, *collections)})
+
+    def part_path(self, chunk):
+        stem = os.path.splitext(os.path.basename(chunk.filename))[0]
+        url_hash = hashlib.sha1(chunk.filename.encode()).hexdigest()[:8]
+        return os.path.join(self.skim_dir, chunk.dataset, f"{stem}-{url_hash}_{chunk.entrystart}-{chunk.entrystop}.parquet")
+
+    def write(self, chunk, arrays, mask):
+        """Write the entries of arrays ({branch name: array} of the chunk) selected by mask
+
+        Returns {part path: number of events}, for the output bookkeeping.
+        """
+        path = self.part_path(chunk)
+        parquetio.write_branches({name: array[mask] for name, array in arrays.items()}, path)
+        return {path: int(np.count_nonzero(mask))}
+
+
+def write_index(output, skim_dir):
+    """Write the part files listed in output[dataset]["_skim"] as a nanoindex json (see hcaltools.nanoindex)
+
+    Returns the path of the index, {skim_dir}/nanoindex_skim.json.
+    """
+    index = {}
+    for dataset, dataset_output in output.items():
+        parts = dataset_output.get("_skim", {}) if isinstance(dataset_output, dict) else {}
+        if parts:
+            index[dataset] = {
+                "files": sorted(parts),
+                "metadata": {path: {"nentries": nevents} for path, nevents in parts.items()},
+            }
+    path = os.path.join(skim_dir, "nanoindex_skim.json")
+    os.makedirs(skim_dir, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(index, f, sort_keys=True, indent=2)
+    return path
@@ -0,0 +1,137 @@
+'''
+Synthetic hcalnano files, for testing and benchmarking without EOS access.
+
+The files have the layout of hcalnano: the event branches (run, luminosityBlock, event, bunchCrossing), and
+digi collections with one entry per channel (see hcaltools.channels) and per-time-sample branches
+(adc0, fc0, ...). Digis which are not read out have valid == False and zeroed fields, as in hcalnano.
+
+The occupancy (fraction of valid digis) and the mean charge of a hit set how busy the events are, from
+MinimumBias-like to splash-like (see PRESETS). Charges are exponentially distributed, spread over the time
+samples with a fixed pulse shape, on top of a pedestal.
+
+    python -m hcaltools.synthetic synthetic_splash.root --events 500 --preset splash
+'''
+import numpy as np
+import awkward as ak
+import uproot
+
+from hcaltools.channels import _subdet_channels
+
+# Number of time samples per subdetector
+NTS = {"HB": 8, "HE": 8, "HF": 3}
+
+# Digi collection -> subdetector
+COLLECTIONS = {
+    "DigiHB": "HB",
+    "DigiHE": "HE",
+    "DigiHF": "HF",
+    "HBDigis": "HB",
+    "HEDigis": "HE",
+}
+
+# name -> (occupancy, mean hit charge in fC)
+PRESETS = {
+    "minbias": (0.03, 30.),
+    "nzs": (0.3, 15.),
+    "splash": (0.97, 2.e4),
+}
+
+# Fraction of the hit charge in each time sample
+_PULSE = {
+    8: np.array([0., 0., 0.02, 0.65, 0.25, 0.06, 0.02, 0.]),
+    3: np.array([0.1, 0.8, 0.1]),
+}
+
+# No TDC transition
+_TDC_NONE = 62
+
+
+def _adc(fc):
+    """Rough QIE charge -> ADC mapping (logarithmic, 8 bits)"""
+    return np.clip(np.round(40. * np.log1p(fc / 4.)), 0, 255).astype(np.int32)
+
+
+def make_digis(rng, subdet, nevents, occupancy, mean_charge):
+    """Record array (nevents x nchannels) of the digis of one subdetector"""
+    channels = np.array(_subdet_channels(subdet), dtype=np.int32)
+    nchannels = len(channels)
+    nts = NTS[subdet]
+    shape = (nevents, nchannels)
+
+    valid = rng.random(shape) < occupancy
+    charge = rng.exponential(mean_charge, shape) * valid
+    pedestalfc = np.broadcast_to(rng.normal(6., 0.3, (1, nchannels, 1)), shape + (nts,)).astype(np.float32)
+    fc = (pedestalfc + rng.normal(0., 1., shape + (nts,)) + charge[..., None] * _PULSE[nts]).clip(0.).astype(np.float32)
+    adc = _adc(fc)
+    # TDC: rising edge in the peak time sample, for hits well above the pedestal
+    peak = int(np.argmax(_PULSE[nts]))
+    tdc = np.full(shape + (nts,), _TDC_NONE, dtype=np.int32)
+    tdc[..., peak] = np.where(charge > 50., rng.integers(0, 50, shape), _TDC_NONE)
+    capid = ((np.arange(nts) + rng.integers(0, 4, (nevents, 1, 1))) % 4).astype(np.int32)
+    capid = np.broadcast_to(capid, shape + (nts,))
+
+    fields = {
+        "valid": valid,
+        "ieta": np.broadcast_to(channels[:, 0], shape),
+        "iphi": np.broadcast_to(channels[:, 1], shape),
+        "depth": np.broadcast_to(channels[:, 2], shape),
+    }
+    invalid = ~valid[..., None]
+    for name, values in [("adc", adc), ("fc", fc), ("pedestalfc", pedestalfc), ("tdc", tdc), ("capid", capid)]:
+        values = np.where(invalid, 0, values).astype(values.dtype)
+        for iTS in range(nts):
+            fields[f"{name}{iTS}"] = values[..., iTS]
+    # Jagged (not regular) lists, as in hcalnano: uproot only writes jagged collections
+    counts = np.full(nevents, nchannels)
+    return ak.zip({
+        name: ak.unflatten(np.ascontiguousarray(values).reshape(-1), counts)
+        for name, values in fields.items()
+    })
+
+
+def make_events(rng, nevents, first_event=1, run=1, occupancy=0.03, mean_charge=30., collections=COLLECTIONS):
+    """{branch name: array} for nevents events, ready to be written with uproot"""
+    event = np.arange(first_event, first_event + nevents, dtype=np.uint64)
+    branches = {
+        "run": np.full(nevents, run, dtype=np.uint32),
+        "luminosityBlock": (1 + (event - 1) // 1000).astype(np.uint32),
+        "event": event,
+        # About 10% of the events in BX 1, the rest spread over the orbit
+        "bunchCrossing": np.where(rng.random(nevents) < 0.1, 1, rng.integers(2, 3565, nevents)).astype(np.uint32),
+    }
+    for name, subdet in collections.items():
+        branches[name] = make_digis(rng, subdet, nevents, occupancy, mean_charge)
+    return branches
+
+
+def write_file(path, nevents, occupancy=0.03, mean_charge=30., run=1, seed=0, batchsize=100, collections=COLLECTIONS):
+    """Write a synthetic hcalnano file with nevents events, in baskets of batchsize events"""
+    rng = np.random.default_rng(seed)
+    with uproot.recreate(path) as f:
+        for first in range(0, nevents, batchsize):
+            branches = make_events(rng, min(batchsize, nevents - first), first_event=first + 1, run=run,
+                                   occupancy=occupancy, mean_charge=mean_charge, collections=collections)
+            if first == 0:
+                f["Events"] = branches
+            else:
+                f["Events"].extend(branches)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a synthetic hcalnano file")
+    parser.add_argument(dest="outputfile", type=str, help="Output ROOT file")
+    parser.add_argument("-n", "--events", type=int, default=1000, help="Number of events")
+    parser.add_argument("-p", "--preset", type=str, default="minbias", choices=list(PRESETS), help="Occupancy/charge preset")
+    parser.add_argument("--occupancy", type=float, default=None, help="Fraction of valid digis (overrides the preset)")
+    parser.add_argument("--mean-charge", type=float, default=None, help="Mean hit charge in fC (overrides the preset)")
+    parser.add_argument("--run", type=int, default=1, help="Run number")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    occupancy, mean_charge = PRESETS[args.preset]
+    if args.occupancy is not None:
+        occupancy = args.occupancy
+    if args.mean_charge is not None:
+        mean_charge = args.mean_charge
+    write_file(args.outputfile, args.events, occupancy=occupancy, mean_charge=mean_charge, run=args.run, seed=args.seed)
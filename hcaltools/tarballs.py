@@ -0,0 +1,101 @@
+'''
+Fingerprinted tarballs of the user code and venv, for condor submission.
+
+Tarring the venv takes minutes, and it hardly ever changes. The job environment is split into two layers:
+  - venv: the dependencies. Its fingerprint is computed from the installed distributions (the names of the
+    .dist-info/.egg-info entries, .pth and .egg-link files, and pyvenv.cfg), without reading the packages.
+  - usercode: hcalanalysis, hcaltools, setup.py and env.sh. Its fingerprint is a hash of the file contents.
+The fingerprint is part of the tarball name, so an existing tarball is reused as long as nothing changed.
+Workers unpack the venv layer once per node (see crun_processor.py).
+'''
+import os
+import glob
+import fnmatch
+import hashlib
+import subprocess
+import tempfile
+
+# Compression codecs: (tarball extension, compress program, tar extract flags)
+CODECS = {
+    "gz": ("tar.gz", "gzip", "-xzf"),
+    "zst": ("tar.zst", "zstd -T0", "--use-compress-program=unzstd -xf"),
+}
+
+
+def list_files(root, paths, exclude=()):
+    """Paths (relative to root) of the files and symlinks under root/paths, skipping those matching exclude"""
+    files = []
+    for path in paths:
+        if os.path.isfile(os.path.join(root, path)):
+            files.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, path)):
+            reldir = os.path.relpath(dirpath, root)
+            # Symlinked directories (e.g. venv/lib64) are archived as links
+            links = [x for x in dirnames if os.path.islink(os.path.join(dirpath, x))]
+            dirnames[:] = [x for x in dirnames if x not in links and not any(fnmatch.fnmatch(os.path.join(reldir, x), pattern) for pattern in exclude)]
+            for filename in filenames + links:
+                relpath = os.path.join(reldir, filename)
+                if not any(fnmatch.fnmatch(relpath, pattern) for pattern in exclude):
+                    files.append(relpath)
+    return sorted(files)
+
+
+def content_fingerprint(root, files):
+    """sha256 of the names and contents of files (relative to root)"""
+    digest = hashlib.sha256()
+    for relpath in files:
+        path = os.path.join(root, relpath)
+        digest.update(relpath.encode() + b"\0")
+        if os.path.islink(path):
+            digest.update(os.readlink(path).encode())
+        else:
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def venv_fingerprint(venv_dir):
+    """sha256 of the distributions installed in a venv, without reading the packages themselves"""
+    digest = hashlib.sha256()
+    with open(os.path.join(venv_dir, "pyvenv.cfg"), "rb") as f:
+        digest.update(f.read())
+    for site_packages in sorted(glob.glob(os.path.join(venv_dir, "lib", "python*", "site-packages"))):
+        for entry in sorted(os.listdir(site_packages)):
+            if entry.endswith((".dist-info", ".egg-info")):
+                digest.update(entry.encode() + b"\0")
+            elif entry.endswith((".pth", ".egg-link")):
+                with open(os.path.join(site_packages, entry), "rb") as f:
+                    digest.update(entry.encode() + b"\0" + f.read() + b"\0")
+    return digest.hexdigest()
+
+
+def build_tarball(root, files, path, codec="gz"):
+    """Tar files (relative to root) into path, atomically"""
+    _, compressor, _ = CODECS[codec]
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as filelist:
+        filelist.write("\n".join(files) + "\n")
+        filelist.flush()
+        tmp_path = path + ".tmp"
+        subprocess.run(["tar", "-c", "-I", compressor, "-f", tmp_path, "-C", root, "--no-recursion", "-T", filelist.name], check=True)
+    os.replace(tmp_path, path)
+
+
+def cached_tarball(tarball_dir, name, root, files, fingerprint, codec="gz", force=False):
+    """Path of the tarball {name}-{fingerprint}.{ext} in tarball_dir, built only if missing (or force)
+
+    files can also be a function returning the files, so that they are only listed if needed.
+    """
+    extension, _, _ = CODECS[codec]
+    path = os.path.join(tarball_dir, f"{name}-{fingerprint[:16]}.{extension}")
+    if os.path.isfile(path) and not force:
+        print(f"Reusing {path}")
+        return path
+    if callable(files):
+        files = files()
+    print(f"Tarring {len(files)} files into {path}...")
+    build_tarball(root, files, path, codec)
+    print("...done")
+    return path
@@ -0,0 +1,77 @@
+import pytest
+import numpy as np
+
+pytest.importorskip("coffea")
+from hcaltools.accumulators import TopKAccumulator, EventListAccumulator
+
+
+def split_fill(acc, nparts, *columns):
+    """Fill copies of acc with nparts slices of columns, and merge them in reverse order"""
+    parts = []
+    for part in zip(*(np.array_split(np.asarray(column), nparts) for column in columns)):
+        filled = acc.identity()
+        filled.fill(*part)
+        parts.append(filled)
+    merged = acc.identity()
+    for filled in reversed(parts):
+        merged.add(filled)
+    return merged
+
+
+def test_topk():
+    acc = TopKAccumulator(3)
+    acc.fill([1, 2, 3, 4, 5], [10., 50., 30., 50., 20.])
+    # Ties broken by event number
+    assert acc.items() == [(2, 50.), (4, 50.), (3, 30.)]
+
+
+def test_topk_merge_order():
+    rng = np.random.default_rng(1)
+    events = rng.permutation(1000)
+    values = rng.integers(0, 50, 1000).astype(float)
+    single = TopKAccumulator(20)
+    single.fill(events, values)
+    assert split_fill(TopKAccumulator(20), 7, events, values).items() == single.items()
+    assert len(single) == 20
+
+
+def test_eventlist_policies():
+    run = [1, 1, 2, 2, 1]
+    lumi = [1, 2, 1, 1, 1]
+    event = [5, 3, 2, 1, 4]
+    value = [1., 5., 3., 4., 2.]
+    first = EventListAccumulator(cap=3, policy="first")
+    first.fill(run, lumi, event, value)
+    assert [x[:3] for x in first.items()] == [(1, 1, 4), (1, 1, 5), (1, 2, 3)]
+
+    top = EventListAccumulator(cap=2, policy="top")
+    top.fill(run, lumi, event, value)
+    assert [x[3] for x in top.items()] == [5., 4.]
+
+    with pytest.raises(ValueError):
+        EventListAccumulator(policy="largest")
+
+
+@pytest.mark.parametrize("policy", EventListAccumulator.policies)
+def test_eventlist_merge_order(policy):
+    rng = np.random.default_rng(2)
+    n = 2000
+    run = rng.integers(1, 4, n)
+    lumi = rng.integers(1, 50, n)
+    event = rng.permutation(n) + 1
+    value = rng.random(n)
+    single = EventListAccumulator(cap=50, policy=policy)
+    single.fill(run, lumi, event, value)
+    assert len(single) == 50
+    for nparts in [2, 5, 13]:
+        assert split_fill(EventListAccumulator(cap=50, policy=policy), nparts, run, lumi, event, value).items() == single.items()
+
+
+def test_eventlist_duplicates():
+    acc = EventListAccumulator(cap=10, policy="top")
+    acc.fill(1, 1, [7, 8], [1., 2.])
+    other = acc.identity()
+    other.fill(1, 1, [7], [3.])
+    acc.add(other)
+    # Event 7 is kept once, with the preferred (largest) value
+    assert acc.items() == [(1, 1, 7, 3.), (1, 1, 8, 2.)]
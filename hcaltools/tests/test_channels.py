@@ -0,0 +1,59 @@
+import pytest
+import numpy as np
+
+pytest.importorskip("coffea")
+from hcaltools.channels import ChannelMap, channel_index, SUBDETS
+
+
+def test_index():
+    assert len(np.unique(np.stack([channel_index.subdet, channel_index.ieta, channel_index.iphi, channel_index.depth]), axis=1).T) == len(channel_index)
+    idx = channel_index.index("HB", [1, -16, 17, 1, 50], [1, 72, 1, 0, 1], [1, 4, 1, 1, 1])
+    assert (idx[:2] >= 0).all()
+    # Out of HB, iphi 0, |ieta| > 41
+    assert (idx[2:] == -1).all()
+    assert channel_index.ieta[idx[1]] == -16 and channel_index.iphi[idx[1]] == 72 and channel_index.depth[idx[1]] == 4
+    # HF only has odd iphi
+    assert channel_index.index("HF", [30, 30], [1, 2], [1, 1]).tolist()[1] == -1
+
+
+def test_fill():
+    m = ChannelMap(label="q")
+    m.fill("HE", ieta=[20, 20, 21, 99], iphi=[3, 3, 5, 1], depth=[2, 2, 1, 1], weight=[1., 2., 4., 8.], key=[10, 11, 10, 10])
+    assert m.unmapped == 1
+    assert m.keys.tolist() == [10, 11]
+    idx = channel_index.index("HE", [20, 21], [3, 5], [2, 1])
+    assert m.values(10)[idx].tolist() == [1., 4.]
+    assert m.entries(11)[idx].tolist() == [1, 0]
+    assert m.entries(11).dtype == np.int32
+    assert m.values(10).sum() == 5.
+    with pytest.raises(KeyError):
+        m.values(12)
+
+
+def test_add():
+    a = ChannelMap()
+    a.fill("HB", [1], [1], [1], weight=[1.], key=[5])
+    b = ChannelMap()
+    b.fill("HB", [1, 2], [1, 1], [1, 1], weight=[2., 3.], key=[3, 5])
+    b.fill("HF", [99], [1], [1])
+    a.add(b)
+    idx = channel_index.index("HB", [1, 2], [1, 1], [1, 1])
+    assert a.keys.tolist() == [3, 5]
+    assert a.values(5)[idx].tolist() == [1., 3.]
+    assert a.values(3)[idx].tolist() == [2., 0.]
+    assert a.unmapped == 1
+    # Merging is the same as filling everything into one map
+    c = ChannelMap()
+    c.fill("HB", [1, 1, 2], [1, 1, 1], [1, 1, 1], weight=[1., 2., 3.], key=[5, 3, 5])
+    assert np.array_equal(c.values(5), a.values(5)) and np.array_equal(c.entries(3), a.entries(3))
+
+
+def test_to_hist():
+    m = ChannelMap()
+    m.fill("HB", [1, -1], [1, 2], [1, 1], weight=[2., 3.])
+    m.fill("HE", [20], [3], [2], weight=[4.])
+    h = m.to_hist()
+    assert h.sum() == 9.
+    assert h[{"ieta": 42, "iphi": 0, "depth": 0}] == 2.
+    assert m.to_hist(subdet="HE").sum() == 4.
+    assert m.to_hist(where=channel_index.subdet == SUBDETS.index("HB")).sum() == 5.
@@ -0,0 +1,35 @@
+from hcaltools.columns import ColumnSet
+
+
+class DeclaringProcessor:
+    columns = {"event": None, "DigiHB": ["valid", "fc"]}
+
+
+def test_filter():
+    columns = ColumnSet({
+        "event": None,
+        "RecHitHBHE": None,
+        "DigiHB": ["valid", "ieta", "fc", "tdc"],
+    })
+    selected = [
+        "event",
+        "nDigiHB", "DigiHB_valid", "DigiHB_ieta",
+        # Per-time-sample branches of packed fields
+        "DigiHB_fc0", "DigiHB_fc7", "DigiHB_tdc3",
+        # Whole collections
+        "nRecHitHBHE", "RecHitHBHE_energy",
+    ]
+    rejected = [
+        "run", "luminosityBlock",
+        "DigiHB_iphi", "DigiHB_pedestalfc0", "DigiHB_adc0",
+        "DigiHE_valid", "nDigiHE", "DigiHBx_valid",
+    ]
+    assert [name for name in selected if not columns(name)] == []
+    assert [name for name in rejected if columns(name)] == []
+
+
+def test_from_processor():
+    columns = ColumnSet.from_processor(DeclaringProcessor())
+    assert columns.names == ["event", "DigiHB"]
+    assert columns("DigiHB_fc3") and not columns("DigiHB_ieta")
+    assert ColumnSet.from_processor(object()) is None
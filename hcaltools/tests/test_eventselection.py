@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+
+from hcaltools.eventselection import EventSelection
+
+SPLASHES23 = os.path.join(os.path.dirname(__file__), "..", "..", "hcalanalysis", "filelists", "eventlists", "splashes23.json")
+
+
+def test_mask():
+    selection = EventSelection({"runA": [30, 10, 20, 10], "runB": []})
+    assert len(selection) == 3
+    assert selection.events("runA").tolist() == [10, 20, 30]
+    events = np.array([5, 10, 15, 20, 30, 31, 2**40])
+    assert selection.mask("runA", events).tolist() == [False, True, False, True, True, False, False]
+    assert not selection.mask("runB", events).any()
+    assert not selection.mask("runC", events).any()
+    assert selection.mask("runA", np.zeros(0, dtype=np.uint64)).tolist() == []
+
+
+def test_any():
+    selection = EventSelection({"runA": [10, 20]})
+    assert selection.any("runA", [1, 20])
+    assert not selection.any("runA", [11, 12, 19])
+    assert not selection.any("runA", [21, 100])
+    assert not selection.any("runA", [])
+    assert not selection.any("runC", [10])
+
+
+def test_round_trip(tmp_path):
+    selection = EventSelection({"runA": [3, 1, 2], "runB": [7]})
+    path = str(tmp_path / "events.json")
+    selection.to_file(path)
+    loaded = EventSelection.from_file(path)
+    assert sorted(loaded.runs) == ["runA", "runB"]
+    assert loaded.events("runA").tolist() == [1, 2, 3]
+
+
+def test_splashes23():
+    selection = EventSelection.from_file(SPLASHES23)
+    assert len(selection.events("r365373_Splashes_FEVT")) == 5
+    assert len(selection.events("r365537_Splashes_FEVT")) == 123
+    assert selection.mask("r365373_Splashes_FEVT", [215, 216, 217, 1520]).tolist() == [False, True, True, True]
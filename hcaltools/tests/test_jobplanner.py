@@ -0,0 +1,68 @@
+import random
+
+import pytest
+
+from hcaltools.jobplanner import plan_jobs, job_entry_ranges
+
+
+def check_plan(files, target, chunksize):
+    """Check that the jobs cover each file once, in chunk multiples, and respect the target"""
+    jobs = plan_jobs(files, target, chunksize=chunksize)
+    nentries = {filename: n for filename, n, _ in files}
+    weight = {filename: w for filename, _, w in files}
+
+    covered = {}
+    for job in jobs:
+        assert job
+        work = sum((stop - start) * weight[filename] for filename, start, stop in job)
+        single_chunk = len(job) == 1 and job[0][2] - job[0][1] <= chunksize
+        assert work <= target * (1 + 1e-9) or single_chunk
+        for filename, start, stop in job:
+            assert start % chunksize == 0
+            assert stop % chunksize == 0 or stop == nentries[filename]
+            covered.setdefault(filename, []).append((start, stop))
+
+    for filename, n, _ in files:
+        if n == 0:
+            assert filename not in covered
+            continue
+        ranges = covered[filename]
+        assert ranges[0][0] == 0 and ranges[-1][1] == n
+        assert all(ranges[i][1] == ranges[i + 1][0] for i in range(len(ranges) - 1))
+    return jobs
+
+
+def test_uneven_files():
+    files = [("a.root", 1000, 1.), ("b.root", 350, 1.), ("c.root", 2000, 1.)]
+    jobs = check_plan(files, 1000, 100)
+    assert len(jobs) == 4
+    assert job_entry_ranges(jobs[1]) == {"a.root": [[800, 1000]], "b.root": [[0, 350]], "c.root": [[0, 300]]}
+
+
+@pytest.mark.parametrize("chunksize", [1, 7, 250, 333])
+def test_chunksize_not_dividing(chunksize):
+    files = [("a.root", 1234, 1.), ("b.root", 5, 1.), ("c.root", 999, 1.), ("d.root", 0, 1.)]
+    jobs = check_plan(files, 700, chunksize)
+    assert len(jobs) >= 4
+
+
+def test_bytes_weights():
+    files = [("a.root", 5000, 2.5), ("b.root", 100, 0.37), ("c.root", 1234, 1.)]
+    check_plan(files, 2345., 100)
+
+
+def test_chunk_larger_than_target():
+    jobs = check_plan([("a.root", 1000, 1.)], 50, 300)
+    assert [job[0][1:] for job in jobs] == [(0, 300), (300, 600), (600, 900), (900, 1000)]
+
+
+def test_random_plans():
+    rng = random.Random(3)
+    for _ in range(500):
+        files = [(f"f{i}.root", rng.choice([0, 1, 7, 100, 999, 1234, 5000]), rng.choice([1., 0.37, 2.5]))
+                 for i in range(rng.randint(1, 8))]
+        check_plan(files, rng.choice([50, 500, 1000, 2345, 10000]), rng.choice([1, 7, 100, 250, 333]))
+
+
+def test_empty():
+    assert plan_jobs([("a.root", 0, 1.)], 100) == []
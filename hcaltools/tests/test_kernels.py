@@ -0,0 +1,72 @@
+import pytest
+import numpy as np
+
+from hcaltools import kernels
+from hcaltools.kernels import digi_timing
+
+implementations = [False] + ([True] if kernels.numba is not None else [])
+
+
+def reference(fc, tdc):
+    """The per-time-sample computation digi_timing replaces (as formerly in SplashProcessor)"""
+    nTS = fc.shape[1]
+    sumq = sum(fc[:, iTS] for iTS in range(nTS))
+    qtime_sum = sum(25.0 * iTS * fc[:, iTS] for iTS in range(nTS))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        qtime = np.where(sumq != 0, qtime_sum / sumq, np.nan)
+    tdctime = np.stack([np.where(tdc[:, iTS] < 50, 25 * iTS + 0.5 * tdc[:, iTS], np.nan) for iTS in range(nTS)], axis=-1).min(axis=-1)
+    return sumq, qtime, tdctime
+
+
+@pytest.fixture(params=[8, 3], ids=["HBHE", "HF"])
+def digis(request):
+    rng = np.random.default_rng(request.param)
+    n = 5000
+    fc = rng.normal(50., 40., (n, request.param)).astype(np.float32)
+    fc[:20] = 0.
+    tdc = rng.choice([10, 30, 49, 50, 62], (n, request.param)).astype(np.int32)
+    tdc[:100] = rng.integers(0, 50, (100, request.param))
+    return fc, tdc
+
+
+@pytest.mark.parametrize("use_numba", implementations)
+def test_matches_reference(digis, use_numba):
+    fc, tdc = digis
+    sumq, qtime, tdctime = digi_timing(fc, tdc, use_numba=use_numba)
+    ref_sumq, ref_qtime, ref_tdctime = reference(fc, tdc)
+    assert np.allclose(sumq, ref_sumq, rtol=1e-5, atol=1e-3)
+    assert np.allclose(qtime, ref_qtime, rtol=1e-4, atol=1e-3, equal_nan=True)
+    # Zero charge gives NaN, not inf
+    assert np.isnan(qtime[:20]).all()
+    assert np.array_equal(tdctime, ref_tdctime, equal_nan=True)
+    assert np.isfinite(tdctime[:100]).all()
+
+
+@pytest.mark.parametrize("use_numba", implementations)
+def test_earliest_valid_tdc(use_numba):
+    tdc = np.array([
+        [62, 10, 62, 40],  # first valid TS is 1
+        [20, 62, 62, 62],  # TS 0
+        [62, 62, 62, 62],  # none
+        [5, 5, 5, 5],      # all valid
+    ], dtype=np.int32)
+    fc = np.ones(tdc.shape, dtype=np.float32)
+    _, _, baseline = digi_timing(fc, tdc, use_numba=use_numba)
+    _, _, earliest = digi_timing(fc, tdc, use_numba=use_numba, earliest_valid_tdc=True)
+    assert np.array_equal(baseline, [np.nan, np.nan, np.nan, 2.5], equal_nan=True)
+    assert np.array_equal(earliest, [30., 10., np.nan, 2.5], equal_nan=True)
+
+
+@pytest.mark.skipif(kernels.numba is None, reason="numba is not installed")
+def test_numba_matches_numpy(digis):
+    fc, tdc = digis
+    for earliest_valid_tdc in [False, True]:
+        compiled = digi_timing(fc, tdc, use_numba=True, earliest_valid_tdc=earliest_valid_tdc)
+        fallback = digi_timing(fc, tdc, use_numba=False, earliest_valid_tdc=earliest_valid_tdc)
+        for a, b in zip(compiled, fallback):
+            assert np.allclose(a, b, rtol=1e-9, atol=1e-6, equal_nan=True)
+
+
+def test_without_tdc():
+    sumq, qtime, tdctime = digi_timing(np.array([[1., 3.]]), use_numba=False)
+    assert sumq.tolist() == [4.] and qtime.tolist() == [18.75] and tdctime is None
@@ -0,0 +1,118 @@
+import pytest
+
+ak = pytest.importorskip("awkward")
+pytest.importorskip("coffea")
+from coffea import processor
+
+from hcaltools import runner, synthetic, skim, parquetio
+from hcaltools.columns import ColumnSet
+from hcalanalysis.schemas import HcalNanoAODSchema
+
+COLUMNS = ColumnSet({
+    "event": None,
+    "DigiHB": ["valid", "ieta", "fc"],
+    "DigiHF": ["valid", "ieta", "fc", "tdc"],
+})
+
+
+class ChargeProcessor(processor.ProcessorABC):
+    """Counts events and valid digis, and sums their charge"""
+
+    columns = {
+        "event": None,
+        "DigiHB": ["valid", "ieta", "fc"],
+        "DigiHF": ["valid", "ieta", "fc", "tdc"],
+    }
+
+    def process(self, events):
+        output = {"nevents": len(events)}
+        for collection in ["DigiHB", "DigiHF"]:
+            digis = events[collection]
+            digis = digis[digis.valid]
+            output[f"ndigis_{collection}"] = int(ak.sum(ak.num(digis, axis=1)))
+            output[f"sumq_{collection}"] = float(ak.sum(digis.fc))
+        return {events.metadata["dataset"]: output}
+
+    def postprocess(self, accumulator):
+        return accumulator
+
+
+@pytest.fixture(scope="module")
+def chunks(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("synthetic") / "synthetic.root")
+    synthetic.write_file(path, 50, occupancy=0.3, batchsize=20,
+                         collections={name: subdet for name, subdet in synthetic.COLLECTIONS.items() if name in ("DigiHB", "DigiHF")})
+    # 50 entries in chunks of 15: the last chunk is short, and chunks straddle baskets
+    return runner.plan_chunks({"synthetic": [path]}, chunksize=15)
+
+
+def flat(array):
+    return ak.to_numpy(ak.flatten(array, axis=None))
+
+
+def test_preloaded_matches_lazy(chunks):
+    for chunk in chunks:
+        lazy = runner.open_events(chunk, HcalNanoAODSchema, COLUMNS)
+        eager = runner.events_from_arrays(runner.read_arrays(chunk, COLUMNS), chunk, HcalNanoAODSchema)
+        assert len(lazy) == len(eager) == chunk.entrystop - chunk.entrystart
+        assert (flat(lazy.event) == flat(eager.event)).all()
+        for collection, nTS in [("DigiHB", 8), ("DigiHF", 3)]:
+            # The per-time-sample branches are packed into (ndigis x nTS) fields by the schema
+            assert (flat(ak.num(eager[collection].fc, axis=2)) == nTS).all()
+            assert (flat(lazy[collection].fc) == flat(eager[collection].fc)).all()
+            assert (flat(lazy[collection].ieta) == flat(eager[collection].ieta)).all()
+        assert (flat(lazy.DigiHF.tdc) == flat(eager.DigiHF.tdc)).all()
+
+
+def test_undeclared_column_fails(chunks):
+    events = runner.open_events(chunks[0], HcalNanoAODSchema, COLUMNS)
+    with pytest.raises(Exception):
+        events.DigiHB.pedestalfc
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_read_ahead_matches_process_chunk(chunks, lazy):
+    processor_instance = ChargeProcessor()
+    expected = None
+    for chunk in chunks:
+        expected = processor.accumulate([runner.process_chunk(chunk, processor_instance, HcalNanoAODSchema, COLUMNS)], expected)
+
+    output = runner.process_chunk_group(tuple(chunks), processor_instance, HcalNanoAODSchema, COLUMNS, depth=2, lazy=lazy)
+    stats = output["synthetic"].pop("_readahead")
+    assert stats.nchunks == len(chunks)
+    assert stats.nlazy == (len(chunks) if lazy else 0)
+    assert output["synthetic"]["nevents"] == 50
+    assert output["synthetic"]["ndigis_DigiHB"] == expected["synthetic"]["ndigis_DigiHB"]
+    assert output["synthetic"]["sumq_DigiHF"] == pytest.approx(expected["synthetic"]["sumq_DigiHF"])
+
+
+class MarkingProcessor(ChargeProcessor):
+    """ChargeProcessor marking events with an event number divisible by 7"""
+
+    def process(self, events):
+        skim.mark(events.event % 7 == 0)
+        return super().process(events)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_skim(chunks, tmp_path, lazy):
+    skim_writer = skim.SkimWriter(str(tmp_path / "skim"), ["DigiHF"])
+    output = runner.process_chunk_group(tuple(chunks), MarkingProcessor(), HcalNanoAODSchema, COLUMNS, depth=2, lazy=lazy,
+                                        skim_writer=skim_writer)
+    parts = output["synthetic"]["_skim"]
+    assert sum(parts.values()) == 50 // 7
+    events = []
+    for path in sorted(parts, key=lambda path: int(path.rsplit("_", 1)[1].split("-")[0])):
+        arrays = parquetio.read_branches(path)
+        # Whole collection, including the branches not read for the processor
+        assert {"run", "luminosityBlock", "event", "nDigiHF", "DigiHF_fc1", "DigiHF_adc1"} <= set(arrays)
+        assert not any(name.startswith("DigiHB") for name in arrays)
+        events.extend(arrays["event"].tolist())
+    assert events == list(range(7, 50, 7))
+
+    # The skim reads back like the original file
+    skimmed = runner.plan_chunks({"synthetic": sorted(parts)}, chunksize=15, nentries=parts)
+    original = runner.read_arrays(chunks[0], COLUMNS)
+    part = runner.read_arrays(skimmed[0], COLUMNS)
+    assert (flat(part["event"]) == [7, 14]).all()
+    assert (flat(part["DigiHF_fc1"]) == flat(original["DigiHF_fc1"][[6, 13]])).all()
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+pytest.importorskip("coffea")
+from hcaltools import workerpool
+from hcaltools.runner import Chunk
+from hcaltools.workerpool import recycling_executor, split_task
+
+
+def count_entries(chunk):
+    """Number of entries of chunk, dying on chunks of more than 10 entries"""
+    if chunk.entrystop - chunk.entrystart > 10:
+        os._exit(workerpool.EXIT_MEMORY)
+    return {"nentries": chunk.entrystop - chunk.entrystart}
+
+
+def make_chunks(*sizes):
+    chunks, start = [], 0
+    for size in sizes:
+        chunks.append(Chunk("dataset", "file.root", "Events", start, start + size))
+        start += size
+    return chunks
+
+
+def test_split_task():
+    chunk, = make_chunks(7)
+    assert split_task(chunk) == (chunk._replace(entrystop=3), chunk._replace(entrystart=3))
+    assert split_task(make_chunks(1)[0]) is None
+    group = tuple(make_chunks(5, 5, 5))
+    assert split_task(group) == (group[:1], group[1:])
+
+
+def test_retry_in_halves(capsys):
+    chunks = make_chunks(5, 16, 5)
+    results = dict(recycling_executor(chunks, count_entries, workers=2))
+    assert {chunks[0]: 5, chunks[1]: 16, chunks[2]: 5} == {chunk: output["nentries"] for (chunk,), output in results.items()}
+    assert "retrying in two halves" in capsys.readouterr().out
+
+    with pytest.raises(RuntimeError, match="even after splitting"):
+        list(recycling_executor(make_chunks(30), count_entries, workers=1))
+
+
+def test_death_before_start(monkeypatch, capsys):
+    chunks = make_chunks(5, 5)
+    submit = workerpool._Worker.submit
+
+    def kill_then_submit(worker, task):
+        # The worker dies after the liveness check, before it gets the second chunk
+        if task[0] == chunks[1] and not getattr(kill_then_submit, "killed", False):
+            kill_then_submit.killed = True
+            worker.process.kill()
+            worker.process.join()
+        submit(worker, task)
+
+    monkeypatch.setattr(workerpool._Worker, "submit", kill_then_submit)
+    results = list(recycling_executor(chunks, count_entries, workers=1))
+    assert [chunk for (chunk,), _ in results] == chunks
+    out = capsys.readouterr().out
+    assert "before starting" in out and "retrying in two halves" not in out
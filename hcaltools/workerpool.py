@@ -0,0 +1,197 @@
+'''
+Process pool with memory-capped, recycled workers.
+
+Long jobs creep up in RSS (slow leaks, fragmentation), and rare high-occupancy chunks (splashes) can blow
+up a single worker. Here each worker runs one chunk at a time, and
+  - is replaced after max_chunks chunks, or when its RSS is above max_rss after a chunk
+  - kills itself if its RSS goes above max_rss while processing a chunk (checked by a watcher thread);
+    the chunk is then retried once, split into two halves. A worker killed by the kernel OOM killer is
+    handled the same way.
+Workers acknowledge each chunk when they start it, so a worker which died before starting a chunk (e.g.
+while idle) is replaced without blaming the chunk, which is resubmitted as is.
+'''
+import os
+import sys
+import time
+import threading
+import traceback
+import multiprocessing
+import multiprocessing.connection
+from collections import deque
+
+from coffea import processor
+
+# Exit code of a worker which killed itself for going above max_rss
+EXIT_MEMORY = 75
+
+
+def rss():
+    """Resident set size of this process, in bytes"""
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _watch_memory(max_rss, interval=0.5):
+    while True:
+        if rss() > max_rss:
+            sys.stderr.write(f"Worker {os.getpid()} above {max_rss / 1e6:.0f} MB, exiting\n")
+            sys.stderr.flush()
+            os._exit(EXIT_MEMORY)
+        time.sleep(interval)
+
+
+def _worker_main(function, conn, max_rss):
+    if max_rss is not None:
+        threading.Thread(target=_watch_memory, args=(max_rss,), daemon=True).start()
+    while True:
+        chunk = conn.recv()
+        if chunk is None:
+            return
+        conn.send(("started", None, rss()))
+        try:
+            output = function(chunk)
+        except Exception:
+            conn.send(("error", traceback.format_exc(), rss()))
+        else:
+            conn.send(("ok", output, rss()))
+
+
+class _Worker:
+    def __init__(self, context, function, max_rss):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(function, child_conn, max_rss), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = False
+        self.nchunks = 0
+
+    def submit(self, task):
+        self.task = task
+        self.started = False
+        try:
+            self.conn.send(task[0])
+        except (BrokenPipeError, OSError):
+            # Worker is gone; this is picked up like a death during the chunk
+            pass
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+def split_task(task):
+    """Two halves of a task (None if it can't be split)
+
+    A group of chunks (see runner.group_chunks) is split into two groups, and a single chunk into two
+    entry ranges.
+    """
+    if not hasattr(task, "_fields"):
+        if len(task) > 1:
+            return task[:len(task) // 2], task[len(task) // 2:]
+        halves = split_task(task[0])
+        return None if halves is None else ((halves[0],), (halves[1],))
+    if task.entrystop - task.entrystart < 2:
+        return None
+    middle = (task.entrystart + task.entrystop) // 2
+    return task._replace(entrystop=middle), task._replace(entrystart=middle)
+
+
+def recycling_executor(chunks, function, workers=4, max_rss=None, max_chunks=None):
+    """Yield ((chunk,), function(chunk)) for all chunks, computed by memory-capped, recycled workers
+
+    Chunks can also be groups of chunks (see runner.group_chunks).
+    max_rss is the per-worker RSS ceiling in bytes, and max_chunks the number of chunks after which a worker
+    is replaced (None: no limit). A chunk which killed its worker is retried once as two halves, which are
+    merged before being yielded, so the output still corresponds to the original chunk.
+    """
+    context = multiprocessing.get_context()
+    # (chunk, original chunk if this is half of a retried one)
+    queue = deque((chunk, None) for chunk in chunks)
+    halves = {}
+    nrecycled = 0
+    nretried = 0
+    pool = [_Worker(context, function, max_rss) for _ in range(workers)]
+    try:
+        while queue or any(worker.task is not None for worker in pool):
+            for i, worker in enumerate(pool):
+                if worker.task is None and queue:
+                    if not worker.process.is_alive():
+                        # Died while idle (e.g. killed above max_rss after its last chunk): replace it first
+                        print(f"Worker died (exit code {worker.process.exitcode}) while idle, replacing it")
+                        worker.stop()
+                        pool[i] = worker = _Worker(context, function, max_rss)
+                        nrecycled += 1
+                    worker.submit(queue.popleft())
+            busy = [worker for worker in pool if worker.task is not None]
+            multiprocessing.connection.wait([w.conn for w in busy] + [w.process.sentinel for w in busy])
+
+            for i, worker in enumerate(pool):
+                if worker.task is None:
+                    continue
+                chunk, original = worker.task
+                message = None
+                dead = False
+                try:
+                    while message is None and worker.conn.poll():
+                        message = worker.conn.recv()
+                        if message[0] == "started":
+                            worker.started = True
+                            message = None
+                except EOFError:
+                    dead = True
+                if message is None and not dead and worker.process.is_alive():
+                    continue
+
+                if message is None:
+                    worker.process.join()
+                    exitcode = worker.process.exitcode
+                    worker.conn.close()
+                    pool[i] = _Worker(context, function, max_rss)
+                    nrecycled += 1
+                    if not worker.started:
+                        # Worker died before it got the chunk: not the chunk's fault, resubmit it as is
+                        print(f"Worker died (exit code {exitcode}) before starting {chunk}, resubmitting it")
+                        queue.appendleft(worker.task)
+                        continue
+                    # Worker died during the chunk: retry the chunk in two halves
+                    split = split_task(chunk) if original is None else None
+                    if split is None:
+                        raise RuntimeError(f"Worker died (exit code {exitcode}) processing {chunk}, even after splitting")
+                    print(f"Worker died (exit code {exitcode}) processing {chunk}, retrying in two halves")
+                    nretried += 1
+                    halves[chunk] = [2, None]
+                    queue.appendleft((split[1], chunk))
+                    queue.appendleft((split[0], chunk))
+                    continue
+
+                status, output, worker_rss = message
+                if status == "error":
+                    raise RuntimeError(f"Error processing {chunk}:\n{output}")
+                worker.task = None
+                worker.nchunks += 1
+                if (max_rss is not None and worker_rss > max_rss) or (max_chunks is not None and worker.nchunks >= max_chunks):
+                    worker.stop()
+                    pool[i] = _Worker(context, function, max_rss)
+                    nrecycled += 1
+
+                if original is None:
+                    yield (chunk,), output
+                else:
+                    halves[original][0] -= 1
+                    halves[original][1] = processor.accumulate([output], halves[original][1])
+                    if halves[original][0] == 0:
+                        yield (original,), halves.pop(original)[1]
+    finally:
+        for worker in pool:
+            if worker.task is None:
+                worker.stop()
+            elif worker.process.is_alive():
+                worker.process.terminate()
+        print(f"Worker pool: {nrecycled} workers recycled, {nretried} chunks retried")